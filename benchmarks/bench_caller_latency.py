@@ -0,0 +1,35 @@
+"""Latency seen by the calling thread for each `track`/`identify` call, with consumers running."""
+import time
+
+import pytest
+
+from benchmarks.conftest import API_KEY, SERVER_TOKEN
+from usermaven.client import Client
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+@pytest.mark.parametrize("defer_processing", [False, True], ids=["inline", "deferred"])
+def bench_caller_latency(benchmark, stub_server, traffic, defer_processing):
+    def run():
+        client = Client(API_KEY, SERVER_TOKEN, host=stub_server.url, max_queue_size=0,
+                        defer_processing=defer_processing)
+        latencies = []
+        clock = time.perf_counter
+        for call in traffic:
+            start = clock()
+            if call["type"] == "identify":
+                client.identify(call["user"], call.get("company") or {})
+            else:
+                client.track(call["user_id"], call["event_type"], call.get("company") or {},
+                             call.get("event_attributes") or {})
+            latencies.append(clock() - start)
+        client.shutdown()
+        return latencies
+
+    latencies = benchmark.pedantic(run, rounds=1, iterations=1)
+    for p in (50, 99, 99.9):
+        benchmark.extra_info["p%s_us" % p] = percentile(latencies, p) * 1e6
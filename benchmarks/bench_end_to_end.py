@@ -0,0 +1,40 @@
+"""Throughput from `track`/`identify` to the (stub) ingestion endpoint."""
+import time
+
+import pytest
+
+from benchmarks.conftest import API_KEY, SERVER_TOKEN, replay
+from usermaven.client import Client
+
+PROFILES = {
+    "ideal": dict(latency=0, error_rate=0, rate_limit_rate=0),
+    "slow": dict(latency=0.02, error_rate=0, rate_limit_rate=0),
+    "flaky": dict(latency=0.005, error_rate=0.05, rate_limit_rate=0.05),
+}
+
+
+@pytest.mark.parametrize("profile", sorted(PROFILES))
+def bench_end_to_end(benchmark, stub_server, traffic, profile):
+    for name, value in PROFILES[profile].items():
+        setattr(stub_server, name, value)
+
+    runs = []
+
+    def run():
+        runs.append(1)
+        client = Client(API_KEY, SERVER_TOKEN, host=stub_server.url, max_queue_size=0, max_retries=10)
+        start = time.time()
+        replay(client, traffic)
+        client.shutdown()
+        return time.time() - start
+
+    stub_server.reset()
+    elapsed = benchmark.pedantic(run, rounds=3, iterations=1)
+    benchmark.extra_info["events_per_sec"] = len(traffic) / elapsed
+    batches = stub_server.statuses[200]
+    benchmark.extra_info["bytes_per_batch"] = stub_server.byte_count / float(max(batches, 1))
+    benchmark.extra_info["bytes_per_event"] = stub_server.byte_count / float(max(stub_server.event_count, 1))
+    benchmark.extra_info["errors"] = stub_server.statuses[500]
+    benchmark.extra_info["rate_limited"] = stub_server.statuses[429]
+    # --benchmark-disable runs it once
+    assert stub_server.event_count == len(runs) * len(traffic)
@@ -0,0 +1,97 @@
+"""Caller-side costs: cleaning, enqueueing and batch assembly."""
+import tracemalloc
+
+import pytest
+
+from benchmarks.conftest import API_KEY, COMPANY, SERVER_TOKEN
+from usermaven.client import Client
+from usermaven.consumer import Consumer
+from usermaven.utils import clean
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+EVENT_ATTRIBUTES = {"plan_name": "premium", "plan_price": 100, "currency": "USD"}
+
+
+def paused_client(**kwargs):
+    """A client whose consumers are stopped, so events stay on the queue."""
+    client = Client(API_KEY, SERVER_TOKEN, host="http://127.0.0.1:9", max_queue_size=0, **kwargs)
+    client.join()
+    return client
+
+
+def sample_msg():
+    _, msg = Client(API_KEY, SERVER_TOKEN, send=False).track("user_id", "plan_purchased", COMPANY, EVENT_ATTRIBUTES)
+    return msg
+
+
+def bench_clean(benchmark):
+    benchmark(clean, sample_msg())
+
+
+def bench_track(benchmark):
+    client = paused_client()
+    benchmark(client.track, "user_id", "plan_purchased", {}, EVENT_ATTRIBUTES)
+
+
+def bench_track_with_company(benchmark):
+    client = paused_client()
+    benchmark(client.track, "user_id", "plan_purchased", COMPANY, EVENT_ATTRIBUTES)
+
+
+def bench_track_with_changing_company(benchmark):
+    client = paused_client()
+    counter = iter(range(10 ** 9))
+
+    def track():
+        company = dict(COMPANY, custom=dict(COMPANY["custom"], employees=next(counter)))
+        client.track("user_id", "plan_purchased", company, EVENT_ATTRIBUTES)
+
+    benchmark(track)
+
+
+def bench_track_with_company_uncached(benchmark):
+    client = paused_client(company_cache_size=0)
+    benchmark(client.track, "user_id", "plan_purchased", COMPANY, EVENT_ATTRIBUTES)
+
+
+def bench_identify(benchmark):
+    client = paused_client()
+    user = {"id": "user_id", "email": "user@example.com", "created_at": "2022-01-20T09:55:35"}
+    benchmark(client.identify, user, COMPANY)
+
+
+def bench_consumer_next(benchmark):
+    q = queue.Queue()
+    consumer = Consumer(q, API_KEY, SERVER_TOKEN, flush_at=100, flush_interval=0.01)
+    msg = sample_msg()
+
+    def fill():
+        for _ in range(consumer.flush_at):
+            q.put(msg)
+
+    batch = benchmark.pedantic(consumer.next, setup=fill, rounds=200)
+    assert len(batch) == consumer.flush_at
+
+
+@pytest.mark.parametrize("max_queue_bytes", [None, 1 << 31], ids=["dicts", "bytes"])
+def bench_memory_per_queued_event(benchmark, max_queue_bytes):
+    n = 10000
+    client = paused_client(max_queue_bytes=max_queue_bytes)
+
+    def run():
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(n):
+            client.track("user_%d" % i, "plan_purchased", COMPANY, EVENT_ATTRIBUTES)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        while not client.queue.empty():
+            client.queue.get_nowait()
+        return (after - before) / float(n)
+
+    per_event = benchmark.pedantic(run, rounds=1, iterations=1)
+    benchmark.extra_info["bytes_per_queued_event"] = per_event
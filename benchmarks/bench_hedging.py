@@ -0,0 +1,32 @@
+"""Time to deliver each batch against an endpoint with a slow tail, with and without hedged requests."""
+import time
+
+import pytest
+
+from benchmarks.bench_caller_latency import percentile
+from usermaven.consumer import Consumer
+from usermaven.hedging import Hedge
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+BATCH = [{"event_type": "page_viewed", "user": {"id": "user_id"}, "event_id": "x"}] * 20
+
+
+@pytest.mark.parametrize("hedge_after", [None, 0.95], ids=["single", "hedged"])
+def bench_batch_latency(benchmark, hedge_after):
+    # 2% of the requests take 250ms instead of 5ms
+    with FakeIngestionServer(latency=0.005, slow_rate=0.02, slow_latency=0.25, record=False, seed=0) as server:
+        hedge = Hedge(hedge_after) if hedge_after else None
+        consumer = Consumer(None, API_KEY, SERVER_TOKEN, host=server.url, hedge=hedge)
+
+        def run():
+            latencies = []
+            for _ in range(400):
+                start = time.perf_counter()
+                consumer.request(BATCH)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        latencies = benchmark.pedantic(run, rounds=1, iterations=1)
+        for p in (50, 99, 99.9):
+            benchmark.extra_info["p%s_ms" % p] = percentile(latencies, p) * 1e3
+        benchmark.extra_info["requests"] = server.request_count
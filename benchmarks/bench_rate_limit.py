@@ -0,0 +1,34 @@
+"""Backfill throughput against an endpoint enforcing an events per second quota, with and without a rate limiter."""
+import time
+
+import pytest
+
+from usermaven.client import Client
+from usermaven.ratelimit import RateLimiter
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+QUOTA = 4000
+EVENTS = 40000
+
+
+# "ceiling" starts from twice the quota and has to find it from the 429s
+@pytest.mark.parametrize("events_per_second", [None, QUOTA, 2 * QUOTA], ids=["unlimited", "at-quota", "ceiling"])
+def bench_backfill(benchmark, events_per_second):
+    with FakeIngestionServer(latency=0.002, quota=QUOTA, record=False) as server:
+        limiter = RateLimiter(events_per_second) if events_per_second else None
+        client = Client(API_KEY, SERVER_TOKEN, host=server.url, max_queue_size=0, thread=4, max_retries=10,
+                        rate_limiter=limiter)
+
+        def run():
+            started = time.monotonic()
+            for i in range(EVENTS):
+                client.track("user_%d" % (i % 100), "page_viewed")
+            client.flush()
+            return time.monotonic() - started
+
+        elapsed = benchmark.pedantic(run, rounds=1, iterations=1)
+        client.shutdown()
+        benchmark.extra_info["events_per_second"] = server.event_count / elapsed
+        benchmark.extra_info["delivered"] = server.event_count
+        benchmark.extra_info["dropped"] = sum(consumer.dropped_count for consumer in client.consumers)
+        benchmark.extra_info["429s"] = server.statuses[429]
@@ -0,0 +1,23 @@
+"""Request body bytes per event, and time to deliver the traffic, with plain and compact batches."""
+import pytest
+
+from benchmarks.conftest import API_KEY, SERVER_TOKEN, replay
+from usermaven.client import Client
+
+
+@pytest.mark.parametrize("compact", [False, True], ids=["plain", "compact"])
+def bench_request_bytes(benchmark, stub_server, traffic, compact):
+    runs = []
+
+    def run():
+        runs.append(1)
+        client = Client(API_KEY, SERVER_TOKEN, host=stub_server.url, max_queue_size=0, compact_batches=compact)
+        replay(client, traffic)
+        client.shutdown()
+
+    stub_server.reset()
+    benchmark.pedantic(run, rounds=3, iterations=1)
+    benchmark.extra_info["bytes_per_event"] = stub_server.byte_count / float(max(stub_server.event_count, 1))
+    benchmark.extra_info["bytes_per_batch"] = stub_server.byte_count / float(max(stub_server.statuses[200], 1))
+    # --benchmark-disable runs it once
+    assert stub_server.event_count == len(runs) * len(traffic)
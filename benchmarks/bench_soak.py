@@ -0,0 +1,11 @@
+"""A short run of the soak test in `benchmarks/soak.py`; run that module directly for millions of events."""
+import io
+
+from benchmarks.soak import check, format_sample, soak
+
+
+def bench_soak(benchmark):
+    out = io.StringIO()
+    samples, _ = benchmark.pedantic(soak, args=(24000, 4000), kwargs={"out": out, "thread": 2}, rounds=1)
+    benchmark.extra_info["samples"] = [format_sample(s) for s in samples]
+    assert check(samples) == [], out.getvalue()
@@ -0,0 +1,78 @@
+import json
+import random
+
+import pytest
+
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+COMPANY = {
+    "id": "uPq9oUGrIt",
+    "name": "Usermaven",
+    "created_at": "2022-01-20T09:55:35",
+    "custom": {"plan": "enterprise", "industry": "Technology", "website": "https://usermaven.com", "employees": "20"},
+}
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--replay",
+        action="store",
+        default=None,
+        help="JSONL traffic file to replay instead of the synthetic traffic. Each line is a `track` "
+        '({"type": "track", "user_id", "event_type", "company", "event_attributes"}) or an `identify` '
+        '({"type": "identify", "user", "company"}) call.',
+    )
+    parser.addoption("--events", action="store", type=int, default=2000, help="Number of events per end-to-end run.")
+
+
+def synthetic_traffic(n, seed=0):
+    """Return `n` calls that look like a typical server-side integration."""
+    rnd = random.Random(seed)
+    calls = []
+    for i in range(n):
+        user_id = "user_%d" % rnd.randint(0, 500)
+        if i % 20 == 0:
+            calls.append({
+                "type": "identify",
+                "user": {"id": user_id, "email": user_id + "@example.com", "created_at": "2022-01-20T09:55:35",
+                         "custom": {"plan_name": "premium"}},
+                "company": COMPANY,
+            })
+        else:
+            calls.append({
+                "type": "track",
+                "user_id": user_id,
+                "event_type": rnd.choice(["page_viewed", "goal_created", "plan_purchased", "api_call"]),
+                "company": COMPANY if rnd.random() < 0.7 else {},
+                "event_attributes": {"plan_name": "premium", "plan_price": rnd.randint(1, 500), "currency": "USD"},
+            })
+    return calls
+
+
+def load_traffic(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(client, calls):
+    """Send every call in `calls` through `client`."""
+    for call in calls:
+        if call["type"] == "identify":
+            client.identify(call["user"], call.get("company") or {})
+        else:
+            client.track(call["user_id"], call["event_type"], call.get("company") or {},
+                         call.get("event_attributes") or {})
+
+
+@pytest.fixture(scope="session")
+def traffic(request):
+    path = request.config.getoption("--replay")
+    if path:
+        return load_traffic(path)
+    return synthetic_traffic(request.config.getoption("--events"))
+
+
+@pytest.fixture
+def stub_server():
+    with FakeIngestionServer(record=False, seed=0) as server:
+        yield server
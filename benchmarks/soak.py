@@ -0,0 +1,178 @@
+"""Soak test: drive millions of events through a `Client` and check that nothing grows.
+
+    python -m benchmarks.soak --events 2000000
+
+sends events against a local stub server that fails intermittently (5xx,
+429 and bursts of outages), and samples the memory traced by `tracemalloc`,
+the RSS, the number of threads and the number of open file descriptors every
+`--interval` events, after a `flush()`. Once the `--warmup` samples are
+done, the later samples must stay within `--max-growth-mb` of traced memory
+and `--max-rss-growth-mb` of RSS, and must not add threads or descriptors. Exits with status 1 otherwise, listing the
+allocation sites that grew the most.
+"""
+import argparse
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from benchmarks.conftest import synthetic_traffic
+from usermaven.client import Client
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError):
+        return None
+
+
+def open_fds():
+    """Number of open file descriptors (sockets included), or None where /proc is not available."""
+    for path in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(path))
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def sample(events):
+    gc.collect()
+    return {
+        "events": events,
+        "traced": tracemalloc.get_traced_memory()[0],
+        "rss": rss_bytes(),
+        "threads": threading.active_count(),
+        "fds": open_fds(),
+    }
+
+
+def soak(events, interval=100000, warmup=2, frames=1, outage_every=5, debug=False, out=sys.stderr,
+         **client_options):
+    """Send `events` events, return a sample per interval and the tracemalloc snapshots `(baseline, last)`.
+
+    Only two snapshots are kept, holding more would grow the RSS being measured.
+    """
+    traffic = synthetic_traffic(min(interval, 10000))
+    samples = []
+    baseline = snapshot = None
+    tracemalloc.start(frames)
+    logger = logging.getLogger("usermaven")
+    level = logger.level
+    devnull = open(os.devnull, "w")
+    handler = logging.StreamHandler(devnull)
+    # the injected failures are expected; with --debug every message is still formatted, as a service logging
+    # at DEBUG would
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    with FakeIngestionServer(latency=0.001, error_rate=0.01, rate_limit_rate=0.005, record=False, seed=0) as server:
+        client = Client(API_KEY, SERVER_TOKEN, host=server.url, debug=debug, **client_options)
+        sent = 0
+        intervals = 0
+        while sent < events:
+            intervals += 1
+            if outage_every and intervals % outage_every == 0:
+                server.inject(503, count=20)
+            for n in range(min(interval, events - sent)):
+                call = traffic[n % len(traffic)]
+                while True:
+                    if call["type"] == "identify":
+                        success, _ = client.identify(call["user"], call["company"])
+                    else:
+                        success, _ = client.track(call["user_id"], call["event_type"], call["company"],
+                                                  call["event_attributes"])
+                    if success:
+                        break
+                    # the queue is full, let the consumers catch up
+                    time.sleep(0.001)
+            sent += min(interval, events - sent)
+            client.flush()
+            samples.append(sample(sent))
+            snapshot = tracemalloc.take_snapshot()
+            if len(samples) == warmup:
+                baseline = snapshot
+            out.write(format_sample(samples[-1]) + "\n")
+        client.shutdown()
+
+    logger.removeHandler(handler)
+    logger.propagate = True
+    logger.setLevel(level)
+    devnull.close()
+    tracemalloc.stop()
+    return samples, (baseline, snapshot)
+
+
+def format_sample(s):
+    rss = "-" if s["rss"] is None else "%.1f" % (s["rss"] / 1e6)
+    return "{0:>10} events  traced {1:7.2f} MB  rss {2:>7} MB  threads {3:>3}  fds {4}".format(
+        s["events"], s["traced"] / 1e6, rss, s["threads"], s["fds"]
+    )
+
+
+def check(samples, warmup=2, max_growth_mb=2.0, max_rss_growth_mb=16.0, fd_slack=2):
+    """Return a list of problems found in the samples taken after `warmup`."""
+    if len(samples) <= warmup:
+        return ["not enough samples after a warmup of %d" % warmup]
+    baseline, later = samples[warmup - 1], samples[warmup:]
+    problems = []
+    growth = max(s["traced"] for s in later) - baseline["traced"]
+    if growth > max_growth_mb * 1e6:
+        problems.append("traced memory grew by %.2f MB" % (growth / 1e6))
+    # the allocator keeps freed memory around, so the RSS only gets a looser bound
+    if baseline["rss"] is not None:
+        rss_growth = max(s["rss"] for s in later) - baseline["rss"]
+        if rss_growth > max_rss_growth_mb * 1e6:
+            problems.append("RSS grew by %.1f MB" % (rss_growth / 1e6))
+    if max(s["threads"] for s in later) > baseline["threads"]:
+        problems.append("thread count grew from %d to %d" % (baseline["threads"], max(s["threads"] for s in later)))
+    if baseline["fds"] is not None and max(s["fds"] for s in later) > baseline["fds"] + fd_slack:
+        problems.append("open file descriptors grew from %d to %d" % (baseline["fds"], max(s["fds"] for s in later)))
+    return problems
+
+
+def growth_report(snapshots, limit=10):
+    """Return the allocation sites that grew the most between the `(baseline, last)` snapshots."""
+    baseline, last = snapshots
+    if baseline is None or baseline is last:
+        return []
+    stats = last.compare_to(baseline, "traceback")
+    return [stat for stat in stats[:limit] if stat.size_diff > 0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=2000000)
+    parser.add_argument("--interval", type=int, default=100000, help="events between samples")
+    parser.add_argument("--warmup", type=int, default=2, help="samples taken before the baseline")
+    parser.add_argument("--max-growth-mb", type=float, default=2.0)
+    parser.add_argument("--max-rss-growth-mb", type=float, default=16.0)
+    parser.add_argument("--frames", type=int, default=1,
+                        help="stack frames kept per allocation, more makes the report clearer and the soak slower")
+    parser.add_argument("--thread", type=int, default=2, help="consumer threads")
+    parser.add_argument("--debug", action="store_true", help="format every log message")
+    args = parser.parse_args(argv)
+
+    samples, snapshots = soak(args.events, args.interval, args.warmup, args.frames, debug=args.debug,
+                              thread=args.thread)
+    problems = check(samples, args.warmup, args.max_growth_mb, args.max_rss_growth_mb)
+    for problem in problems:
+        print("FAIL: " + problem)
+        for stat in growth_report(snapshots):
+            print(stat)
+            for line in stat.traceback.format()[-4:]:
+                print("    " + line)
+    if not problems:
+        print("OK: %d events, no growth after warmup" % samples[-1]["events"])
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,6 +13,7 @@ on_error = None  # type: Callable
 debug = False  # type: bool
 send = True  # type: bool
 sync_mode = False  # type: bool
+serverless = False  # type: bool
 disabled = False  # type: bool
 
 default_client = None
@@ -85,27 +86,62 @@ def identify(
     )
 
 
-def flush():
-    """Tell the client to flush."""
-    _proxy("flush")
+def increment(
+    user_id,     # type: str
+    event_type,  # type: str
+    by=1,        # type: int
+    company={},  # type: Optional[Dict]
+    dims={},     # type: Optional[Dict]
+):
+    # type: (...) -> None
+    """
+    Increment counts an event you only need totals for, such as `api_call`, without sending one event per
+    occurrence. Counts are aggregated in-process and sent as one `track` event per user, company, event type and
+    `dims` combination every `rollup_interval` seconds, with the total in the `count` event attribute.
+
+    For example:
+    ```python
+    usermaven.increment('user_id', 'api_call')
+    usermaven.increment('user_id', 'api_call', by=5, dims={'endpoint': '/v1/search'})
+    ```
+    """
+    _proxy(
+        "increment",
+        user_id=user_id,
+        event_type=event_type,
+        by=by,
+        company=company,
+        dims=dims
+    )
+
 
+def flush(timeout=None):
+    """Tell the client to flush, waiting at most `timeout` seconds if given."""
+    return _proxy("flush", timeout=timeout)
 
-def join():
-    """Block program until the client clears the queue"""
-    _proxy("join")
 
+def join(timeout=None):
+    """Block program until the client clears the queue, or for at most `timeout` seconds"""
+    _proxy("join", timeout=timeout)
 
-def shutdown():
-    """Flush all messages and cleanly shutdown the client"""
-    _proxy("flush")
-    _proxy("join")
+
+def shutdown(timeout=None):
+    """Flush all messages and cleanly shutdown the client, within `timeout` seconds if given"""
+    _proxy("shutdown", timeout=timeout)
 
 
 def _proxy(method, *args, **kwargs):
     """Create an analytics client if one doesn't exist and send to it."""
-    global default_client
     if disabled:
         return None
+
+    fn = getattr(_client(), method)
+    return fn(*args, **kwargs)
+
+
+def _client():
+    """Return the default client, creating it from the settings above on first use."""
+    global default_client
     if not default_client:
         default_client = Client(
             api_key,
@@ -115,7 +151,6 @@ def _proxy(method, *args, **kwargs):
             on_error=on_error,
             send=send,
             sync_mode=sync_mode,
+            serverless=serverless,
         )
-
-    fn = getattr(default_client, method)
-    return fn(*args, **kwargs)
+    return default_client
@@ -0,0 +1,144 @@
+import json
+import logging
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from usermaven.circuit import CircuitOpen
+from usermaven.ratelimit import RateLimited
+from usermaven.request import DatetimeSerializer, batch_post, cap_timeout, fatal_exception
+from usermaven.settings import BATCH_SIZE_LIMIT, MAX_MSG_SIZE
+from usermaven.tracing import NOOP_TRACER
+
+log = logging.getLogger("usermaven")
+
+# Number of events delivered by a flush, and the number still waiting to be sent.
+FlushResult = namedtuple("FlushResult", ["delivered", "remaining"])
+
+
+class DeadlineExceeded(Exception):
+    """Raised for (or attached to) batches that could not be delivered before a deadline."""
+
+    def __str__(self):
+        return "[Usermaven] deadline exceeded before the batch was delivered"
+
+
+def split_batches(items, flush_at=None, size_limit=BATCH_SIZE_LIMIT):
+    """Split `items` into as few batches as possible, keeping their order.
+
+    Each batch holds at most `flush_at` items (unlimited when None) and stays
+    under `size_limit` bytes of JSON. Items over `MAX_MSG_SIZE` are dropped,
+    like `Consumer.next` does. Return `(batches, dropped)`.
+    """
+    batches = []
+    dropped = []
+    batch = []
+    batch_size = 0
+    for item in items:
+        if isinstance(item, bytes):
+            item_size = len(item)
+        else:
+            item_size = len(json.dumps(item, cls=DatetimeSerializer).encode())
+        if item_size > MAX_MSG_SIZE:
+            log.error("Item exceeds 32kb limit, dropping. (%s)", item)
+            dropped.append(item)
+            continue
+        if batch and (batch_size + item_size >= size_limit or (flush_at and len(batch) >= flush_at)):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(item)
+        batch_size += item_size
+    if batch:
+        batches.append(batch)
+    return batches, dropped
+
+
+def remaining_time(deadline):
+    """Seconds left until the `time.monotonic()` `deadline`, or None if there is none."""
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def post_batches(
+    api_key,
+    server_token,
+    batches,
+    host=None,
+    timeout=15,
+    deadline=None,
+    retries=0,
+    max_workers=4,
+    tracer=NOOP_TRACER,
+    circuit=None,
+    limiter=None,
+    compact=False,
+):
+    """Post `batches` concurrently and retry the ones that failed with a retryable error.
+
+    Nothing is sent after the `time.monotonic()` `deadline`, and each request's
+    timeout is capped by the time left. Return `(delivered, failed)` where
+    `failed` is a list of `(batch, exception)` in the original batch order;
+    batches that ran out of time carry a `DeadlineExceeded`. Batches refused by
+    an open `circuit` breaker, or that the rate `limiter` could not let through
+    before the deadline, are not retried. With `compact`, batches are sent in
+    the `usermaven.compact` encoding.
+    """
+
+    def post(batch, request_timeout):
+        with tracer.span("request", size=len(batch)):
+            batch_post(api_key, server_token, host, timeout=request_timeout, circuit=circuit, limiter=limiter,
+                       deadline=deadline, compact=compact, batch=batch)
+
+    delivered = []
+    failed = {}
+    pending = list(enumerate(batches))
+    if not pending:
+        return delivered, []
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending))))
+    try:
+        attempt = 0
+        while pending:
+            remaining = remaining_time(deadline)
+            if remaining is not None and remaining <= 0:
+                break
+            request_timeout = cap_timeout(timeout, remaining)
+            futures = {executor.submit(post, batch, request_timeout): (i, batch) for i, batch in pending}
+            done, not_done = wait(futures, timeout=remaining)
+
+            pending = []
+            for future in done:
+                i, batch = futures[future]
+                exc = future.exception()
+                if exc is None:
+                    delivered.append(batch)
+                    failed.pop(i, None)
+                    continue
+                exc.attempts = attempt + 1
+                failed[i] = (batch, exc)
+                if not fatal_exception(exc) and not isinstance(exc, (CircuitOpen, RateLimited)) and attempt < retries:
+                    pending.append((i, batch))
+            for future in not_done:
+                # still in flight at the deadline, its outcome is unknown
+                future.cancel()
+                failed[futures[future][0]] = (futures[future][1], DeadlineExceeded())
+
+            attempt += 1
+            if pending:
+                pending.sort(key=lambda pair: pair[0])
+                delay = random.uniform(0, 2 ** (attempt - 1))
+                remaining = remaining_time(deadline)
+                if remaining is not None:
+                    delay = min(delay, max(remaining, 0))
+                tracer.record("retry", delay, tries=attempt)
+                time.sleep(delay)
+    finally:
+        executor.shutdown(wait=False)
+
+    for i, batch in pending:
+        # keep the last error of batches that were attempted before time ran out
+        failed.setdefault(i, (batch, DeadlineExceeded()))
+    return delivered, [failed[i] for i in sorted(failed)]
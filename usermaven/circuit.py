@@ -0,0 +1,115 @@
+import logging
+import time
+from threading import Lock
+
+from usermaven.ratelimit import RateLimited
+from usermaven.request import APIError, fatal_exception
+
+log = logging.getLogger("usermaven")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Raised instead of sending a request while the circuit breaker is open."""
+
+    def __str__(self):
+        return "[Usermaven] circuit breaker is open, the ingestion endpoint is unavailable"
+
+
+def throttled(exc):
+    """Return whether a request failed with `exc` because of a rate limit, rather than reaching a failing endpoint"""
+    return isinstance(exc, RateLimited) or (isinstance(exc, APIError) and exc.status == 429)
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to the ingestion endpoint while it is failing.
+
+    After `failure_threshold` consecutive failed requests the circuit opens and
+    every request fails fast with `CircuitOpen`. Once `reset_timeout` seconds
+    have passed a single probe request is let through (half-open): the circuit
+    closes if it succeeds and opens again if it fails. Network and retryable
+    server errors count as failures; other client errors mean the endpoint is
+    up, so they do not. A request throttled with a 429, or that the rate
+    limiter refused to send, says nothing about the endpoint's health, and
+    counts as neither.
+
+    `on_state_change(old, new)` is called on every transition. `clock` returns
+    the current time in seconds and defaults to `time.monotonic`.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, on_state_change=None, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_state_change = on_state_change
+        self.clock = clock
+        self.lock = Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def call(self, fn, *args, **kwargs):
+        """Call `fn` unless the circuit is open, recording whether it failed."""
+        probe = self.allow()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if throttled(e):
+                self.release(probe)
+            elif fatal_exception(e):
+                self.record_success(probe)
+            else:
+                self.record_failure(probe)
+            raise
+        self.record_success(probe)
+        return result
+
+    def allow(self):
+        """Raise `CircuitOpen` if a request may not be sent now, return whether it is the half-open probe."""
+        with self.lock:
+            if self.state == CLOSED:
+                return False
+            if self.state == OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+        raise CircuitOpen()
+
+    def release(self, probe=False):
+        """Let another request probe the endpoint, if this one was the probe but was not sent."""
+        if probe:
+            with self.lock:
+                self.probing = False
+
+    def record_success(self, probe=False):
+        with self.lock:
+            if probe:
+                self.probing = False
+            self.failures = 0
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self, probe=False):
+        with self.lock:
+            if probe:
+                self.probing = False
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = self.clock()
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        old, self.state = self.state, state
+        if state == OPEN:
+            log.warning("circuit breaker opened after %s failures", self.failures)
+        else:
+            log.info("circuit breaker %s", state)
+        if self.on_state_change:
+            try:
+                self.on_state_change(old, state)
+            except Exception as e:
+                log.error("on_state_change failed: %s", e)
@@ -0,0 +1,150 @@
+"""The `usermaven` command line tool.
+
+    usermaven replay --api-key KEY --server-token TOKEN DIRECTORY_OR_FILE...
+
+streams the batches saved by `DeadLetterSink` (or `FileSink`) back to the
+ingestion API, a few concurrent uploads at a time. With `--checkpoint FILE`
+the position of the last delivered record is saved after every round of
+uploads, and a replay that is interrupted picks up from there. Batches that
+fail again go to `--dead-letter DIRECTORY`; without it, the checkpoint stays
+before the first round with a failed batch, so that resuming retries it.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from usermaven.batching import post_batches, split_batches
+from usermaven.ratelimit import RateLimiter
+from usermaven.sinks import DeadLetterSink, hand_to_sink, read_undelivered
+
+
+def replay_files(paths):
+    """Return the undelivered files under `paths`, oldest first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith((".jsonl", ".jsonl.gz"))
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, position, delivered):
+    # written to a temporary file first, so an interrupted write keeps the previous checkpoint
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"path": position[0], "line": position[1], "delivered": delivered}, f)
+    os.replace(tmp, path)
+
+
+def records(files, checkpoint=None):
+    """Yield `((path, line_number), record)` for every record after the `checkpoint`."""
+    skipping = checkpoint is not None and checkpoint["path"] in files
+    for path in files:
+        if skipping and path != checkpoint["path"]:
+            continue
+        for line_number, record in read_undelivered(path):
+            if skipping and line_number <= checkpoint["line"]:
+                continue
+            yield (path, line_number), record
+        skipping = False
+
+
+def replay(args, out=sys.stderr):
+    """Replay the undelivered batches, return the number of events that still could not be delivered."""
+    checkpoint = load_checkpoint(args.checkpoint)
+    dead_letter = DeadLetterSink(args.dead_letter) if args.dead_letter else None
+    limiter = None
+    if args.events_per_second or args.bytes_per_second:
+        limiter = RateLimiter(args.events_per_second, args.bytes_per_second)
+    delivered = checkpoint["delivered"] if checkpoint else 0
+    failed_events = 0
+    # set once a batch failed with nowhere to go, keeping the checkpoint before it
+    checkpoint_held = False
+
+    def upload(events, position):
+        nonlocal delivered, failed_events, checkpoint_held
+        started = time.monotonic()
+        batches, dropped = split_batches(events, args.batch_size)
+        sent, failed = post_batches(
+            args.api_key,
+            args.server_token,
+            batches,
+            host=args.host,
+            timeout=args.timeout,
+            retries=args.retries,
+            max_workers=args.concurrency,
+            limiter=limiter,
+        )
+        delivered += sum(len(batch) for batch in sent)
+        failed_events += len(dropped)
+        for batch, e in failed:
+            failed_events += len(batch)
+            out.write("failed to replay {0} events: {1}\n".format(len(batch), e))
+            if dead_letter:
+                hand_to_sink(dead_letter, batch, e)
+        if failed and not dead_letter:
+            checkpoint_held = True
+        if args.checkpoint and not checkpoint_held:
+            save_checkpoint(args.checkpoint, position, delivered)
+        out.write("replayed {0} events, {1} failed, up to {2}:{3}\n".format(delivered, failed_events, *position))
+        if args.rate:
+            # stay under --rate requests per second
+            time.sleep(max(len(batches) / args.rate - (time.monotonic() - started), 0))
+
+    events = []
+    position = None
+    # one round of uploads holds `concurrency` full batches
+    round_size = args.batch_size * args.concurrency
+    for position, record in records(replay_files(args.paths), checkpoint):
+        events.extend(record["batch"])
+        if len(events) >= round_size:
+            upload(events, position)
+            events = []
+    if events:
+        upload(events, position)
+    return failed_events
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="usermaven")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    replay_parser = commands.add_parser("replay", help="send the batches saved by an undelivered sink again")
+    replay_parser.add_argument("paths", nargs="+", help="dead-letter directories or files, replayed in name order")
+    replay_parser.add_argument("--api-key", default=os.environ.get("USERMAVEN_API_KEY"))
+    replay_parser.add_argument("--server-token", default=os.environ.get("USERMAVEN_SERVER_TOKEN"))
+    replay_parser.add_argument("--host", default=None)
+    replay_parser.add_argument("--batch-size", type=int, default=100, help="events per request")
+    replay_parser.add_argument("--concurrency", type=int, default=4, help="concurrent requests")
+    replay_parser.add_argument("--rate", type=float, default=None, help="maximum requests per second")
+    replay_parser.add_argument("--events-per-second", type=float, default=None,
+                               help="workspace quota to stay under, slowing down further on 429 responses")
+    replay_parser.add_argument("--bytes-per-second", type=float, default=None)
+    replay_parser.add_argument("--retries", type=int, default=3)
+    replay_parser.add_argument("--timeout", type=float, default=15)
+    replay_parser.add_argument("--checkpoint", default=None, help="file recording progress, to resume from")
+    replay_parser.add_argument("--dead-letter", default=None, help="directory for batches that fail again")
+
+    args = parser.parse_args(argv)
+    if not args.api_key or not args.server_token:
+        parser.error("--api-key and --server-token (or USERMAVEN_API_KEY and USERMAVEN_SERVER_TOKEN) are required")
+    failed = replay(args)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
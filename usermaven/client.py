@@ -1,14 +1,25 @@
 import atexit
 import logging
+import numbers
 import random
 import string
-
-from six import string_types
-
-from usermaven.consumer import Consumer
-from usermaven.request import batch_post
-from usermaven.utils import clean
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from threading import Lock, local
+
+from usermaven.batching import DeadlineExceeded, FlushResult, post_batches, split_batches
+from usermaven.consumer import Consumer, DeferredMessage, resolve_deferred
+from usermaven.hedging import Hedge
+from usermaven.queues import ByteQueue, ShardedQueue, drain_queue, join_queue, put_many
+from usermaven.request import batch_post, decode_batch, encode_event, fatal_exception
+from usermaven.rollup import Rollup
+from usermaven.utils import clean, context_var
+from usermaven.validation import USER, CompanyCache
 from usermaven.settings import ID_TYPES
+from usermaven.sinks import hand_to_sink, make_sink
+from usermaven.tracing import NOOP_TRACER, Profiler
 
 try:
     import queue
@@ -36,9 +47,40 @@ class Client(object):
         sync_mode=False,
         timeout=15,
         thread=1,
+        rollup_interval=60,
+        rollup_max_keys=10000,
+        serverless=False,
+        upload_threads=4,
+        undelivered_sink=None,
+        shutdown_timeout=None,
+        company_cache_size=1024,
+        max_split_depth=7,
+        defer_processing=False,
+        tracer=None,
+        profile=False,
+        max_queue_bytes=None,
+        circuit_breaker=None,
+        rate_limiter=None,
+        connect_timeout=None,
+        batch_deadline=None,
+        hedge_after=None,
+        shard_by_user=False,
+        compact_batches=False,
     ):
 
-        self.queue = queue.Queue(max_queue_size)
+        # max_queue_bytes: bound the queue by the total size of the events, which are
+        # then queued as encoded JSON rather than as dicts
+        self.max_queue_bytes = max_queue_bytes
+        # shard_by_user: give each consumer its own queue and route every event by its
+        # user id, so that the events of one user are sent in order
+        self.shard_by_user = shard_by_user and not (sync_mode or serverless)
+        if self.shard_by_user:
+            shards = max(thread, 1)
+            self._shard_size = -(-max_queue_size // shards) if max_queue_size else 0
+            self._shard_bytes = -(-max_queue_bytes // shards) if max_queue_bytes else None
+            self.queue = ShardedQueue(self._make_queue(self._shard_size, self._shard_bytes) for _ in range(shards))
+        else:
+            self.queue = self._make_queue(max_queue_size, max_queue_bytes)
 
         # api_key: This is the project_id/workspace_id which is required for authentication
         self.api_key = stringify_id(api_key)
@@ -46,8 +88,8 @@ class Client(object):
         # server_token: This should be the server secret token used for authentication when sending the events.
         self.server_token = stringify_id(server_token)
 
-        require("api_key", self.api_key, string_types)
-        require("server_token", self.server_token, string_types)
+        require("api_key", self.api_key, str)
+        require("server_token", self.server_token, str)
 
         self.on_error = on_error
         self.debug = debug
@@ -55,7 +97,40 @@ class Client(object):
         self.sync_mode = sync_mode
         self.host = host
         self.timeout = timeout
+        # connect_timeout: seconds to wait for a connection, `timeout` then bounds each read
+        self.connect_timeout = connect_timeout
+        self._request_timeout = timeout if connect_timeout is None else (connect_timeout, timeout)
+        # hedge_after: a latency percentile (e.g. 0.95) past which a slow request is sent
+        # a second time. Events then get an event_id, so that the duplicate can be dropped.
+        self.hedge = Hedge(hedge_after) if hedge_after else None
+        self.max_retries = max_retries
+        self.max_queue_size = max_queue_size
+        self.serverless = serverless
+        self.upload_threads = upload_threads
+        # undelivered_sink: a `sink(batch, error)` callable or a file path that receives
+        # events which could not be delivered, instead of dropping them. Events then get an
+        # event_id, as a batch still in flight at a shutdown deadline may arrive as well.
+        self.undelivered_sink = make_sink(undelivered_sink)
+        self.shutdown_timeout = shutdown_timeout
+        # circuit_breaker: a usermaven.circuit.CircuitBreaker shared by all uploads; while
+        # it is open, batches go straight to undelivered_sink (or stay buffered when serverless)
+        self.circuit_breaker = circuit_breaker
+        # rate_limiter: a usermaven.ratelimit.RateLimiter pacing all uploads under the
+        # workspace's ingestion quota, slowing down when the API answers with a 429
+        self.rate_limiter = rate_limiter
+        # compact_batches: send the fields shared by a batch's events, and each company,
+        # once per request (see usermaven.compact). Only for endpoints that expand them.
+        self.compact_batches = compact_batches
         self.group_type_mapping = None
+        # serverless: events wait here until flush(), as there are no consumer threads
+        self.buffer = []
+        self._buffer_lock = Lock()
+        self.company_cache = CompanyCache(company_cache_size)
+        self.rollup = Rollup(self.track, interval=rollup_interval, max_keys=rollup_max_keys)
+        # tracer: a usermaven.tracing.Tracer timing each pipeline stage. profile=True
+        # uses a Profiler instead and prints its per-stage breakdown on join().
+        self.profile = profile
+        self.tracer = Profiler() if profile else (tracer or NOOP_TRACER)
 
         if debug:
             # Ensures that debug level messages are logged when debug mode is on.
@@ -65,7 +140,7 @@ class Client(object):
         else:
             self.log.setLevel(logging.WARNING)
 
-        if sync_mode:
+        if sync_mode or serverless:
             self.consumers = None
         else:
             # On program exit, allow the consumer thread to exit cleanly.
@@ -73,88 +148,88 @@ class Client(object):
             # interpreter is destroyed before the daemon thread finishes
             # execution. However, it is *not* the same as flushing the queue!
             # To guarantee all messages have been delivered, you'll still need
-            # to call flush().
-            if send:
-                atexit.register(self.join)
+            # to call flush(). Consumers are started on the first enqueue, so
+            # constructing a client that never sends anything costs no threads.
+            self._consumer_options = dict(
+                host=host,
+                on_error=on_error,
+                flush_at=flush_at,
+                flush_interval=flush_interval,
+                retries=max_retries,
+                timeout=self._request_timeout,
+                undelivered_sink=self.undelivered_sink,
+                max_split_depth=max_split_depth,
+                tracer=self.tracer,
+                circuit=circuit_breaker,
+                limiter=rate_limiter,
+                compact=compact_batches,
+                batch_deadline=batch_deadline,
+                hedge=self.hedge,
+            )
+            self.consumers = []
             for n in range(thread):
-                self.consumers = []
-                consumer = Consumer(
-                    self.queue,
-                    self.api_key,
-                    self.server_token,
-                    host=host,
-                    on_error=on_error,
-                    flush_at=flush_at,
-                    flush_interval=flush_interval,
-                    retries=max_retries,
-                    timeout=timeout,
-                )
-                self.consumers.append(consumer)
-
-                # if we've disabled sending, just don't start the consumer
-                if send:
-                    consumer.start()
+                consumer_queue = self.queue.shards[n] if self.shard_by_user else self.queue
+                self.consumers.append(self._make_consumer(consumer_queue))
+
+        self._consumers_started = False
+        self._consumers_lock = Lock()
+        self._profile_reported = False
+        # events collected by `with client.batch():` on each thread
+        self._batch_scope = local()
+        # the RequestBuffer holding the events of the current request, see buffered()
+        self._request_buffer = context_var("usermaven_request_buffer")
+        # defer_processing: validation and cleaning run on the consumer threads,
+        # which only exist when events are queued
+        self._deferred = defer_processing and send and not (sync_mode or serverless)
+
+    def _make_queue(self, maxsize, max_bytes):
+        if max_bytes:
+            return ByteQueue(max_bytes, maxsize)
+        return queue.Queue(maxsize)
+
+    def _make_consumer(self, consumer_queue):
+        return Consumer(consumer_queue, self.api_key, self.server_token, **self._consumer_options)
 
     def identify(self, user, company={}):
-        require("user", user, dict)
-        if "id" in user and "email" in user and "created_at" in user:
-            # user object has required attributes
-            require("user_id", user["id"], ID_TYPES)
-            require("user_email", user["email"], string_types)
-            require("user_created_at", user["created_at"], string_types)
-        else:
-            # user object is missing one or more of the required attributes
-            raise ValueError("user object is missing one or more of the required attributes")
+        if self._deferred and not self._collecting():
+            user_id = user.get("id") if isinstance(user, dict) else None
+            return self._enqueue_deferred(self._identify_msg, (snapshot(user), snapshot(company)), user_id)
+        return self._enqueue(self._identify_msg(user, company))
+
+    def _identify_msg(self, user, company):
+        user = USER(user)
+        user["anonymous_id"] = generate_id()
 
         msg = {
             "api_key": self.api_key,
-            "event_id": "",
+            "event_id": self._event_id(),
             "event_type": "user_identify",
             "ids": {},
-            "user": {
-                "anonymous_id": generate_id(),
-                "id": user["id"],
-                "email": user["email"],
-                "created_at": user["created_at"],
-            },
+            "user": user,
             "screen_resolution": "0",
             "src": "usermaven-python"
         }
 
-        if "custom" in user:
-            require("user_custom", user["custom"], dict)
-            msg["user"]["custom"] = user["custom"]
-
         if company:
-            require("company", company, dict)
-            if "id" in company and "name" in company and "created_at" in company:
-                # company object has required attributes
-                require("company_id", company["id"], ID_TYPES)
-                require("company_name", company["name"], string_types)
-                require("company_created_at", company["created_at"], string_types)
-            else:
-                # company object is missing one or more of the required attributes
-                raise ValueError("company object is missing one or more of the required attributes")
+            msg["company"] = self.company_cache.get(company)
 
-            msg["company"] = {
-                "id": company["id"],
-                "name": company["name"],
-                "created_at": company["created_at"]
-            }
-            if "custom" in company:
-                require("company_custom", company["custom"], dict)
-                msg["company"]["custom"] = company["custom"]
-
-        return self._enqueue(msg)
+        return msg
 
     def track(self, user_id, event_type, company={}, event_attributes={}):
+        if self._deferred and not self._collecting():
+            return self._enqueue_deferred(
+                self._track_msg, (user_id, event_type, snapshot(company), snapshot(event_attributes)), user_id
+            )
+        return self._enqueue(self._track_msg(user_id, event_type, company, event_attributes))
+
+    def _track_msg(self, user_id, event_type, company, event_attributes):
         require("user_id", user_id, ID_TYPES)
-        require("event_type", event_type, string_types)
+        require("event_type", event_type, str)
 
         msg = {
             "api_key": self.api_key,
             "event_type": event_type,
-            "event_id": "",
+            "event_id": self._event_id(),
             "ids": {},
             "user": {
                 "anonymous_id": generate_id(),
@@ -166,75 +241,513 @@ class Client(object):
         }
 
         if company:
-            require("company", company, dict)
-            if "id" in company and "name" in company and "created_at" in company:
-                # company object has required attributes
-                require("company_id", company["id"], ID_TYPES)
-                require("company_name", company["name"], string_types)
-                require("company_created_at", company["created_at"], string_types)
-            else:
-                # company object is missing one or more of the required attributes
-                raise ValueError("company object is missing one or more of the required attributes")
+            msg["company"] = self.company_cache.get(company)
+
+        return msg
 
-            msg["company"] = {
-                "id": company["id"],
-                "name": company["name"],
-                "created_at": company["created_at"]
-            }
-            if "custom" in company:
-                require("company_custom", company["custom"], dict)
-                msg["company"]["custom"] = company["custom"]
+    def _event_id(self):
+        # hedged requests, and replayed batches that were delivered after all, rely on the event id
+        # to drop duplicates
+        return uuid.uuid4().hex if self.hedge or self.undelivered_sink else ""
 
-        return self._enqueue(msg)
+    def increment(self, user_id, event_type, by=1, company={}, dims={}):
+        """Count `by` occurrences of `event_type` without sending an event per occurrence.
+
+        Counts are aggregated in-process per (user, company, event_type, dims) and
+        sent as a single `track` event every `rollup_interval` seconds, with the
+        total in the `count` event attribute alongside the `dims`.
+        """
+        require("user_id", user_id, ID_TYPES)
+        require("event_type", event_type, str)
+        require("by", by, numbers.Number)
+        require("dims", dims, dict)
+        if company:
+            company = self.company_cache.get(company)
+
+        self.rollup.add(user_id, event_type, by=by, company=company, dims=dims)
+
+    def _clean(self, msg):
+        """Return a cleaned copy of `msg`"""
+        # the company block comes validated and cleaned from the company cache
+        cleaned = clean({key: value for key, value in msg.items() if key != "company"})
+        if "company" in msg:
+            cleaned["company"] = msg["company"]
+        return cleaned
+
+    def _prepare(self, build, *args):
+        """Build, validate and clean a message, on the consumer thread in deferred mode"""
+        return self._clean(build(*args))
+
+    def _enqueue_deferred(self, build, args, user_id):
+        """Push a message that the consumer will build and clean, return `(success, None)`"""
+        if not self._consumers_started:
+            self._start_consumers()
+
+        item = DeferredMessage(self._prepare, (build,) + args)
+        buffer = self._request_buffer.get()
+        if buffer is not None and buffer.hold(item, user_id):
+            return True, None
+
+        try:
+            with self.tracer.span("enqueue"):
+                self._put(item, user_id)
+            return True, None
+        except queue.Full:
+            self.log.warning("analytics-python queue is full")
+            return False, None
 
     def _enqueue(self, msg):
         """Push a new `msg` onto the queue, return `(success, msg)`"""
 
-        msg = clean(msg)
+        with self.tracer.span("clean"):
+            msg = self._clean(msg)
         self.log.debug("queueing: %s", msg)
 
         # if send is False, return msg as if it was successfully queued
         if not self.send:
             return True, msg
 
+        collected = getattr(self._batch_scope, "events", None)
+        if collected is not None:
+            collected.append(msg)
+            return True, msg
+
+        buffer = self._request_buffer.get()
+        if buffer is not None and buffer.hold(msg, msg["user"].get("id")):
+            return True, msg
+
         if self.sync_mode:
             self.log.debug("enqueued with blocking %s.", msg["event_type"])
-            batch_post(self.api_key, self.server_token, self.host, timeout=self.timeout, batch=[msg])
+            with self.tracer.span("request", size=1):
+                batch_post(
+                    self.api_key,
+                    self.server_token,
+                    self.host,
+                    timeout=self._request_timeout,
+                    circuit=self.circuit_breaker,
+                    limiter=self.rate_limiter,
+                    compact=self.compact_batches,
+                    batch=[msg],
+                )
 
             return True, msg
 
+        if self.serverless:
+            with self.tracer.span("enqueue"), self._buffer_lock:
+                if self.max_queue_size and len(self.buffer) >= self.max_queue_size:
+                    self.log.warning("usermaven buffer is full")
+                    return False, msg
+                self.buffer.append(msg)
+            self.log.debug("buffered %s.", msg["event_type"])
+            return True, msg
+
+        if not self._consumers_started:
+            self._start_consumers()
+
+        item = msg
+        if self.max_queue_bytes:
+            with self.tracer.span("serialize"):
+                item = encode_event(msg)
+
         try:
-            self.queue.put(msg, block=False)
+            with self.tracer.span("enqueue"):
+                self._put(item, msg["user"].get("id"))
             self.log.debug("enqueued %s.", msg["event_type"])
             return True, msg
         except queue.Full:
             self.log.warning("analytics-python queue is full")
             return False, msg
 
-    def flush(self):
-        """Forces a flush from the internal queue to the server"""
+    def _put(self, item, user_id):
+        if self.shard_by_user:
+            self.queue.put(item, key=user_id)
+        else:
+            self.queue.put(item, block=False)
+
+    def _put_many(self, items, keys):
+        if self.shard_by_user:
+            return self.queue.put_many(items, keys)
+        return put_many(self.queue, items)
+
+    @contextmanager
+    def buffered(self):
+        """Hold the events tracked in this context, such as a web request, and enqueue them together on exit
+
+        The events are put on the queue at once when the block exits, even if
+        it raises, rather than taking the queue's lock for every call. An
+        identify repeating an earlier one of the same user in the block is
+        dropped. The block is local to the thread, or to the asyncio task on
+        Python 3.7+. Nested blocks are part of the outermost one.
+        See `usermaven.middleware` for the web framework integrations.
+        """
+        buffer = self._request_buffer.get()
+        if buffer is not None and not buffer.ended:
+            yield
+            return
+
+        buffer = self.begin_buffer()
+        try:
+            yield
+        finally:
+            buffer.end()
+
+    def begin_buffer(self):
+        """Start holding the events tracked in this context, return the `RequestBuffer` that enqueues them on `end()`
+
+        Like `buffered()`, for a request whose handling does not fit in a
+        `with` block.
+        """
+        buffer = RequestBuffer(self)
+        buffer.activate()
+        return buffer
+
+    def _enqueue_buffered(self, entries, start_consumers=True):
+        """Enqueue the `(item, user id)` entries held by `buffered()`, return how many were queued"""
+        entries = self._collapse_identifies(entries)
+        if not entries:
+            return 0
+        items = [item for item, _ in entries]
+
+        if self.sync_mode:
+            # raising here would fail the request after its response was built
+            self._post_collected(items, raise_errors=False)
+            return len(items)
+
+        if self.serverless:
+            with self.tracer.span("enqueue", size=len(items)), self._buffer_lock:
+                room = len(items)
+                if self.max_queue_size:
+                    room = max(self.max_queue_size - len(self.buffer), 0)
+                self.buffer.extend(items[:room])
+            count = min(room, len(items))
+        else:
+            if start_consumers and not self._consumers_started:
+                self._start_consumers()
+            if self.max_queue_bytes:
+                with self.tracer.span("serialize"):
+                    items = [item if isinstance(item, DeferredMessage) else encode_event(item) for item in items]
+            with self.tracer.span("enqueue", size=len(items)):
+                count = self._put_many(items, [key for _, key in entries])
+
+        if count < len(items):
+            self.log.warning("analytics-python queue is full, dropped %s buffered events", len(items) - count)
+        self.log.debug("enqueued %s buffered events.", count)
+        return count
+
+    def _collapse_identifies(self, entries):
+        """Drop the identifies that repeat an earlier identify of the same user in `entries`"""
+        seen = {}
+        kept = []
+        for item, user_id in entries:
+            identity = self._identity(item)
+            if identity is not None:
+                earlier = seen.setdefault(user_id, [])
+                if identity in earlier:
+                    continue
+                earlier.append(identity)
+            kept.append((item, user_id))
+        return kept
+
+    def _identity(self, item):
+        """Return what an identify sets, ignoring its generated anonymous id, or None for other events"""
+        if isinstance(item, DeferredMessage):
+            if item.args[0] != self._identify_msg:
+                return None
+            return item.args[1:]
+        if item["event_type"] != "user_identify":
+            return None
+        user = {key: value for key, value in item["user"].items() if key != "anonymous_id"}
+        return user, item.get("company")
+
+    def add_consumer(self, timeout=None):
+        """Add a consumer thread, return whether it was added
+
+        With `shard_by_user`, the consumer gets a new shard of the queue. As
+        that moves users between shards, new events are held back until the
+        events already queued have been sent, or for at most `timeout` seconds
+        (in which case no consumer is added).
+        """
+        if self.consumers is None:
+            return False
+        if self.shard_by_user:
+            shard = self._make_queue(self._shard_size, self._shard_bytes)
+            if not self.queue.add_shard(shard, timeout):
+                self.log.warning("queue was not drained in time, not adding a consumer.")
+                return False
+            consumer = self._make_consumer(shard)
+        else:
+            consumer = self._make_consumer(self.queue)
+
+        with self._consumers_lock:
+            self.consumers.append(consumer)
+            if self._consumers_started and consumer.running:
+                consumer.start()
+        return True
+
+    @contextmanager
+    def batch(self):
+        """Collect the events tracked on this thread within the block, and post them on exit
+
+        The events are sent synchronously in as few requests as the batch size
+        limit allows. Every request is attempted, then the first upload error
+        is raised like in `sync_mode`.
+        If the block raises, the events collected so far are still sent, and
+        upload errors are logged rather than hiding the block's exception.
+        Nested blocks are part of the outermost one.
+        """
+        scope = self._batch_scope
+        if getattr(scope, "events", None) is not None:
+            yield scope.events
+            return
+
+        scope.events = events = []
+        try:
+            yield events
+        except BaseException:
+            scope.events = None
+            self._post_collected(events, raise_errors=False)
+            raise
+        scope.events = None
+        self._post_collected(events)
+
+    def _collecting(self):
+        return getattr(self._batch_scope, "events", None) is not None
+
+    def _post_collected(self, events, raise_errors=True):
+        """Post the events collected by `batch()` in size-bounded requests"""
+        batches, _ = split_batches(events)
+        error = None
+        for batch in batches:
+            try:
+                with self.tracer.span("request", size=len(batch)):
+                    batch_post(
+                        self.api_key,
+                        self.server_token,
+                        self.host,
+                        timeout=self._request_timeout,
+                        circuit=self.circuit_breaker,
+                        limiter=self.rate_limiter,
+                        compact=self.compact_batches,
+                        batch=batch,
+                    )
+            except Exception as e:
+                self.log.error("error uploading %s collected events: %s", len(batch), e)
+                error = error or e
+        if error is not None and raise_errors:
+            raise error
+        self.log.debug("posted %s collected events in %s requests.", len(events), len(batches))
+
+    def _start_consumers(self):
+        """Start the consumer threads, unless they have already been started or joined"""
+        with self._consumers_lock:
+            if self._consumers_started:
+                return
+            self._consumers_started = True
+            atexit.register(self._exit)
+            for consumer in self.consumers:
+                # a consumer paused by join() before the first enqueue stays stopped
+                if consumer.running:
+                    consumer.start()
+
+    def flush(self, timeout=None):
+        """Forces a flush from the internal queue to the server
+
+        With a `timeout`, gives up waiting after that many seconds. In serverless
+        mode the buffered events are sent in parallel before the `timeout` runs
+        out and a `FlushResult(delivered, remaining)` is returned; events that
+        could not be delivered in time stay buffered for the next flush.
+        """
+        self.rollup.flush()
+        if self.serverless:
+            return self._flush_buffer(timeout)
+
         queue = self.queue
         size = queue.qsize()
-        queue.join()
+        if timeout is None:
+            queue.join()
+        elif not join_queue(queue, timeout):
+            self.log.warning("flush timed out with about %s items left.", queue.qsize())
+            return
         # Note that this message may not be precise, because of threading.
         self.log.debug("successfully flushed about %s items.", size)
 
-    def join(self):
+    def _flush_buffer(self, timeout):
+        """Send the serverless buffer in as few parallel requests as possible within `timeout`"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._buffer_lock:
+            items, self.buffer = self.buffer, []
+
+        batches, _ = split_batches(items)
+        delivered, failed = post_batches(
+            self.api_key,
+            self.server_token,
+            batches,
+            host=self.host,
+            timeout=self._request_timeout,
+            deadline=deadline,
+            retries=self.max_retries,
+            max_workers=self.upload_threads,
+            tracer=self.tracer,
+            circuit=self.circuit_breaker,
+            limiter=self.rate_limiter,
+            compact=self.compact_batches,
+        )
+
+        leftover = []
+        for batch, e in failed:
+            if fatal_exception(e):
+                self.log.error("error uploading: %s", e)
+                if self.on_error:
+                    self.on_error(e, batch)
+            else:
+                leftover.extend(batch)
+
+        with self._buffer_lock:
+            self.buffer[:0] = leftover
+            remaining = len(self.buffer)
+        sent = sum(len(batch) for batch in delivered)
+        self.log.debug("flushed %s items, %s left over.", sent, remaining)
+        return FlushResult(sent, remaining)
+
+    def join(self, timeout=None):
         """Ends the consumer thread once the queue is empty.
-        Blocks execution until finished
+        Blocks execution until finished, or for at most `timeout` seconds
         """
-        for consumer in self.consumers:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.rollup.stop()
+        for consumer in self.consumers or []:
             consumer.pause()
+        for consumer in self.consumers or []:
             try:
-                consumer.join()
+                consumer.join(None if deadline is None else max(deadline - time.monotonic(), 0))
             except RuntimeError:
                 # consumer thread has not started
                 pass
+        if self.profile and not self._profile_reported:
+            self._profile_reported = True
+            self.tracer.report()
+
+    def shutdown(self, timeout=None):
+        """Flush all messages and cleanly shutdown the client
+
+        With a `timeout`, the queued events are sent over `upload_threads`
+        concurrent uploads instead of one batch at a time, retries stop at the
+        deadline, and events that could not be delivered in time are handed to
+        `undelivered_sink`. Delivery is at least once: a batch whose request is
+        still in flight at the deadline is handed over too, and may arrive
+        nonetheless. Its events carry an `event_id` to drop the duplicates by.
+        """
+        if timeout is None:
+            self.flush()
+            self.join()
+            return
+
+        deadline = time.monotonic() + timeout
+        self.rollup.stop()
+        if self.serverless:
+            self._flush_buffer(timeout)
+            with self._buffer_lock:
+                items, self.buffer = self.buffer, []
+            if items:
+                hand_to_sink(self.undelivered_sink, items, DeadlineExceeded())
+            return
+
+        # in-flight batches keep going, but stop retrying at the deadline
+        for consumer in self.consumers or []:
+            consumer.deadline = deadline
+            consumer.pause()
 
-    def shutdown(self):
-        """Flush all messages and cleanly shutdown the client"""
-        self.flush()
-        self.join()
+        items = []
+        for item in drain_queue(self.queue):
+            if isinstance(item, DeferredMessage):
+                item = resolve_deferred(item, self.on_error, self.tracer)
+            if item is not None:
+                items.append(item)
+        batches, _ = split_batches(items)
+        _, failed = post_batches(
+            self.api_key,
+            self.server_token,
+            batches,
+            host=self.host,
+            timeout=self._request_timeout,
+            deadline=deadline,
+            retries=self.max_retries,
+            max_workers=self.upload_threads,
+            tracer=self.tracer,
+            circuit=self.circuit_breaker,
+            limiter=self.rate_limiter,
+            compact=self.compact_batches,
+        )
+        for batch, e in failed:
+            self.log.error("error uploading on shutdown: %s", e)
+            batch = decode_batch(batch)
+            if self.on_error:
+                self.on_error(e, batch)
+            hand_to_sink(self.undelivered_sink, batch, e)
+
+        self.join(max(deadline - time.monotonic(), 0))
+
+    def _exit(self):
+        """Stop the consumers on interpreter exit, draining the queue if `shutdown_timeout` is set"""
+        if self.shutdown_timeout is None:
+            self.join()
+        else:
+            self.shutdown(self.shutdown_timeout)
+
+
+class RequestBuffer(object):
+    """The events held for one request by `Client.buffered()` or `Client.begin_buffer()`.
+
+    Events tracked in a context where the buffer is active are held until
+    `end()` enqueues them. `activate()` and `deactivate()` may be repeated,
+    for a response produced in steps. `end()` only acts once and may be
+    called from any thread or context, even by the garbage collector at
+    interpreter exit, where it does not start the consumer threads. An ended
+    buffer holds nothing, even where it is still active.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.events = []
+        self.lock = Lock()
+        self.ended = False
+        self.token = None
+
+    def activate(self):
+        """Hold the events tracked in this context, unless another buffer already does."""
+        current = self.client._request_buffer.get()
+        if self.ended or (current is not None and not current.ended):
+            return
+        self.token = self.client._request_buffer.set(self)
+
+    def deactivate(self):
+        token, self.token = self.token, None
+        if token is None:
+            return
+        try:
+            self.client._request_buffer.reset(token)
+        except (ValueError, RuntimeError):
+            # activated in another context, where it holds nothing once ended
+            pass
+
+    def hold(self, item, user_id):
+        """Hold `item`, return False if the buffer has already ended."""
+        with self.lock:
+            if self.ended:
+                return False
+            self.events.append((item, user_id))
+            return True
+
+    def end(self):
+        """Enqueue the held events, return how many were queued."""
+        with self.lock:
+            if self.ended:
+                return 0
+            self.ended = True
+            events, self.events = self.events, []
+        self.deactivate()
+        # threads cannot be started while the interpreter shuts down
+        return self.client._enqueue_buffered(events, start_consumers=not sys.is_finalizing())
 
 
 def require(name, field, data_type):
@@ -244,10 +757,17 @@ def require(name, field, data_type):
         raise AssertionError(msg)
 
 
+def snapshot(value):
+    """Return a shallow copy of a dict argument, to be processed later"""
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
 def stringify_id(val):
     if val is None:
         return None
-    if isinstance(val, string_types):
+    if isinstance(val, str):
         return val
     return str(val)
 
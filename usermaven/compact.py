@@ -0,0 +1,73 @@
+"""Compact batch bodies, for ingestion endpoints that accept them.
+
+The events of a batch repeat most of their fields: the api key, `src`,
+`screen_resolution`, empty `ids` and `event_id`, and often the same company.
+`compact_batch` sends the fields every event has in common once, and each
+distinct company once, referenced by its index:
+
+    {"compact": 1,
+     "common": {"api_key": "...", "src": "usermaven-python", ...},
+     "companies": [{"name": "Acme", "id": "1", ...}],
+     "events": [{"event_type": "page_viewed", "user": {...}, "company": 0}, ...]}
+
+`expand_batch` turns such a body back into the plain list of events. It is
+all an endpoint, or a proxy in front of one, needs to accept compact bodies;
+`usermaven.testing.FakeIngestionServer` uses it.
+"""
+
+COMPACT_VERSION = 1
+
+
+def compact_batch(batch):
+    """Return the compact body for the events in `batch`"""
+    common = {}
+    if len(batch) > 1:
+        first, rest = batch[0], batch[1:]
+        common = {key: value for key, value in first.items() if all(key in e and e[key] == value for e in rest)}
+
+    companies = []
+    # the client's company cache hands out one dict per company, so most are found by identity
+    refs = {}
+    events = []
+    for event in batch:
+        event = {key: value for key, value in event.items() if key not in common}
+        company = event.get("company")
+        if isinstance(company, dict):
+            ref = refs.get(id(company))
+            if ref is None:
+                ref = next((i for i, known in enumerate(companies) if known == company), None)
+                if ref is None:
+                    ref = len(companies)
+                    companies.append(company)
+                refs[id(company)] = ref
+            event["company"] = ref
+        events.append(event)
+
+    return {"compact": COMPACT_VERSION, "common": common, "companies": companies, "events": events}
+
+
+def expand_batch(body):
+    """Return the events of a body made by `compact_batch`, or `body` itself if it is a plain list of events
+
+    The expanded events share the `common` values and the companies. Raises
+    `ValueError` for a body that is neither.
+    """
+    if isinstance(body, list):
+        return body
+    if not isinstance(body, dict) or body.get("compact") != COMPACT_VERSION:
+        raise ValueError("not a batch of events")
+
+    common = body.get("common", {})
+    companies = body.get("companies", [])
+    events = []
+    for event in body["events"]:
+        expanded = dict(common)
+        expanded.update(event)
+        company = expanded.get("company")
+        if isinstance(company, int) and not isinstance(company, bool):
+            try:
+                expanded["company"] = companies[company]
+            except IndexError:
+                raise ValueError("unknown company reference %d" % company)
+        events.append(expanded)
+    return events
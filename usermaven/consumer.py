@@ -1,12 +1,17 @@
 import json
 import logging
+import random
+import time
+from functools import partial
 from threading import Thread
 
-import backoff
-import monotonic
-
-from usermaven.request import APIError, DatetimeSerializer, batch_post
-from usermaven.settings import MAX_MSG_SIZE, BATCH_SIZE_LIMIT
+from usermaven.batching import DeadlineExceeded
+from usermaven.circuit import CircuitOpen
+from usermaven.ratelimit import RateLimited
+from usermaven.request import APIError, DatetimeSerializer, batch_post, cap_timeout, decode_batch, fatal_exception
+from usermaven.settings import MAX_MSG_SIZE, BATCH_SIZE_LIMIT, SPLIT_STATUSES
+from usermaven.sinks import hand_to_sink
+from usermaven.tracing import NOOP_TRACER
 
 try:
     from queue import Empty
@@ -14,6 +19,38 @@ except ImportError:
     from Queue import Empty
 
 
+class DeferredMessage(object):
+    """A message queued as its arguments, built and cleaned by the consumer.
+
+    `Client(defer_processing=True)` queues these instead of messages, so that
+    validation and cleaning run on the consumer thread rather than the caller's.
+    """
+
+    __slots__ = ("fn", "args")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+    def resolve(self):
+        return self.fn(*self.args)
+
+    def __repr__(self):
+        return "DeferredMessage{0!r}".format(self.args[1:])
+
+
+def resolve_deferred(deferred, on_error=None, tracer=NOOP_TRACER):
+    """Build the message for a `DeferredMessage`, return None and report it to `on_error` if it is invalid."""
+    try:
+        with tracer.span("clean"):
+            return deferred.resolve()
+    except Exception as e:
+        logging.getLogger("usermaven").error("dropping invalid message: %s", e)
+        if on_error:
+            on_error(e, [deferred])
+        return None
+
+
 class Consumer(Thread):
     """Consumes the messages from the client's queue."""
 
@@ -30,6 +67,14 @@ class Consumer(Thread):
         flush_interval=0.5,
         retries=10,
         timeout=15,
+        undelivered_sink=None,
+        max_split_depth=7,
+        tracer=None,
+        circuit=None,
+        batch_deadline=None,
+        hedge=None,
+        limiter=None,
+        compact=False,
     ):
         """Create a consumer thread."""
         Thread.__init__(self)
@@ -49,6 +94,26 @@ class Consumer(Thread):
         self.running = True
         self.retries = retries
         self.timeout = timeout
+        self.undelivered_sink = undelivered_sink
+        # batches rejected with a SPLIT_STATUSES error are halved up to
+        # max_split_depth times to isolate the offending events
+        self.max_split_depth = max_split_depth
+        self.split_count = 0
+        self.dropped_count = 0
+        # time.monotonic() value after which the consumer stops retrying, set on shutdown
+        self.deadline = None
+        # times the stages of each batch, see usermaven.tracing
+        self.tracer = tracer or NOOP_TRACER
+        # a CircuitBreaker shared with the client's other uploads, if any
+        self.circuit = circuit
+        # batch_deadline: seconds a batch may spend on all its attempts and backoff waits
+        self.batch_deadline = batch_deadline
+        # a usermaven.hedging.Hedge duplicating slow requests, if any
+        self.hedge = hedge
+        # a usermaven.ratelimit.RateLimiter shared with the client's other uploads, if any
+        self.limiter = limiter
+        # send batches in the usermaven.compact encoding
+        self.compact = compact
 
     def run(self):
         """Runs the consumer."""
@@ -61,6 +126,11 @@ class Consumer(Thread):
     def pause(self):
         """Pause the consumer."""
         self.running = False
+        # wake it up if it is waiting for the queue
+        not_empty = getattr(self.queue, "not_empty", None)
+        if not_empty is not None:
+            with not_empty:
+                not_empty.notify_all()
 
     def upload(self):
         """Upload the next batch of items, return whether successful."""
@@ -70,64 +140,190 @@ class Consumer(Thread):
             return False
 
         try:
-            self.request(batch)
-            success = True
-        except Exception as e:
-            self.log.error("error uploading: %s", e)
-            success = False
-            if self.on_error:
-                self.on_error(e, batch)
+            success = self.send(batch)
         finally:
             # mark items as acknowledged from queue
             for item in batch:
                 self.queue.task_done()
             return success
 
+    def send(self, batch, depth=0):
+        """Send `batch`, splitting it if it is rejected, return whether all of it was delivered."""
+        try:
+            self.request(batch)
+            return True
+        except Exception as e:
+            if len(batch) > 1 and depth < self.max_split_depth and splittable_exception(e):
+                self.split_count += 1
+                self.log.warning("batch of %s items rejected, splitting it: %s", len(batch), e)
+                middle = len(batch) // 2
+                left = self.send(batch[:middle], depth + 1)
+                right = self.send(batch[middle:], depth + 1)
+                return left and right
+
+            self.log.error("error uploading: %s", e)
+            self.dropped_count += len(batch)
+            batch = decode_batch(batch)
+            if self.on_error:
+                self.on_error(e, batch)
+            if self.undelivered_sink:
+                hand_to_sink(self.undelivered_sink, batch, e)
+            return False
+
+    def wait_for_item(self):
+        """Block until the queue holds an item, return False if the consumer was paused first."""
+        queue = self.queue
+        with queue.not_empty:
+            while not queue._qsize():
+                if not self.running:
+                    return False
+                queue.not_empty.wait()
+        return True
+
     def next(self):
         """Return the next batch of items to upload."""
         queue = self.queue
         items = []
 
-        start_time = monotonic.monotonic()
+        # an idle consumer sleeps until there is something to send, and the
+        # flush_interval only starts once there is
+        if not self.wait_for_item():
+            return items
+
+        start_time = time.monotonic()
         total_size = 0
+        # per-item timings are only taken for batches the tracer samples
+        traced = self.tracer.enabled and self.tracer.sampled()
+        wait_time = serialize_time = 0.0
+        mark = time.perf_counter() if traced else 0.0
 
         while len(items) < self.flush_at:
-            elapsed = monotonic.monotonic() - start_time
+            elapsed = time.monotonic() - start_time
             if elapsed >= self.flush_interval:
                 break
             try:
                 item = queue.get(block=True, timeout=self.flush_interval - elapsed)
-                item_size = len(json.dumps(item, cls=DatetimeSerializer).encode())
-                if item_size > MAX_MSG_SIZE:
-                    self.log.error("Item exceeds 32kb limit, dropping. (%s)", str(item))
-                    continue
-                items.append(item)
-                total_size += item_size
-                if total_size >= BATCH_SIZE_LIMIT:
-                    self.log.debug("hit batch size limit (size: %d)", total_size)
-                    break
             except Empty:
                 break
+            finally:
+                if traced:
+                    now = time.perf_counter()
+                    wait_time += now - mark
+                    mark = now
+            if isinstance(item, DeferredMessage):
+                item = self.resolve(item)
+                if item is None:
+                    queue.task_done()
+                    continue
+                if traced:
+                    # building and cleaning it is traced as the `clean` stage
+                    mark = time.perf_counter()
+            if isinstance(item, bytes):
+                # encoded by a client with max_queue_bytes
+                item_size = len(item)
+            else:
+                item_size = len(json.dumps(item, cls=DatetimeSerializer).encode())
+            if traced:
+                now = time.perf_counter()
+                serialize_time += now - mark
+                mark = now
+            if item_size > MAX_MSG_SIZE:
+                self.log.error("Item exceeds 32kb limit, dropping. (%s)", item)
+                queue.task_done()
+                continue
+            items.append(item)
+            total_size += item_size
+            if total_size >= BATCH_SIZE_LIMIT:
+                self.log.debug("hit batch size limit (size: %d)", total_size)
+                break
 
+        if traced and items:
+            self.tracer.record("queue_wait", wait_time, size=len(items))
+            self.tracer.record("serialize", serialize_time, size=len(items), bytes=total_size)
+            self.tracer.record("batch", time.monotonic() - start_time, size=len(items), bytes=total_size)
         return items
 
+    def resolve(self, deferred):
+        """Build the message for a `DeferredMessage`, return None if it is invalid."""
+        return resolve_deferred(deferred, self.on_error, self.tracer)
+
     def request(self, batch):
         """Attempt to upload the batch and retry before raising an error"""
+        import backoff
 
-        def fatal_exception(exc):
-            if isinstance(exc, APIError):
-                # retry on server errors and client errors
-                # with 429 status code (rate limited),
-                # don't retry on other client errors
-                if exc.status == "N/A":
-                    return False
-                return (400 <= exc.status < 500) and exc.status != 429
-            else:
-                # retry on all other errors (eg. network)
-                return False
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceeded()
+
+        batch_deadline = None if self.batch_deadline is None else time.monotonic() + self.batch_deadline
 
-        @backoff.on_exception(backoff.expo, Exception, max_tries=self.retries + 1, giveup=fatal_exception)
+        # self.deadline is read on every attempt, as shutdown() may set it
+        # while a batch is already being retried
+        def deadline():
+            deadlines = [d for d in (self.deadline, batch_deadline) if d is not None]
+            return min(deadlines) if deadlines else None
+
+        def remaining():
+            at = deadline()
+            return None if at is None else at - time.monotonic()
+
+        last_error = None
+
+        def wait_gen():
+            for wait in backoff.expo():
+                wait = random.uniform(0, wait)
+                if isinstance(last_error, APIError) and last_error.status == 429:
+                    # the limiter holds every request back for Retry-After and paces the retry
+                    if self.limiter is not None:
+                        wait = 0
+                    elif last_error.retry_after is not None:
+                        wait = last_error.retry_after
+                left = remaining()
+                yield wait if left is None else min(wait, max(left, 0))
+
+        def giveup(exc):
+            left = remaining()
+            # an open circuit fails the batch at once rather than retrying it
+            return (
+                fatal_exception(exc)
+                or isinstance(exc, (CircuitOpen, RateLimited))
+                or (left is not None and left <= 0)
+            )
+
+        attempts = 0
+
+        def on_backoff(details):
+            self.tracer.record("retry", details["wait"], tries=details["tries"])
+
+        # jitter is applied by wait_gen, which must not shorten a Retry-After
+        @backoff.on_exception(
+            wait_gen, Exception, max_tries=self.retries + 1, giveup=giveup, on_backoff=on_backoff, jitter=None
+        )
         def send_request():
-            batch_post(self.api_key, self.server_token, self.host, timeout=self.timeout, batch=batch)
+            nonlocal attempts, last_error
+            attempts += 1
+            timeout = cap_timeout(self.timeout, remaining())
+            post, limiter = batch_post, self.limiter
+            if self.hedge is not None:
+                post = partial(self.hedge.call, batch_post)
+                if limiter is not None:
+                    # a hedged copy shares the tokens of its request, and waiting for them is not latency
+                    post, limiter = partial(limiter.call, post), None
+            try:
+                with self.tracer.span("request", size=len(batch)):
+                    post(self.api_key, self.server_token, self.host, timeout=timeout, circuit=self.circuit,
+                         limiter=limiter, deadline=deadline(), compact=self.compact, batch=batch)
+            except Exception as e:
+                last_error = e
+                raise
+
+        try:
+            send_request()
+        except Exception as e:
+            # recorded with the batch by DeadLetterSink
+            e.attempts = attempts
+            raise
+
 
-        send_request()
+def splittable_exception(exc):
+    """Return whether a batch that failed with `exc` may succeed once split into smaller batches"""
+    return isinstance(exc, APIError) and exc.status in SPLIT_STATUSES
@@ -0,0 +1,74 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+
+log = logging.getLogger("usermaven")
+
+
+class Hedge(object):
+    """Sends a duplicate of a request that is slower than usual, and keeps whichever finishes first.
+
+    A request still running after the `percentile` of the recent request
+    latencies (the last `window` successful requests, once there are at least
+    `min_samples`) is sent a second time. Both copies carry the same event
+    ids, which lets the ingestion API drop the duplicate.
+    """
+
+    def __init__(self, percentile=0.95, window=100, min_samples=20, max_workers=8):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.lock = Lock()
+        self.max_workers = max_workers
+        self.executor = None
+        self.hedged_count = 0
+
+    def threshold(self):
+        """Seconds after which a request is hedged, None until enough latencies are known."""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(self.percentile * len(latencies)), len(latencies) - 1)]
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def call(self, fn, *args, **kwargs):
+        """Call `fn`, calling it again in parallel if it runs for longer than the threshold."""
+        delay = self.threshold()
+        if delay is None:
+            return self._timed(fn, args, kwargs)
+
+        executor = self._executor()
+        primary = executor.submit(self._timed, fn, args, kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self.hedged_count += 1
+        log.debug("request slower than %.3fs, sending a hedged request", delay)
+        pending = {primary, executor.submit(self._timed, fn, args, kwargs)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _timed(self, fn, args, kwargs):
+        start = time.monotonic()
+        result = fn(*args, **kwargs)
+        self.record(time.monotonic() - start)
+        return result
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self.executor
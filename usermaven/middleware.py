@@ -0,0 +1,122 @@
+"""Middleware buffering the events of each web request, see `Client.buffered()`.
+
+The events tracked while a request is handled are enqueued together once its
+response has been sent, and repeated identifies of a user are sent once.
+Each middleware takes a `client`, or uses the module-level client configured
+with `usermaven.api_key` and friends.
+
+Flask, or any WSGI application::
+
+    app.wsgi_app = WSGIMiddleware(app.wsgi_app, client)
+
+FastAPI, Starlette, or any ASGI application::
+
+    app.add_middleware(ASGIMiddleware, client=client)
+
+Django, in settings.py::
+
+    MIDDLEWARE = ["usermaven.middleware.DjangoMiddleware", ...]
+"""
+import usermaven
+
+
+def _resolve(client):
+    if client is not None:
+        return client
+    if usermaven.disabled:
+        return None
+    return usermaven._client()
+
+
+class WSGIMiddleware(object):
+    """Buffers the events of each request until its response has been sent.
+
+    The events are enqueued once the server has iterated over the response
+    or closed it, whichever comes first.
+    """
+
+    def __init__(self, app, client=None):
+        self.app = app
+        self.client = client
+
+    def __call__(self, environ, start_response):
+        client = _resolve(self.client)
+        if client is None:
+            return self.app(environ, start_response)
+
+        buffer = client.begin_buffer()
+        try:
+            response = self.app(environ, start_response)
+        except BaseException:
+            buffer.end()
+            raise
+        finally:
+            # the server may never close the response, so the buffer is only
+            # active while the application runs
+            buffer.deactivate()
+        return _BufferedResponse(response, buffer)
+
+
+class _BufferedResponse(object):
+    """Iterates over a WSGI response with its request's buffer active, and ends the buffer after it."""
+
+    def __init__(self, response, buffer):
+        self.response = response
+        self.buffer = buffer
+
+    def __iter__(self):
+        try:
+            iterator = iter(self.response)
+            while True:
+                self.buffer.activate()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.buffer.deactivate()
+                yield chunk
+        finally:
+            self.buffer.end()
+
+    def close(self):
+        try:
+            if hasattr(self.response, "close"):
+                self.response.close()
+        finally:
+            self.buffer.end()
+
+
+class ASGIMiddleware(object):
+    """Buffers the events of each HTTP request until the application has sent its response."""
+
+    def __init__(self, app, client=None):
+        self.app = app
+        self.client = client
+
+    async def __call__(self, scope, receive, send):
+        client = _resolve(self.client)
+        if client is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # the request's task gets its own buffer, which handlers run in a thread pool
+        # share through the copied context
+        with client.buffered():
+            await self.app(scope, receive, send)
+
+
+class DjangoMiddleware(object):
+    """Buffers the events of each request until its response is returned."""
+
+    def __init__(self, get_response, client=None):
+        self.get_response = get_response
+        self.client = client
+
+    def __call__(self, request):
+        client = _resolve(self.client)
+        if client is None:
+            return self.get_response(request)
+
+        with client.buffered():
+            return self.get_response(request)
@@ -0,0 +1,259 @@
+import atexit
+import logging
+import time
+from collections import OrderedDict, deque
+from threading import Condition, Lock
+
+from usermaven.batching import split_batches
+from usermaven.client import Client
+from usermaven.queues import join_queue
+from usermaven.consumer import Consumer
+from usermaven.sinks import make_sink
+
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
+
+
+class FairQueue(object):
+    """A bounded queue partitioned per workspace that hands out single-workspace batches in turn.
+
+    A workspace is ready once it holds `max_items` events or its oldest event
+    has waited `interval` seconds. `get_batch` serves the ready workspaces
+    round-robin, so one busy workspace cannot hold back the others.
+    `workspace_maxsize` additionally bounds the events queued per workspace.
+    """
+
+    def __init__(self, maxsize=0, workspace_maxsize=0):
+        self.maxsize = maxsize
+        self.workspace_maxsize = workspace_maxsize
+        self.mutex = Lock()
+        self.not_empty = Condition(self.mutex)
+        self.all_tasks_done = Condition(self.mutex)
+        self.unfinished_tasks = 0
+        self.size = 0
+        # workspace -> deque of (enqueued_at, item), in the order they are served
+        self.pending = OrderedDict()
+
+    def qsize(self):
+        with self.mutex:
+            return self.size
+
+    def put(self, workspace, item):
+        """Queue `item` for `workspace`, raising `Full` rather than blocking."""
+        with self.mutex:
+            if self.maxsize and self.size >= self.maxsize:
+                raise Full
+            items = self.pending.get(workspace)
+            if items is None:
+                items = self.pending[workspace] = deque()
+            elif self.workspace_maxsize and len(items) >= self.workspace_maxsize:
+                raise Full
+            items.append((time.monotonic(), item))
+            self.size += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def get_batch(self, max_items, interval, timeout=None, stop=None):
+        """Return `(workspace, items)` for the next ready workspace, or `(None, [])` after `timeout`.
+
+        Without a `timeout` it waits for as long as no workspace is ready. It
+        also returns `(None, [])` instead of waiting once `stop()` is true,
+        which is checked again when `not_empty` is notified.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.not_empty:
+            while True:
+                now = time.monotonic()
+                wait = None if deadline is None else deadline - now
+                for workspace, items in self.pending.items():
+                    ready_in = items[0][0] + interval - now
+                    if len(items) >= max_items or ready_in <= 0:
+                        return workspace, self._take(workspace, items, max_items)
+                    wait = ready_in if wait is None else min(wait, ready_in)
+                if (wait is not None and wait <= 0) or (stop is not None and stop()):
+                    return None, []
+                self.not_empty.wait(wait)
+
+    def _take(self, workspace, items, max_items):
+        batch = [items.popleft()[1] for _ in range(min(max_items, len(items)))]
+        self.size -= len(batch)
+        # served workspaces go to the back of the line
+        del self.pending[workspace]
+        if items:
+            self.pending[workspace] = items
+        return batch
+
+    def task_done(self):
+        with self.all_tasks_done:
+            if self.unfinished_tasks <= 0:
+                raise ValueError("task_done() called too many times")
+            self.unfinished_tasks -= 1
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+
+class WorkspaceConsumer(Consumer):
+    """A consumer of a `FairQueue`, sending each batch with its workspace's credentials."""
+
+    def __init__(self, queue, credentials, **kwargs):
+        Consumer.__init__(self, queue, None, None, **kwargs)
+        # workspace -> (api_key, server_token), shared with the client
+        self.credentials = credentials
+
+    def upload(self):
+        """Upload the next batch of items, return whether successful."""
+        # waits for as long as no workspace is ready, pause() wakes it up
+        workspace, items = self.queue.get_batch(self.flush_at, self.flush_interval, stop=lambda: not self.running)
+        if not items:
+            return False
+
+        try:
+            # request() reads the credentials from the consumer, which only
+            # sends one batch at a time
+            self.api_key, self.server_token = self.credentials[workspace]
+            batches, dropped = split_batches(items, self.flush_at)
+            success = not dropped
+            for batch in batches:
+                success = self.send(batch) and success
+            return success
+        finally:
+            for item in items:
+                self.queue.task_done()
+
+
+class MultiClient(object):
+    """Sends events for many workspaces through one shared queue and consumer pool.
+
+    Register each workspace with `add_workspace(workspace, api_key, server_token)`
+    (or pass `workspaces={workspace: (api_key, server_token)}`), then pass the
+    workspace to `track` and `identify`. Events are batched per workspace and
+    the `thread` consumers serve the workspaces in turn.
+    """
+
+    log = logging.getLogger("usermaven")
+
+    def __init__(
+        self,
+        workspaces=None,
+        host=None,
+        debug=False,
+        max_queue_size=10000,
+        workspace_queue_size=0,
+        on_error=None,
+        flush_at=100,
+        flush_interval=0.5,
+        max_retries=3,
+        timeout=15,
+        thread=4,
+        undelivered_sink=None,
+        company_cache_size=1024,
+        circuit_breaker=None,
+        tracer=None,
+    ):
+        self.queue = FairQueue(max_queue_size, workspace_queue_size)
+        self.host = host
+        self.debug = debug
+        self.company_cache_size = company_cache_size
+        # workspace -> Client(send=False), which validates and cleans its messages
+        self.clients = {}
+        self.credentials = {}
+        self.undelivered_sink = make_sink(undelivered_sink)
+        self.consumers = [
+            WorkspaceConsumer(
+                self.queue,
+                self.credentials,
+                host=host,
+                on_error=on_error,
+                flush_at=flush_at,
+                flush_interval=flush_interval,
+                retries=max_retries,
+                timeout=timeout,
+                undelivered_sink=self.undelivered_sink,
+                tracer=tracer,
+                circuit=circuit_breaker,
+            )
+            for _ in range(thread)
+        ]
+        self._consumers_started = False
+        self._consumers_lock = Lock()
+
+        for workspace, (api_key, server_token) in (workspaces or {}).items():
+            self.add_workspace(workspace, api_key, server_token)
+
+    def add_workspace(self, workspace, api_key, server_token):
+        """Register the credentials events for `workspace` are sent with."""
+        client = Client(
+            api_key, server_token, host=self.host, debug=self.debug, send=False, thread=0,
+            company_cache_size=self.company_cache_size,
+        )
+        self.clients[workspace] = client
+        self.credentials[workspace] = (client.api_key, client.server_token)
+
+    def identify(self, workspace, user, company={}):
+        _, msg = self._client(workspace).identify(user, company)
+        return self._enqueue(workspace, msg)
+
+    def track(self, workspace, user_id, event_type, company={}, event_attributes={}):
+        _, msg = self._client(workspace).track(user_id, event_type, company, event_attributes)
+        return self._enqueue(workspace, msg)
+
+    def _client(self, workspace):
+        client = self.clients.get(workspace)
+        if client is None:
+            raise ValueError("unknown workspace: {0}".format(workspace))
+        return client
+
+    def _enqueue(self, workspace, msg):
+        """Push a cleaned `msg` onto the workspace's queue, return `(success, msg)`"""
+        if not self._consumers_started:
+            self._start_consumers()
+
+        try:
+            self.queue.put(workspace, msg)
+            self.log.debug("enqueued %s for %s.", msg["event_type"], workspace)
+            return True, msg
+        except Full:
+            self.log.warning("usermaven queue is full for %s", workspace)
+            return False, msg
+
+    def _start_consumers(self):
+        with self._consumers_lock:
+            if self._consumers_started:
+                return
+            self._consumers_started = True
+            atexit.register(self.join)
+            for consumer in self.consumers:
+                if consumer.running:
+                    consumer.start()
+
+    def flush(self, timeout=None):
+        """Wait until every queued event has been sent, or for at most `timeout` seconds"""
+        if timeout is None:
+            self.queue.join()
+        elif not join_queue(self.queue, timeout):
+            self.log.warning("flush timed out with about %s items left.", self.queue.qsize())
+
+    def join(self, timeout=None):
+        """Stop the consumers once they have sent their current batch"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for consumer in self.consumers:
+            consumer.pause()
+        for consumer in self.consumers:
+            try:
+                consumer.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+            except RuntimeError:
+                # consumer thread has not started
+                pass
+
+    def shutdown(self, timeout=None):
+        """Flush all messages and stop the consumers, within `timeout` seconds if given"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.flush(timeout)
+        self.join(None if deadline is None else max(deadline - time.monotonic(), 0))
@@ -0,0 +1,212 @@
+import logging
+import time
+import zlib
+from threading import Lock
+
+try:
+    import queue
+    from queue import Empty, Full
+except ImportError:
+    import Queue as queue
+    from Queue import Empty, Full
+
+
+class ByteQueue(queue.Queue):
+    """A queue of encoded events bounded by their total size rather than their number.
+
+    `bytes` items count their length against `max_bytes`. Anything else, such
+    as the `DeferredMessage`s queued with `defer_processing`, is only counted
+    against `maxsize`. An item larger than `max_bytes` is accepted on its own
+    into an empty queue, so it cannot block the queue forever.
+    """
+
+    def __init__(self, max_bytes, maxsize=0):
+        queue.Queue.__init__(self, maxsize)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if not block:
+                if not self._fits(item):
+                    raise Full
+            elif timeout is None:
+                while not self._fits(item):
+                    self.not_full.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._fits(item):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Full
+                    self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def full(self):
+        with self.mutex:
+            return (0 < self.maxsize <= self._qsize()) or self.bytes >= self.max_bytes
+
+    def _fits(self, item):
+        if 0 < self.maxsize <= self._qsize():
+            return False
+        return not self.queue or self.bytes + _size(item) <= self.max_bytes
+
+    def _put(self, item):
+        self.queue.append(item)
+        self.bytes += _size(item)
+
+    def _get(self):
+        item = self.queue.popleft()
+        self.bytes -= _size(item)
+        # a large item leaving may make room for several waiting puts
+        self.not_full.notify_all()
+        return item
+
+
+def _size(item):
+    return len(item) if isinstance(item, bytes) else 0
+
+
+class ShardedQueue(object):
+    """Routes each item to one of several queues by a hash of its key.
+
+    Items with the same key always land in the same shard, so a consumer that
+    owns a shard sends them in order. Items are put without blocking, raising
+    `Full` when their shard is full.
+    """
+
+    log = logging.getLogger("usermaven")
+
+    def __init__(self, shards):
+        self.shards = list(shards)
+        self.lock = Lock()
+        # items put while add_shard() waits for the shards to drain, as (item, key)
+        self.held = None
+
+    def shard_for(self, key):
+        return self.shards[zlib.crc32(str(key).encode("utf-8")) % len(self.shards)]
+
+    def put(self, item, key=None):
+        with self.lock:
+            if self.held is None:
+                self.shard_for(key).put(item, block=False)
+                return
+            capacity = sum(shard.maxsize for shard in self.shards)
+            if all(shard.maxsize for shard in self.shards) and len(self.held) >= capacity:
+                raise Full
+            self.held.append((item, key))
+
+    def put_many(self, items, keys):
+        """Put `items`, routed by their `keys`, taking each lock once. Return how many were put.
+
+        Like `put()` this never blocks: the items that do not fit in their
+        shard are left out.
+        """
+        with self.lock:
+            if self.held is not None:
+                room = len(items)
+                if all(shard.maxsize for shard in self.shards):
+                    room = max(sum(shard.maxsize for shard in self.shards) - len(self.held), 0)
+                self.held.extend(list(zip(items, keys))[:room])
+                return min(room, len(items))
+            return self._put_many(items, keys)
+
+    def _put_many(self, items, keys):
+        by_shard = {}
+        for item, key in zip(items, keys):
+            by_shard.setdefault(self.shard_for(key), []).append(item)
+        return sum(put_many(shard, shard_items) for shard, shard_items in by_shard.items())
+
+    def qsize(self):
+        with self.lock:
+            held = len(self.held or ())
+        return sum(shard.qsize() for shard in self.shards) + held
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def join(self):
+        for shard in self.shards:
+            shard.join()
+
+    def add_shard(self, shard, timeout=None):
+        """Add `shard` once the existing shards are drained, return whether it was added.
+
+        Changing the number of shards moves keys between them, so items put in
+        the meantime are held back until every item already queued has been
+        processed, keeping the items of each key in order. The held items are
+        then put without blocking, as `shard` has no consumer yet: those that
+        do not fit in their shard are dropped.
+        """
+        with self.lock:
+            self.held = []
+        drained = join_queue(self, timeout)
+        with self.lock:
+            if drained:
+                self.shards.append(shard)
+            held, self.held = self.held, None
+            count = self._put_many([item for item, _ in held], [key for _, key in held])
+        if count < len(held):
+            self.log.warning("queue is full, dropped %s events held while adding a shard", len(held) - count)
+        return drained
+
+    def take_held(self):
+        """Remove and return the items held back while a shard is being added."""
+        with self.lock:
+            if not self.held:
+                return []
+            held, self.held = self.held, []
+        return [item for item, _ in held]
+
+
+def put_many(queue, items):
+    """Put `items` on `queue` in order without blocking, taking its lock once. Return how many fit."""
+    count = 0
+    with queue.not_full:
+        for item in items:
+            if isinstance(queue, ByteQueue):
+                if not queue._fits(item):
+                    break
+            elif 0 < queue.maxsize <= queue._qsize():
+                break
+            queue._put(item)
+            count += 1
+        if count:
+            queue.unfinished_tasks += count
+            queue.not_empty.notify(count)
+    return count
+
+
+def join_queue(queue, timeout):
+    """Like `queue.join()`, but give up after `timeout` seconds. Return whether all tasks were done."""
+    if timeout is None:
+        queue.join()
+        return True
+    deadline = time.monotonic() + timeout
+    for shard in getattr(queue, "shards", (queue,)):
+        with shard.all_tasks_done:
+            while shard.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                shard.all_tasks_done.wait(remaining)
+    return True
+
+
+def drain_queue(queue):
+    """Remove and return everything currently in `queue`, marking it as done."""
+    # including what a ShardedQueue holds back while it adds a shard, which is newer
+    held = queue.take_held() if isinstance(queue, ShardedQueue) else []
+    items = []
+    for shard in getattr(queue, "shards", (queue,)):
+        while True:
+            try:
+                items.append(shard.get_nowait())
+            except Empty:
+                break
+            shard.task_done()
+    return items + held
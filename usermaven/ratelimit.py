@@ -0,0 +1,147 @@
+import logging
+import time
+from threading import Lock
+
+from usermaven.request import APIError, encode_event
+
+log = logging.getLogger("usermaven")
+
+
+class RateLimited(Exception):
+    """Raised when a request could not be sent within the rate limit before its deadline."""
+
+    def __str__(self):
+        return "[Usermaven] the rate limit does not allow sending the batch before the deadline"
+
+
+class _Bucket(object):
+    """A token bucket refilled at `max_rate * factor` per second, holding up to `burst` seconds of it."""
+
+    def __init__(self, max_rate, burst):
+        self.max_rate = float(max_rate)
+        self.burst = burst
+        self.tokens = self.max_rate * burst
+
+    def refill(self, elapsed, factor):
+        rate = self.max_rate * factor
+        self.tokens = min(self.tokens + elapsed * rate, rate * self.burst)
+
+    def wait(self, cost, factor):
+        """Seconds until `cost` tokens may be taken. A cost over the capacity only waits for a full bucket."""
+        rate = self.max_rate * factor
+        needed = min(cost, rate * self.burst)
+        return max(needed - self.tokens, 0) / rate
+
+
+class RateLimiter(object):
+    """Paces the requests to the ingestion API under an events per second and a bytes per second quota.
+
+    Each limit is a token bucket holding `burst` seconds worth of its rate, so
+    short bursts go out at once while the long-run rate stays under the limit.
+    The limits are ceilings: the rate adapts to the ingestion API's 429s the
+    way TCP adapts to congestion (AIMD). A 429 multiplies the rate by
+    `decrease`, at most once per round of requests, and pauses every request
+    for the response's Retry-After. The rate then grows back by `increase`
+    times the ceiling per second.
+
+    Share one limiter between all the uploads to a workspace, e.g. with
+    `Client(rate_limiter=...)`. `clock` and `sleep` default to
+    `time.monotonic` and `time.sleep`.
+    """
+
+    def __init__(
+        self,
+        events_per_second=None,
+        bytes_per_second=None,
+        burst=1.0,
+        decrease=0.7,
+        increase=0.05,
+        min_factor=0.01,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        if events_per_second is None and bytes_per_second is None:
+            raise ValueError("a RateLimiter needs events_per_second or bytes_per_second")
+        self.events = _Bucket(events_per_second, burst) if events_per_second else None
+        self.bytes = _Bucket(bytes_per_second, burst) if bytes_per_second else None
+        self.decrease = decrease
+        self.increase = increase
+        self.min_factor = min_factor
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = Lock()
+        # fraction of the configured rates currently allowed
+        self.factor = 1.0
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.decreased_at = float("-inf")
+        self.throttled_count = 0
+
+    def call(self, fn, *args, **kwargs):
+        """Call `fn` once the `batch` keyword argument fits in the rate, adapting the rate to its outcome.
+
+        Raises `RateLimited` if it would have to wait past the `time.monotonic()` `deadline` keyword argument.
+        """
+        deadline = kwargs.pop("deadline", None)
+        batch = kwargs.get("batch", ())
+        size = sum(len(item) if isinstance(item, bytes) else len(encode_event(item)) for item in batch) \
+            if self.bytes else 0
+        if not self.acquire(len(batch), size, deadline):
+            raise RateLimited()
+
+        started = self.clock()
+        try:
+            result = fn(*args, **kwargs)
+        except APIError as e:
+            if e.status == 429:
+                self.throttled(started, e.retry_after)
+            raise
+        return result
+
+    def acquire(self, events, size=0, deadline=None):
+        """Wait until `events` events of `size` bytes may be sent, return False if that would be after `deadline`."""
+        while True:
+            with self.lock:
+                now = self.clock()
+                self._refill(now)
+                wait = max(self.paused_until - now, 0)
+                if self.events:
+                    wait = max(wait, self.events.wait(events, self.factor))
+                if self.bytes:
+                    wait = max(wait, self.bytes.wait(size, self.factor))
+                if wait <= 0:
+                    if self.events:
+                        self.events.tokens -= events
+                    if self.bytes:
+                        self.bytes.tokens -= size
+                    return True
+            if deadline is not None and now + wait > deadline:
+                return False
+            self.sleep(wait)
+
+    def throttled(self, started, retry_after=None):
+        """Slow down after a 429 to a request sent at `started`, pausing for `retry_after` seconds if given."""
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.throttled_count += 1
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            # requests sent before the last decrease were sent at the old rate
+            if started < self.decreased_at:
+                return
+            self.decreased_at = now
+            self.factor = max(self.factor * self.decrease, self.min_factor)
+            for bucket in (self.events, self.bytes):
+                if bucket:
+                    bucket.tokens = min(bucket.tokens, 0)
+        log.warning("rate limited by the ingestion API, sending at %d%% of the rate limit", self.factor * 100)
+
+    def _refill(self, now):
+        elapsed = max(now - self.updated, 0)
+        self.updated = now
+        if now > self.paused_until:
+            self.factor = min(self.factor + self.increase * elapsed, 1.0)
+        for bucket in (self.events, self.bytes):
+            if bucket:
+                bucket.refill(elapsed, self.factor)
@@ -1,20 +1,45 @@
 import json
 import logging
+import time
 from datetime import date, datetime
-from typing import Any, Optional, Union
-
-import requests
+from email.utils import mktime_tz, parsedate_tz
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Optional, Union
 
+from usermaven.compact import compact_batch
 from usermaven.utils import remove_trailing_slash
 from usermaven.settings import DEFAULT_HOST, USER_AGENT
 
-_session = requests.sessions.Session()
+if TYPE_CHECKING:
+    import requests
+
+# `requests` is imported and the session created on the first upload rather
+# than when `usermaven` is imported, to keep the import cheap.
+_session = None
+_session_lock = Lock()
+
+
+def _get_session() -> "requests.Session":
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+
+                _session = requests.sessions.Session()
+    return _session
 
 
 def post(
-    api_key: str, server_token: str, host: Optional[str] = None, path=None, timeout: int = 15, **kwargs
-) -> requests.Response:
-    """Post the `kwargs` to the API"""
+    api_key: str,
+    server_token: str,
+    host: Optional[str] = None,
+    path=None,
+    timeout: int = 15,
+    compact: bool = False,
+    **kwargs
+) -> "requests.Response":
+    """Post the `kwargs` to the API, the batch in the `usermaven.compact` encoding if `compact`"""
     log = logging.getLogger("usermaven")
     body = kwargs
     url = remove_trailing_slash(host or DEFAULT_HOST) + path
@@ -22,7 +47,14 @@ def post(
     log.debug("making request: %s", data)
     headers = {"Content-Type": "application/json", "User-Agent": USER_AGENT}
     server_secret_key = api_key + "." + server_token
-    res = _session.post(url, params={'token': server_secret_key}, json=data, headers=headers, timeout=timeout)
+    if compact:
+        kwargs = {"data": encode_event(compact_batch(decode_batch(data)))}
+    elif any(isinstance(item, bytes) for item in data):
+        # events queued pre-encoded are joined into the body as they are
+        kwargs = {"data": encode_batch(data)}
+    else:
+        kwargs = {"json": data}
+    res = _get_session().post(url, params={'token': server_secret_key}, headers=headers, timeout=timeout, **kwargs)
 
     if res.status_code == 200:
         log.debug("data uploaded successfully")
@@ -31,38 +63,111 @@ def post(
 
 
 def _process_response(
-    res: requests.Response, success_message: str, *, return_json: bool = True
-) -> Union[requests.Response, Any]:
+    res: "requests.Response", success_message: str, *, return_json: bool = True
+) -> Union["requests.Response", Any]:
     log = logging.getLogger("usermaven")
     if res.status_code == 200:
         log.debug(success_message)
         return res.json() if return_json else res
+    retry_after = parse_retry_after(res.headers.get("Retry-After"))
     try:
         payload = res.json()
         log.debug("received response: %s", payload)
-        raise APIError(res.status_code, payload["detail"])
+        raise APIError(res.status_code, payload["detail"], retry_after)
     except (KeyError, ValueError):
-        raise APIError(res.status_code, res.text)
+        raise APIError(res.status_code, res.text, retry_after)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return the seconds to wait from a Retry-After header, given in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - time.time(), 0.0)
 
 
 def batch_post(
-    api_key: str, server_token: str, host: Optional[str] = None, timeout: int = 15, **kwargs
-) -> requests.Response:
-    """Post the `kwargs` to the batch API endpoint for events"""
+    api_key: str,
+    server_token: str,
+    host: Optional[str] = None,
+    timeout: int = 15,
+    circuit=None,
+    limiter=None,
+    deadline: Optional[float] = None,
+    **kwargs
+) -> "requests.Response":
+    """Post the `kwargs` to the batch API endpoint for events.
+
+    Goes through the `circuit` breaker and waits for the rate `limiter` if
+    given; a request that the limiter cannot let through before the
+    `time.monotonic()` `deadline` raises `RateLimited`.
+    """
+    if circuit is not None:
+        return circuit.call(batch_post, api_key, server_token, host, timeout, limiter=limiter, deadline=deadline,
+                            **kwargs)
+    if limiter is not None:
+        return limiter.call(batch_post, api_key, server_token, host, timeout, deadline=deadline, **kwargs)
     res = post(api_key, server_token, host, "/api/v1/s2s/event/", timeout, **kwargs)
     return _process_response(res, success_message="data uploaded successfully", return_json=False)
 
 
 class APIError(Exception):
-    def __init__(self, status: Union[int, str], message: str):
+    def __init__(self, status: Union[int, str], message: str, retry_after: Optional[float] = None):
         self.message = message
         self.status = status
+        # seconds to wait before retrying, from the response's Retry-After header
+        self.retry_after = retry_after
 
     def __str__(self):
         msg = "[Usermaven] {0} ({1})"
         return msg.format(self.message, self.status)
 
 
+def cap_timeout(timeout, limit):
+    """Cap a `timeout`, in seconds or as a `(connect, read)` pair, to `limit` seconds"""
+    if limit is None:
+        return timeout
+    limit = max(limit, 0.001)
+    if isinstance(timeout, tuple):
+        return tuple(min(t, limit) for t in timeout)
+    return min(timeout, limit)
+
+
+def fatal_exception(exc):
+    """Return whether uploading a batch that failed with `exc` is pointless to retry"""
+    if isinstance(exc, APIError):
+        # retry on server errors and client errors
+        # with 429 status code (rate limited),
+        # don't retry on other client errors
+        if exc.status == "N/A":
+            return False
+        return (400 <= exc.status < 500) and exc.status != 429
+    else:
+        # retry on all other errors (eg. network)
+        return False
+
+
+def encode_event(event: Any) -> bytes:
+    """Return `event` as compact JSON bytes"""
+    return json.dumps(event, cls=DatetimeSerializer, separators=(",", ":")).encode()
+
+
+def encode_batch(batch: list) -> bytes:
+    """Return the JSON array body for `batch`, whose items may be events or already encoded events"""
+    return b"[" + b",".join(item if isinstance(item, bytes) else encode_event(item) for item in batch) + b"]"
+
+
+def decode_batch(batch: list) -> list:
+    """Return `batch` with any encoded events decoded, e.g. to hand them to `on_error`"""
+    return [json.loads(item.decode("utf-8")) if isinstance(item, bytes) else item for item in batch]
+
+
 class DatetimeSerializer(json.JSONEncoder):
     def default(self, obj: Any):
         if isinstance(obj, (date, datetime)):
@@ -0,0 +1,107 @@
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+
+class _Counter(object):
+    """A single row of the rollup table."""
+
+    __slots__ = ("count", "company", "dims", "started_at")
+
+    def __init__(self, company, dims, started_at):
+        self.count = 0
+        self.company = company
+        self.dims = dims
+        self.started_at = started_at
+
+
+class Rollup(object):
+    """Aggregates counter increments in-process and emits one summarized event
+    per (user, company, event_type, dims) key per window.
+
+    `emit` is called as `emit(user_id, event_type, company, event_attributes)`
+    for every summarized row, normally `Client.track`. When the table already
+    holds `max_keys` rows, the oldest row is emitted early to make room.
+    """
+
+    log = logging.getLogger("usermaven")
+
+    def __init__(self, emit, interval=60, max_keys=10000):
+        self.emit = emit
+        self.interval = interval
+        self.max_keys = max_keys
+        self.evicted = 0
+        self.counters = OrderedDict()
+        self.lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def add(self, user_id, event_type, by=1, company=None, dims=None):
+        """Add `by` to the counter for the given key."""
+        dims = dims or {}
+        try:
+            key = (
+                user_id,
+                company["id"] if company else None,
+                event_type,
+                tuple(sorted(dims.items())),
+            )
+            hash(key)
+        except TypeError:
+            raise ValueError("dims values must be hashable, got: {0}".format(dims))
+
+        evicted = None
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                if len(self.counters) >= self.max_keys:
+                    evicted = self.counters.popitem(last=False)
+                    self.evicted += 1
+                counter = _Counter(company, dims, datetime.utcnow())
+                self.counters[key] = counter
+            counter.count += by
+
+        if evicted is not None:
+            self.log.debug("rollup table is full, emitting %s early.", evicted[0])
+            self._emit(*evicted)
+        self._ensure_timer()
+
+    def flush(self):
+        """Emit a summarized event for every key and start a new window."""
+        with self.lock:
+            counters = self.counters
+            self.counters = OrderedDict()
+        for key, counter in counters.items():
+            self._emit(key, counter)
+        return len(counters)
+
+    def stop(self):
+        """Stop the window timer and emit whatever has been aggregated."""
+        self._stopped.set()
+        self.flush()
+
+    def _emit(self, key, counter):
+        user_id, _, event_type, _ = key
+        event_attributes = dict(counter.dims)
+        event_attributes["count"] = counter.count
+        event_attributes["window_start"] = counter.started_at.isoformat()
+        event_attributes["window_end"] = datetime.utcnow().isoformat()
+        try:
+            self.emit(user_id, event_type, counter.company or {}, event_attributes)
+        except Exception as e:
+            self.log.error("error emitting rollup for %s: %s", event_type, e)
+
+    def _ensure_timer(self):
+        if self._thread is not None or self._stopped.is_set():
+            return
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._run, name="usermaven-rollup")
+            self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
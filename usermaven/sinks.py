@@ -0,0 +1,116 @@
+import gzip
+import json
+import logging
+import os
+import time
+import zlib
+from threading import Lock
+
+from usermaven.request import DatetimeSerializer
+
+log = logging.getLogger("usermaven")
+
+
+def undelivered_record(batch, error):
+    """Return the JSON-serializable record describing an undelivered `batch`."""
+    return {
+        "error": str(error) if error is not None else None,
+        "status": getattr(error, "status", None),
+        "batch": batch,
+    }
+
+
+class FileSink(object):
+    """Appends undelivered batches to `path`, one JSON record per line.
+
+    Each record holds the `batch` and the `error` (and HTTP `status`, if any)
+    that kept it from being delivered.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+    def __call__(self, batch, error=None):
+        line = json.dumps(undelivered_record(batch, error), cls=DatetimeSerializer) + "\n"
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class DeadLetterSink(object):
+    """Appends undelivered batches to gzipped JSONL files in `directory`, for `usermaven replay`.
+
+    Each record holds the `batch`, the `error` and HTTP `status`, the number of
+    `attempts` made to send it and when it `failed_at`. Records are written as
+    separate gzip members, so a file stays readable if the process dies, and a
+    new file is started once the current one reaches `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=10 << 20, prefix="undelivered"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.lock = Lock()
+        self.path = None
+        self.sequence = 0
+
+    def __call__(self, batch, error=None):
+        record = undelivered_record(batch, error)
+        record["attempts"] = getattr(error, "attempts", None)
+        record["failed_at"] = time.time()
+        data = gzip.compress(json.dumps(record, cls=DatetimeSerializer).encode() + b"\n")
+        with self.lock:
+            if self.path is None or os.path.getsize(self.path) >= self.max_bytes:
+                self.path = self._next_path()
+            with open(self.path, "ab") as f:
+                f.write(data)
+
+    def _next_path(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sequence += 1
+        # names sort in the order the files were written
+        name = "{0}-{1}-{2}-{3:04d}.jsonl.gz".format(
+            self.prefix, time.strftime("%Y%m%dT%H%M%S", time.gmtime()), os.getpid(), self.sequence
+        )
+        return os.path.join(self.directory, name)
+
+
+def read_undelivered(path):
+    """Yield `(line_number, record)` for each record in a file written by `FileSink` or `DeadLetterSink`.
+
+    A gzipped record cut short, by a process that died while writing it, is
+    logged and skipped.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        line_number = 0
+        while True:
+            try:
+                line = f.readline()
+            except (EOFError, zlib.error) as e:
+                log.warning("skipping a record cut short at the end of %s: %s", path, e)
+                return
+            if not line:
+                return
+            line_number += 1
+            if line.strip():
+                yield line_number, json.loads(line)
+
+
+def make_sink(sink):
+    """Return a `sink(batch, error)` callable for a callable or a file path."""
+    if sink is None or callable(sink):
+        return sink
+    return FileSink(sink)
+
+
+def hand_to_sink(sink, batch, error):
+    """Call `sink` with an undelivered `batch`, logging rather than raising its errors."""
+    if not sink:
+        log.warning("dropping %s undelivered items: %s", len(batch), error)
+        return
+    try:
+        sink(batch, error)
+    except Exception as e:
+        log.error("undelivered sink failed, dropping %s items: %s", len(batch), e)
@@ -0,0 +1,82 @@
+import time
+import unittest
+
+import mock
+
+from usermaven.batching import DeadlineExceeded, post_batches, split_batches
+from usermaven.request import APIError
+from usermaven.settings import MAX_MSG_SIZE
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+
+class TestSplitBatches(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(split_batches([]), ([], []))
+
+    def test_flush_at(self):
+        batches, dropped = split_batches(list(range(25)), flush_at=10)
+        self.assertEqual(batches, [list(range(10)), list(range(10, 20)), list(range(20, 25))])
+        self.assertEqual(dropped, [])
+
+    def test_size_limit(self):
+        item = {"m": "x" * 100}
+        batches, _ = split_batches([item] * 10, size_limit=350)
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+
+    def test_drops_oversize_items(self):
+        oversize = {"m": "x" * MAX_MSG_SIZE}
+        batches, dropped = split_batches([1, oversize, 2])
+        self.assertEqual(batches, [[1, 2]])
+        self.assertEqual(dropped, [oversize])
+
+
+class TestPostBatches(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIngestionServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def post(self, batches, **kwargs):
+        return post_batches(API_KEY, SERVER_TOKEN, batches, host=self.server.url, **kwargs)
+
+    def test_delivers_all_batches(self):
+        batches = [[{"n": i}] for i in range(10)]
+        delivered, failed = self.post(batches)
+        self.assertEqual(len(delivered), 10)
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(e["n"] for e in self.server.events), list(range(10)))
+
+    def test_retries_retryable_errors(self):
+        self.server.inject(503, count=2)
+        with mock.patch("usermaven.batching.time.sleep"):
+            delivered, failed = self.post([[{"n": 1}], [{"n": 2}]], retries=1, max_workers=1)
+        self.assertEqual(len(delivered), 2)
+        self.assertEqual(failed, [])
+
+    def test_gives_up_after_retries(self):
+        self.server.inject(503, count=2)
+        with mock.patch("usermaven.batching.time.sleep"):
+            delivered, failed = self.post([[{"n": 1}]], retries=1)
+        self.assertEqual(delivered, [])
+        self.assertEqual(failed[0][0], [{"n": 1}])
+        self.assertEqual(failed[0][1].status, 503)
+
+    def test_does_not_retry_fatal_errors(self):
+        self.server.inject(400)
+        delivered, failed = self.post([[{"n": 1}]], retries=3)
+        self.assertEqual(self.server.request_count, 1)
+        self.assertIsInstance(failed[0][1], APIError)
+
+    def test_deadline(self):
+        self.server.latency = 0.5
+        start = time.monotonic()
+        delivered, failed = self.post([[{"n": 1}], [{"n": 2}]], deadline=time.monotonic() + 0.1)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(delivered, [])
+        self.assertEqual([batch for batch, _ in failed], [[{"n": 1}], [{"n": 2}]])
+
+    def test_expired_deadline_sends_nothing(self):
+        delivered, failed = self.post([[{"n": 1}]], deadline=time.monotonic() - 1)
+        self.assertEqual(self.server.request_count, 0)
+        self.assertIsInstance(failed[0][1], DeadlineExceeded)
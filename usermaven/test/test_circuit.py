@@ -0,0 +1,232 @@
+import time
+import unittest
+
+from usermaven.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+from usermaven.client import Client
+from usermaven.ratelimit import RateLimited, RateLimiter
+from usermaven.request import APIError, batch_post
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def fail(status=503):
+    raise APIError(status, "unavailable")
+
+
+def succeed():
+    return "ok"
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.transitions = []
+        self.breaker = CircuitBreaker(
+            failure_threshold=3,
+            reset_timeout=10,
+            clock=self.clock,
+            on_state_change=lambda old, new: self.transitions.append(new),
+        )
+
+    def trip(self):
+        for _ in range(3):
+            self.assertRaises(APIError, self.breaker.call, fail)
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertRaises(APIError, self.breaker.call, fail)
+        self.assertRaises(APIError, self.breaker.call, fail)
+        self.breaker.call(succeed)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.trip()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.transitions, [OPEN])
+
+    def test_fails_fast_while_open(self):
+        self.trip()
+        calls = []
+        self.assertRaises(CircuitOpen, self.breaker.call, calls.append, 1)
+        self.clock.advance(9)
+        self.assertRaises(CircuitOpen, self.breaker.call, calls.append, 1)
+        self.assertEqual(calls, [])
+
+    def test_closes_after_successful_probe(self):
+        self.trip()
+        self.clock.advance(10)
+        self.assertEqual(self.breaker.call(succeed), "ok")
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.transitions, [OPEN, HALF_OPEN, CLOSED])
+
+    def test_reopens_after_failed_probe(self):
+        self.trip()
+        self.clock.advance(10)
+        self.assertRaises(APIError, self.breaker.call, fail)
+        self.assertEqual(self.transitions, [OPEN, HALF_OPEN, OPEN])
+        # the reset timeout starts over
+        self.clock.advance(5)
+        self.assertRaises(CircuitOpen, self.breaker.call, succeed)
+        self.clock.advance(5)
+        self.breaker.call(succeed)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_single_probe(self):
+        self.trip()
+        self.clock.advance(10)
+
+        def probe():
+            # a second request while the probe is in flight fails fast
+            self.assertRaises(CircuitOpen, self.breaker.call, succeed)
+
+        self.breaker.call(probe)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_client_errors_do_not_count(self):
+        for _ in range(5):
+            self.assertRaises(APIError, self.breaker.call, fail, 400)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_network_errors_count(self):
+        def refused():
+            raise ConnectionError("refused")
+
+        for _ in range(3):
+            self.assertRaises(ConnectionError, self.breaker.call, refused)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_rate_limited_does_not_count(self):
+        def refused():
+            raise RateLimited()
+
+        self.assertRaises(APIError, self.breaker.call, fail)
+        for _ in range(3):
+            self.assertRaises(RateLimited, self.breaker.call, refused)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.failures, 1)
+
+        self.breaker.call(succeed)
+        self.trip()
+        self.clock.advance(10)
+        # a probe the limiter refused lets the next request probe instead
+        self.assertRaises(RateLimited, self.breaker.call, refused)
+        self.assertEqual(self.breaker.call(succeed), "ok")
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_throttled_requests_do_not_count(self):
+        self.assertRaises(APIError, self.breaker.call, fail)
+        for _ in range(3):
+            self.assertRaises(APIError, self.breaker.call, fail, 429)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.failures, 1)
+
+        self.breaker.call(succeed)
+        self.trip()
+        self.clock.advance(10)
+        self.assertRaises(APIError, self.breaker.call, fail, 429)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertEqual(self.breaker.call(succeed), "ok")
+
+    def test_rate_limited_requests_keep_the_circuit_closed(self):
+        breaker = CircuitBreaker(failure_threshold=3)
+        limiter = RateLimiter(events_per_second=1)
+        batch = [Client(API_KEY, SERVER_TOKEN, send=False).track("user_id", "goal_created")[1]] * 2
+        with FakeIngestionServer() as server:
+            batch_post(API_KEY, SERVER_TOKEN, server.url, circuit=breaker, limiter=limiter, batch=batch)
+            for _ in range(3):
+                self.assertRaises(RateLimited, batch_post, API_KEY, SERVER_TOKEN, server.url, circuit=breaker,
+                                  limiter=limiter, deadline=time.monotonic(), batch=batch)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(server.event_count, 2)
+
+
+class TestClientCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=self.clock)
+        self.undelivered = []
+
+    def client(self, server, **kwargs):
+        return Client(
+            API_KEY,
+            SERVER_TOKEN,
+            host=server.url,
+            flush_at=1,
+            flush_interval=0.01,
+            circuit_breaker=self.breaker,
+            undelivered_sink=lambda batch, e: self.undelivered.append((batch[0]["event_type"], type(e))),
+            **kwargs
+        )
+
+    def test_outage_and_recovery(self):
+        with FakeIngestionServer() as server:
+            client = self.client(server, max_retries=0)
+            # the endpoint goes down
+            server.inject(503, count=100)
+            client.track("user_id", "down_1")
+            client.track("user_id", "down_2")
+            client.flush()
+            self.assertEqual(self.breaker.state, OPEN)
+            self.assertEqual(server.request_count, 2)
+
+            # batches are handed to the sink without a request
+            client.track("user_id", "open_1")
+            client.flush()
+            self.assertEqual(server.request_count, 2)
+
+            # the endpoint comes back, the probe succeeds and the circuit closes
+            server.reset()
+            self.clock.advance(30)
+            client.track("user_id", "recovered_1")
+            client.track("user_id", "recovered_2")
+            client.shutdown()
+
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(
+            self.undelivered, [("down_1", APIError), ("down_2", APIError), ("open_1", CircuitOpen)]
+        )
+        self.assertEqual([e["event_type"] for e in server.events], ["recovered_1", "recovered_2"])
+
+    def test_quota_does_not_open_the_circuit(self):
+        with FakeIngestionServer(quota=200, record=False) as server:
+            # the limiter is set above the quota, which the API enforces with 429s
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, thread=4, flush_at=20, max_queue_size=0,
+                            circuit_breaker=self.breaker, rate_limiter=RateLimiter(events_per_second=400),
+                            undelivered_sink=lambda batch, e: self.undelivered.append((len(batch), type(e))))
+            for i in range(600):
+                client.track("user_%d" % i, "goal_created")
+            client.shutdown()
+
+        self.assertGreater(server.statuses[429], 0)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.undelivered, [])
+        self.assertEqual(server.event_count, 600)
+
+    def test_open_circuit_is_not_retried(self):
+        with FakeIngestionServer() as server:
+            client = self.client(server, max_retries=10)
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+            client.track("user_id", "open_1")
+            client.flush(timeout=1)
+            self.assertEqual(self.undelivered, [("open_1", CircuitOpen)])
+            self.assertEqual(server.request_count, 0)
+            client.join()
+
+    def test_serverless_keeps_events_buffered(self):
+        with FakeIngestionServer() as server:
+            client = self.client(server, serverless=True)
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+            client.track("user_id", "open_1")
+            self.assertEqual(client.flush(timeout=1), (0, 1))
+            self.clock.advance(30)
+            self.assertEqual(client.flush(timeout=1), (1, 0))
+        self.assertEqual(server.request_count, 1)
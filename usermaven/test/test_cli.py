@@ -0,0 +1,106 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from usermaven.cli import main, replay_files
+from usermaven.request import APIError
+from usermaven.sinks import DeadLetterSink
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dead = os.path.join(self.dir, "dead")
+        self.checkpoint = os.path.join(self.dir, "checkpoint.json")
+        sink = DeadLetterSink(self.dead, max_bytes=1)
+        for n in range(5):
+            sink([{"event_type": "e%d_%d" % (n, i)} for i in range(10)], APIError(503, "Service Unavailable"))
+        self.server = FakeIngestionServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def replay(self, *args, **kwargs):
+        argv = ["replay", kwargs.get("path", self.dead), "--api-key", API_KEY, "--server-token", SERVER_TOKEN,
+                "--host", self.server.url, "--batch-size", "10", "--concurrency", "2", "--retries", "0"]
+        with mock.patch("sys.stderr", new_callable=io.StringIO):
+            return main(argv + list(args))
+
+    def test_replay(self):
+        self.assertEqual(self.replay(), 0)
+        self.assertEqual(
+            sorted(e["event_type"] for e in self.server.events),
+            sorted("e%d_%d" % (n, i) for n in range(5) for i in range(10)),
+        )
+        self.assertEqual(self.server.request_count, 5)
+        self.assertTrue(all(len(batch) == 10 for batch in self.server.batches))
+
+    def test_checkpoint_resumes(self):
+        self.server.inject(401, count=2)
+        failed = os.path.join(self.dir, "failed")
+        self.assertEqual(self.replay("--checkpoint", self.checkpoint, "--dead-letter", failed), 1)
+        # the first round of two batches was handed to the dead-letter directory
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(checkpoint["path"], replay_files([self.dead])[-1])
+        self.assertEqual(checkpoint["delivered"], 30)
+        self.assertEqual(len(os.listdir(failed)), 1)
+
+        self.server.reset()
+        self.assertEqual(self.replay("--checkpoint", self.checkpoint), 0)
+        self.assertEqual(self.server.event_count, 0)
+
+        self.assertEqual(self.replay(path=failed), 0)
+        self.assertEqual(self.server.event_count, 20)
+
+    def test_checkpoint_held_without_dead_letter(self):
+        self.server.inject(401, count=1)
+        self.assertEqual(self.replay("--checkpoint", self.checkpoint), 1)
+        # a batch of the first round failed, resuming starts over
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+        self.server.reset()
+        self.assertEqual(self.replay("--checkpoint", self.checkpoint), 0)
+        self.assertEqual(self.server.event_count, 50)
+
+    def test_torn_record(self):
+        files = replay_files([self.dead])
+        with open(files[1], "rb") as f:
+            data = f.read()
+        with open(files[1], "wb") as f:
+            f.write(data[:-10])
+        self.assertEqual(self.replay(), 0)
+        self.assertEqual(sorted(set(e["event_type"][:2] for e in self.server.events)), ["e0", "e2", "e3", "e4"])
+
+    def test_checkpoint_mid_way(self):
+        files = replay_files([self.dead])
+        with open(self.checkpoint, "w") as f:
+            json.dump({"path": files[2], "line": 1, "delivered": 30}, f)
+        self.assertEqual(self.replay("--checkpoint", self.checkpoint), 0)
+        self.assertEqual(sorted(set(e["event_type"][:2] for e in self.server.events)), ["e3", "e4"])
+
+    def test_rate(self):
+        with mock.patch("usermaven.cli.time.sleep") as sleep:
+            self.replay("--rate", "1")
+        self.assertEqual(sleep.call_count, 3)
+        self.assertAlmostEqual(sleep.call_args_list[0][0][0], 2, delta=0.5)
+
+    def test_events_per_second(self):
+        started = time.monotonic()
+        self.assertEqual(self.replay("--events-per-second", "40"), 0)
+        self.assertEqual(self.server.event_count, 50)
+        # 40 events go out at once, the 10 others wait for the bucket to refill
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+
+    def test_requires_credentials(self):
+        with mock.patch.dict(os.environ, clear=True), mock.patch("sys.stderr", new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                main(["replay", self.dead])
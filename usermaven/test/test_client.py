@@ -1,11 +1,14 @@
+import threading
 import time
 import unittest
 
 import mock
-import six
 
 from usermaven.client import Client
+from usermaven.ratelimit import RateLimiter
+from usermaven.request import APIError
 from usermaven.test.test_utils import FAKE_TEST_SERVER_TOKEN, FAKE_TEST_API_KEY
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
 
 
 class TestClient(unittest.TestCase):
@@ -141,6 +144,13 @@ class TestClient(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.client.identify(self.user, company={"name": "Usermaven"})
 
+    def test_identify_missing_and_wrong_type(self):
+        # Test that a missing key is reported as a ValueError even when another key has the wrong type
+        with self.assertRaises(ValueError):
+            self.client.identify({"id": [1], "email": "a"})
+        with self.assertRaises(ValueError):
+            self.client.identify(self.user, company={"id": None, "name": "n"})
+
     def test_advanced_identify_with_custom(self):
         client = self.client
         success, msg = client.identify(
@@ -154,6 +164,43 @@ class TestClient(unittest.TestCase):
         self.assertEqual(msg["company"]["custom"]["custom_key"], "custom_value")
         self.assertEqual(msg["user"]["custom"]["custom_key"], "custom_value")
 
+    def test_increment(self):
+        client = self.client
+        client.increment(self.user_id, "api_call")
+        client.increment(self.user_id, "api_call", by=2, dims={"endpoint": "/v1/search"})
+        client.increment(self.user_id, "api_call", dims={"endpoint": "/v1/search"})
+
+        with mock.patch.object(client, "_enqueue", wraps=client._enqueue) as enqueue:
+            client.flush()
+
+        msgs = sorted((call[0][0] for call in enqueue.call_args_list),
+                      key=lambda msg: msg["event_attributes"]["count"])
+        self.assertEqual(len(msgs), 2)
+        self.assertEqual(msgs[0]["event_type"], "api_call")
+        self.assertEqual(msgs[0]["user"]["id"], "user_id")
+        self.assertEqual(msgs[0]["event_attributes"]["count"], 1)
+        self.assertEqual(msgs[1]["event_attributes"]["count"], 3)
+        self.assertEqual(msgs[1]["event_attributes"]["endpoint"], "/v1/search")
+        self.assertFalse(self.failed)
+
+    def test_increment_with_company(self):
+        client = self.client
+        company = {"id": "5", "name": "Usermaven", "created_at": "2022-12-12T19:11:49"}
+        client.increment(self.user_id, "api_call", company=company)
+
+        with mock.patch.object(client, "_enqueue", wraps=client._enqueue) as enqueue:
+            client.flush()
+
+        msg = enqueue.call_args[0][0]
+        self.assertEqual(msg["company"]["id"], "5")
+        self.assertEqual(msg["event_attributes"]["count"], 1)
+
+    def test_increment_validates_arguments(self):
+        with self.assertRaises(AssertionError):
+            self.client.increment(self.user_id, "api_call", by="1")
+        with self.assertRaises(ValueError):
+            self.client.increment(self.user_id, "api_call", company={"id": "5"})
+
     def test_flush(self):
         client = self.client
         # set up the consumer with more requests than a single batch will allow
@@ -186,6 +233,19 @@ class TestClient(unittest.TestCase):
         self.assertTrue(client.queue.empty())
         self.assertTrue(success)
 
+    def test_serverless_overflow(self):
+        client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN, serverless=True, max_queue_size=1)
+        self.assertTrue(client.track(self.user_id, "goal_created")[0])
+        self.assertFalse(client.track(self.user_id, "goal_created")[0])
+
+    def test_flush_timeout(self):
+        client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN)
+        client.join()
+        client.identify(self.user)
+        start = time.time()
+        client.flush(timeout=0.1)
+        self.assertLess(time.time() - start, 1)
+
     def test_overflow(self):
         client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN, max_queue_size=1)
         # Ensure consumer thread is no longer uploading
@@ -199,7 +259,7 @@ class TestClient(unittest.TestCase):
         self.assertFalse(success)
 
     def test_unicode(self):
-        Client(six.u("unicode_key"), six.u("unicode_token"))
+        Client(u"unicode_key", u"unicode_token")
 
     def test_debug(self):
         Client("bad_key", "bad_token", debug=True)
@@ -227,3 +287,415 @@ class TestClient(unittest.TestCase):
         client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN)
         for consumer in client.consumers:
             self.assertEqual(consumer.timeout, 15)
+
+
+class TestClientWithServer(unittest.TestCase):
+    """Client tests against a local fake ingestion server rather than a mocked `batch_post`."""
+
+    def set_fail(self, e, batch):
+        """Mark the failure handler"""
+        self.failed = True
+
+    def setUp(self):
+        self.failed = False
+        self.user_id = "user_id"
+
+    def test_serverless(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, serverless=True)
+            self.assertFalse(client.consumers)
+            for i in range(250):
+                success, msg = client.track("user_%d" % i, "goal_created")
+                self.assertTrue(success)
+            self.assertEqual(server.request_count, 0)
+
+            result = client.flush(timeout=5)
+
+        self.assertEqual(result, (250, 0))
+        self.assertEqual(server.request_count, 1)
+        self.assertEqual([e["user"]["id"] for e in server.events], ["user_%d" % i for i in range(250)])
+        self.assertEqual(client.buffer, [])
+
+    def test_serverless_flush_keeps_undelivered_events(self):
+        with FakeIngestionServer(latency=0.5) as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, serverless=True)
+            client.track(self.user_id, "goal_created")
+            result = client.flush(timeout=0.1)
+            self.assertEqual(result.delivered, 0)
+            self.assertEqual(result.remaining, 1)
+
+            server.latency = 0
+            client.track(self.user_id, "goal_completed")
+            result = client.flush(timeout=5)
+
+        self.assertEqual(result.delivered, 2)
+        self.assertEqual(result.remaining, 0)
+        self.assertIn("goal_completed", [e["event_type"] for e in server.events])
+
+    def test_serverless_flush_drops_rejected_events(self):
+        with FakeIngestionServer() as server:
+            server.inject(400)
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, serverless=True, on_error=self.set_fail)
+            client.track(self.user_id, "goal_created")
+            result = client.flush(timeout=5)
+
+        self.assertEqual(result, (0, 0))
+        self.assertTrue(self.failed)
+
+    def test_shutdown_timeout_drains_in_parallel(self):
+        with FakeIngestionServer(latency=0.2) as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=0.01, upload_threads=8)
+            for i in range(1000):
+                client.track("user_%d" % i, "goal_created")
+            start = time.time()
+            client.shutdown(timeout=5)
+            elapsed = time.time() - start
+
+        # one batch at a time this would take about 10 * 0.2s
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(server.event_count, 1000)
+        self.assertTrue(client.queue.empty())
+        for consumer in client.consumers:
+            self.assertFalse(consumer.is_alive())
+
+    def test_shutdown_timeout_hands_undelivered_events_to_sink(self):
+        undelivered = []
+        with FakeIngestionServer(error_rate=1) as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=0.01, max_retries=100,
+                            undelivered_sink=lambda batch, e: undelivered.extend(batch))
+            for i in range(300):
+                client.track("user_%d" % i, "goal_created")
+            start = time.time()
+            client.shutdown(timeout=0.5)
+            elapsed = time.time() - start
+            # a batch in flight at the deadline is handed over as its consumer gives up
+            for consumer in client.consumers:
+                consumer.join(1)
+
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(sorted(e["user"]["id"] for e in undelivered), sorted("user_%d" % i for i in range(300)))
+
+    def test_shutdown_timeout_in_flight_batches(self):
+        undelivered = []
+        with FakeIngestionServer(latency=0.5) as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=10, upload_threads=4,
+                            undelivered_sink=lambda batch, e: undelivered.extend(batch))
+            for i in range(400):
+                client.track("user_%d" % i, "goal_created")
+            client.shutdown(timeout=0.2)
+            # the requests in flight at the deadline arrive after all
+            self.assertTrue(server.wait_for_events(400, timeout=5))
+
+        self.assertGreater(len(undelivered), 0)
+        # and carry the ids their copies in the sink have
+        event_ids = set(e["event_id"] for e in server.events)
+        self.assertEqual(len(event_ids), 400)
+        self.assertLessEqual(set(e["event_id"] for e in undelivered), event_ids)
+        self.assertNotIn("", event_ids)
+
+    def test_serverless_shutdown_timeout(self):
+        undelivered = []
+        with FakeIngestionServer(latency=0.5) as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, serverless=True,
+                            undelivered_sink=lambda batch, e: undelivered.extend(batch))
+            client.track(self.user_id, "goal_created")
+            client.shutdown(timeout=0.1)
+
+        self.assertEqual(len(undelivered), 1)
+        self.assertEqual(client.buffer, [])
+
+    def test_defer_processing(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=0.01, defer_processing=True)
+            company = {"id": "5", "name": "Usermaven", "created_at": "2022-12-12T19:11:49"}
+            attributes = {"plan": "premium"}
+            success, msg = client.track(self.user_id, "goal_created", company, attributes)
+            # top-level dicts are copied at call time
+            attributes["plan"] = "changed"
+            client.identify({"id": self.user_id, "email": "user@example.com", "created_at": "2022-12-12T19:11:49"})
+            client.flush()
+
+        self.assertTrue(success)
+        self.assertIsNone(msg)
+        track, identify = server.events
+        self.assertEqual(track["event_type"], "goal_created")
+        self.assertEqual(track["event_attributes"], {"plan": "premium"})
+        self.assertEqual(track["company"]["id"], "5")
+        self.assertEqual(identify["user"]["email"], "user@example.com")
+
+    def test_defer_processing_invalid_message(self):
+        errors = []
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=0.01, defer_processing=True,
+                            on_error=lambda e, batch: errors.append(e))
+            # validation errors surface through on_error rather than on the caller
+            self.assertTrue(client.track(self.user_id, "goal_created", company={"id": "5"})[0])
+            client.track(self.user_id, "goal_completed")
+            client.flush(timeout=5)
+
+        self.assertEqual([type(e) for e in errors], [ValueError])
+        self.assertEqual([e["event_type"] for e in server.events], ["goal_completed"])
+
+    def test_defer_processing_shutdown_timeout(self):
+        errors = []
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=10, defer_processing=True,
+                            on_error=lambda e, batch: errors.append(e))
+            for i in range(5):
+                client.track("user_%d" % i, "goal_created")
+            client.track(self.user_id, "goal_created", company={"id": "5"})
+            client.shutdown(timeout=2)
+
+        self.assertEqual(sorted(e["user"]["id"] for e in server.events), ["user_%d" % i for i in range(5)])
+        self.assertEqual([type(e) for e in errors], [ValueError])
+
+    def test_max_queue_bytes(self):
+        errors = []
+        with FakeIngestionServer() as server:
+            server.reject = lambda event: event["event_type"] == "poison"
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=0.01, max_queue_bytes=1 << 20,
+                            on_error=lambda e, batch: errors.extend(batch))
+            success, msg = client.track(self.user_id, "goal_created", event_attributes={"n": 1})
+            client.track(self.user_id, "poison")
+            client.flush()
+
+        self.assertTrue(success)
+        self.assertEqual(server.events, [msg])
+        # undelivered events are handed back decoded
+        self.assertEqual([e["event_type"] for e in errors], ["poison"])
+
+    def test_max_queue_bytes_full(self):
+        client = Client(API_KEY, SERVER_TOKEN, host="http://127.0.0.1:9", max_queue_bytes=500)
+        client.join()
+        results = [client.track(self.user_id, "goal_created")[0] for _ in range(5)]
+        self.assertEqual(results[:2], [True, True])
+        self.assertIn(False, results)
+        self.assertLessEqual(client.queue.bytes, 500)
+        self.assertIsInstance(client.queue.get_nowait(), bytes)
+
+    def test_hedged_requests(self):
+        with FakeIngestionServer(slow_rate=0.1, slow_latency=1, seed=1) as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_at=1, flush_interval=0.01, hedge_after=0.5,
+                            connect_timeout=1)
+            self.assertEqual(client.consumers[0].timeout, (1, 15))
+            for i in range(60):
+                client.track("user_%d" % i, "goal_created")
+            client.flush()
+            client.join()
+            # the slow originals arrive too
+            self.assertTrue(server.wait_for_events(60 + client.hedge.hedged_count, timeout=2))
+
+        self.assertGreater(client.hedge.hedged_count, 0)
+        # hedged duplicates carry the same event ids
+        event_ids = [e["event_id"] for e in server.events]
+        self.assertTrue(all(event_ids))
+        self.assertEqual(len(set(event_ids)), 60)
+
+    def test_hedged_requests_rate_limited(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_at=1, flush_interval=0.01, hedge_after=0.5,
+                            rate_limiter=RateLimiter(events_per_second=10))
+            for i in range(25):
+                client.track("user_%d" % i, "goal_created")
+            client.flush()
+
+        self.assertEqual(len(set(e["event_id"] for e in server.events)), 25)
+        # waiting about 0.1s for the rate limiter is not taken as request latency
+        self.assertLess(max(client.hedge.latencies), 0.09)
+
+    def test_batch(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, sync_mode=True)
+            with client.batch() as events:
+                for i in range(50):
+                    success, msg = client.track("user_%d" % i, "goal_created")
+                    self.assertTrue(success)
+                with client.batch():
+                    client.identify({"id": "user_1", "email": "user_1@example.com", "created_at": "2022-12-12"})
+                self.assertEqual(server.request_count, 0)
+                self.assertEqual(len(events), 51)
+
+        self.assertEqual(server.request_count, 1)
+        self.assertEqual(server.event_count, 51)
+        self.assertEqual(server.events[-1]["event_type"], "user_identify")
+
+    def test_batch_is_size_bounded(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, sync_mode=True)
+            with client.batch():
+                for i in range(100):
+                    client.track("user_%d" % i, "goal_created", event_attributes={"padding": "x" * 10000})
+
+        self.assertEqual(server.request_count, 3)
+        self.assertEqual(server.event_count, 100)
+
+    def test_batch_raises_upload_errors(self):
+        with FakeIngestionServer() as server:
+            server.inject(503)
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, sync_mode=True)
+            with self.assertRaises(APIError) as cm:
+                with client.batch():
+                    client.track(self.user_id, "goal_created")
+            self.assertEqual(cm.exception.status, 503)
+
+            # the block's own exception wins, the events are still sent
+            with self.assertRaises(KeyError):
+                with client.batch():
+                    client.track(self.user_id, "goal_completed")
+                    raise KeyError("task failed")
+
+        self.assertEqual([e["event_type"] for e in server.events], ["goal_completed"])
+
+    def test_batch_is_per_thread(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, sync_mode=True)
+            with client.batch() as events:
+                thread = threading.Thread(target=client.track, args=(self.user_id, "other_thread"))
+                thread.start()
+                thread.join()
+                self.assertEqual(server.request_count, 1)
+                client.track(self.user_id, "goal_created")
+            self.assertEqual(len(events), 1)
+
+        self.assertEqual(server.request_count, 2)
+
+    def test_batch_with_deferred_processing(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, defer_processing=True)
+            with client.batch():
+                success, msg = client.track(self.user_id, "goal_created")
+            client.join()
+
+        self.assertEqual(msg["event_type"], "goal_created")
+        self.assertEqual(server.events, [msg])
+        self.assertIsNone(client.consumers[0].ident)
+
+    def test_buffered(self):
+        user = {"id": self.user_id, "email": "user@example.com", "created_at": "2022-12-12"}
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url)
+            with client.buffered():
+                for i in range(10):
+                    success, msg = client.track(self.user_id, "goal_created")
+                    self.assertTrue(success)
+                with client.buffered():
+                    client.identify(user)
+                client.identify(dict(user))
+                client.identify(dict(user, email="new@example.com"))
+                self.assertEqual(client.queue.qsize(), 0)
+            self.assertEqual(client.queue.unfinished_tasks, 12)
+            client.flush()
+
+        self.assertEqual(server.event_count, 12)
+        emails = [e["user"]["email"] for e in server.events if e["event_type"] == "user_identify"]
+        self.assertEqual(emails, ["user@example.com", "new@example.com"])
+
+    def test_buffered_with_deferred_processing(self):
+        user = {"id": self.user_id, "email": "user@example.com", "created_at": "2022-12-12"}
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, defer_processing=True, shard_by_user=True,
+                            thread=2)
+            with client.buffered():
+                client.identify(user)
+                client.identify(user)
+                client.track(self.user_id, "goal_created")
+                self.assertEqual(client.queue.qsize(), 0)
+            client.flush()
+
+        self.assertEqual([e["event_type"] for e in server.events], ["user_identify", "goal_created"])
+
+    def test_buffered_enqueues_on_error(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, max_queue_size=3)
+            with self.assertRaises(KeyError):
+                with client.buffered():
+                    for i in range(5):
+                        client.track(self.user_id, "goal_created_%d" % i)
+                    raise KeyError("request failed")
+            client.flush()
+
+        # what did not fit in the queue is dropped
+        self.assertEqual([e["event_type"] for e in server.events], ["goal_created_0", "goal_created_1",
+                                                                    "goal_created_2"])
+
+    def test_buffered_is_per_thread(self):
+        client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN, serverless=True)
+        with client.buffered():
+            thread = threading.Thread(target=client.track, args=(self.user_id, "other_thread"))
+            thread.start()
+            thread.join()
+            self.assertEqual(len(client.buffer), 1)
+            client.track(self.user_id, "goal_created")
+            self.assertEqual(len(client.buffer), 1)
+        self.assertEqual([msg["event_type"] for msg in client.buffer], ["other_thread", "goal_created"])
+
+    def test_begin_buffer(self):
+        client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN, serverless=True)
+        buffer = client.begin_buffer()
+        client.track(self.user_id, "goal_created")
+        self.assertEqual(client.buffer, [])
+
+        # ended from another thread, the buffer still active here holds nothing more
+        thread = threading.Thread(target=buffer.end)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(client.buffer), 1)
+        client.track(self.user_id, "goal_completed")
+        self.assertEqual(len(client.buffer), 2)
+        self.assertEqual(buffer.end(), 0)
+
+        # and a new buffer can start
+        with client.buffered():
+            client.track(self.user_id, "goal_created")
+            self.assertEqual(len(client.buffer), 2)
+        self.assertEqual(len(client.buffer), 3)
+
+    def test_buffered_in_sync_mode(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, sync_mode=True)
+            with client.buffered():
+                client.track(self.user_id, "goal_created")
+                client.track(self.user_id, "goal_completed")
+                self.assertEqual(server.request_count, 0)
+
+        self.assertEqual(server.request_count, 1)
+        self.assertEqual(server.event_count, 2)
+
+    def test_shard_by_user_keeps_order(self):
+        users = ["user_%d" % i for i in range(20)]
+        # slow requests let batches of the other consumers overtake
+        with FakeIngestionServer(slow_rate=0.2, slow_latency=0.05, seed=3) as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, thread=4, flush_at=5, flush_interval=0.01,
+                            shard_by_user=True)
+
+            def produce(offset):
+                for n in range(50):
+                    for user in users[offset::4]:
+                        client.track(user, "step", event_attributes={"n": n})
+
+            producers = [threading.Thread(target=produce, args=(i,)) for i in range(4)]
+            for producer in producers:
+                producer.start()
+            time.sleep(0.05)
+            self.assertTrue(client.add_consumer(timeout=5))
+            for producer in producers:
+                producer.join()
+            client.shutdown()
+
+        self.assertEqual(len(client.consumers), 5)
+        self.assertEqual(len(client.queue.shards), 5)
+        self.assertEqual(server.event_count, 1000)
+        for user in users:
+            steps = [e["event_attributes"]["n"] for e in server.events if e["user"]["id"] == user]
+            self.assertEqual(steps, list(range(50)))
+
+    def test_shard_by_user_deferred(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, thread=2, flush_interval=0.01,
+                            shard_by_user=True, defer_processing=True)
+            client.identify({"id": self.user_id, "email": "user@example.com", "created_at": "2022-12-12"})
+            client.track(self.user_id, "goal_created")
+            self.assertEqual(client.queue.shard_for(self.user_id).qsize() + server.event_count, 2)
+            client.shutdown()
+
+        self.assertEqual([e["event_type"] for e in server.events], ["user_identify", "goal_created"])
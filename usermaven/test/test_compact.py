@@ -0,0 +1,75 @@
+import unittest
+
+from usermaven.client import Client
+from usermaven.compact import compact_batch, expand_batch
+from usermaven.test.test_utils import FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+ACME = {"id": "1", "name": "Acme", "created_at": "2022-01-20", "custom": {"plan": "enterprise"}}
+GLOBEX = {"id": "2", "name": "Globex", "created_at": "2022-01-21"}
+
+
+class TestCompact(unittest.TestCase):
+    def setUp(self):
+        client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN, send=False)
+        self.batch = [
+            client.track("user_1", "page_viewed", ACME)[1],
+            client.track("user_2", "page_viewed", dict(ACME), {"path": "/"})[1],
+            client.identify({"id": "user_3", "email": "user_3@example.com", "created_at": "2022-01-22"}, GLOBEX)[1],
+            client.track("user_4", "goal_created")[1],
+        ]
+
+    def test_round_trip(self):
+        body = compact_batch(self.batch)
+        self.assertEqual(expand_batch(body), self.batch)
+        self.assertEqual(body["common"]["api_key"], FAKE_TEST_API_KEY)
+        self.assertEqual(body["common"]["src"], "usermaven-python")
+        # equal companies are sent once
+        self.assertEqual(body["companies"], [ACME, GLOBEX])
+        self.assertEqual([event.get("company") for event in body["events"]], [0, 0, 1, None])
+        self.assertNotIn("api_key", body["events"][0])
+
+    def test_shared_company(self):
+        batch = self.batch[:2]
+        body = compact_batch(batch)
+        self.assertEqual(body["common"]["company"], ACME)
+        self.assertEqual(body["companies"], [])
+        self.assertEqual(expand_batch(body), batch)
+
+    def test_single_event(self):
+        body = compact_batch(self.batch[:1])
+        self.assertEqual(body["common"], {})
+        self.assertEqual(expand_batch(body), self.batch[:1])
+        self.assertEqual(expand_batch(compact_batch([])), [])
+
+    def test_expand(self):
+        self.assertEqual(expand_batch(self.batch), self.batch)
+        self.assertRaises(ValueError, expand_batch, {"events": []})
+        self.assertRaises(ValueError, expand_batch, "[]")
+        body = compact_batch(self.batch)
+        body["events"][0]["company"] = 5
+        self.assertRaises(ValueError, expand_batch, body)
+
+    def test_client(self):
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, compact_batches=True, max_queue_bytes=1 << 20)
+            # queued as encoded bytes, decoded again to compact them
+            sent = [client.track("user_%d" % i, "page_viewed", ACME)[1] for i in range(20)]
+            client.flush()
+            self.assertEqual(server.events, sent)
+            compact_bytes = server.byte_count
+
+            server.reset()
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url)
+            for i in range(20):
+                client.track("user_%d" % i, "page_viewed", ACME)
+            client.flush()
+
+        self.assertEqual(len(server.events), 20)
+        self.assertLess(compact_bytes, server.byte_count / 2)
+
+        with FakeIngestionServer() as server:
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, compact_batches=True, sync_mode=True)
+            with client.batch():
+                batch = [client.track("user_%d" % i, "page_viewed", ACME)[1] for i in range(3)]
+        self.assertEqual(server.events, batch)
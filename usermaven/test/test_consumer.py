@@ -1,4 +1,5 @@
 import json as json_global
+import threading
 import time
 import unittest
 
@@ -9,10 +10,12 @@ try:
 except ImportError:
     from Queue import Queue
 
-from usermaven.consumer import Consumer
+from usermaven.batching import DeadlineExceeded
+from usermaven.consumer import Consumer, DeferredMessage
 from usermaven.settings import MAX_MSG_SIZE
 from usermaven.request import APIError
 from usermaven.test.test_utils import TEST_SERVER_TOKEN, TEST_API_KEY
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
 
 
 class TestConsumer(unittest.TestCase):
@@ -40,6 +43,19 @@ class TestConsumer(unittest.TestCase):
         next = consumer.next()
         self.assertEqual(next, [])
         self.assertTrue(q.empty())
+        self.assertEqual(q.unfinished_tasks, 0)
+
+    def test_next_resolves_deferred_messages(self):
+        q = Queue()
+        errors = []
+        consumer = Consumer(q, "", "", flush_interval=0.01, on_error=lambda e, batch: errors.append(e))
+        q.put(DeferredMessage(lambda n: {"n": n}, (1,)))
+        q.put(DeferredMessage(lambda n: 1 / n, (0,)))
+        q.put(2)
+        self.assertEqual(consumer.next(), [{"n": 1}, 2])
+        self.assertIsInstance(errors[0], ZeroDivisionError)
+        # the dropped message is acknowledged, so only the batch is outstanding
+        self.assertEqual(q.unfinished_tasks, 2)
 
     def test_upload(self):
         q = Queue()
@@ -138,11 +154,143 @@ class TestConsumer(unittest.TestCase):
         consumer = Consumer(None, TEST_API_KEY, TEST_SERVER_TOKEN, retries=3)
         self._test_request_retry(consumer, APIError(500, "Internal Server Error"), 3)
 
+    def test_request_deadline(self):
+        consumer = Consumer(None, TEST_API_KEY, TEST_SERVER_TOKEN, retries=10)
+        consumer.deadline = time.monotonic() + 0.2
+        with mock.patch("usermaven.consumer.batch_post", side_effect=APIError(503, "Service Unavailable")):
+            start = time.monotonic()
+            with self.assertRaises(APIError):
+                consumer.request([{"user_id": "user_id", "event_type": "python event track"}])
+            self.assertLess(time.monotonic() - start, 0.5)
+
+        consumer.deadline = time.monotonic() - 1
+        with self.assertRaises(DeadlineExceeded):
+            consumer.request([{"user_id": "user_id", "event_type": "python event track"}])
+
+    def test_upload_hands_failed_batch_to_sink(self):
+        q = Queue()
+        sink = mock.Mock()
+        consumer = Consumer(q, TEST_API_KEY, TEST_SERVER_TOKEN, retries=0, undelivered_sink=sink)
+        track = {"user_id": "user_id", "event_type": "python event track"}
+        q.put(track)
+        error = APIError(400, "Client Errors")
+        with mock.patch("usermaven.consumer.batch_post", side_effect=error):
+            self.assertFalse(consumer.upload())
+        sink.assert_called_once_with([track], error)
+        self.assertEqual(error.attempts, 1)
+
+    def test_batch_deadline(self):
+        consumer = Consumer(None, TEST_API_KEY, TEST_SERVER_TOKEN, retries=100, timeout=(3, 15), batch_deadline=0.2)
+        timeouts = []
+
+        def post(*args, **kwargs):
+            timeouts.append(kwargs["timeout"])
+            raise APIError(503, "Service Unavailable")
+
+        start = time.monotonic()
+        with mock.patch("usermaven.consumer.batch_post", side_effect=post):
+            with self.assertRaises(APIError):
+                consumer.request([{"user_id": "user_id", "event_type": "python event track"}])
+        self.assertLess(time.monotonic() - start, 1)
+        # connect and read timeouts are both capped by the time left
+        self.assertLessEqual(timeouts[0][1], 0.2)
+        self.assertLessEqual(timeouts[0][0], timeouts[0][1])
+
+    def test_request_records_attempts(self):
+        consumer = Consumer(None, TEST_API_KEY, TEST_SERVER_TOKEN, retries=2)
+        error = APIError(503, "Service Unavailable")
+        with mock.patch("usermaven.consumer.batch_post", side_effect=error), mock.patch("time.sleep"):
+            with self.assertRaises(APIError):
+                consumer.request([{"user_id": "user_id", "event_type": "python event track"}])
+        self.assertEqual(error.attempts, 3)
+
+    def test_split_isolates_rejected_events(self):
+        q = Queue()
+        failed = []
+        with FakeIngestionServer(reject=lambda event: event["n"] in (13, 77)) as server:
+            consumer = Consumer(q, API_KEY, SERVER_TOKEN, host=server.url, flush_at=100,
+                                on_error=lambda e, batch: failed.extend(batch))
+            for n in range(100):
+                q.put({"n": n})
+            self.assertFalse(consumer.upload())
+
+        self.assertEqual(failed, [{"n": 13}, {"n": 77}])
+        self.assertEqual(sorted(e["n"] for e in server.events), [n for n in range(100) if n not in (13, 77)])
+        self.assertEqual(consumer.dropped_count, 2)
+        self.assertGreater(consumer.split_count, 0)
+        self.assertEqual(q.unfinished_tasks, 0)
+
+    def test_split_on_payload_too_large(self):
+        q = Queue()
+        with FakeIngestionServer(max_body_size=2000) as server:
+            consumer = Consumer(q, API_KEY, SERVER_TOKEN, host=server.url, flush_at=100)
+            for n in range(100):
+                q.put({"n": n, "padding": "x" * 50})
+            self.assertTrue(consumer.upload())
+
+        self.assertEqual(server.event_count, 100)
+        self.assertEqual(server.statuses[413], consumer.split_count)
+        self.assertEqual(consumer.dropped_count, 0)
+
+    def test_split_depth_is_capped(self):
+        q = Queue()
+        failed = []
+        with FakeIngestionServer(reject=lambda event: event["n"] == 0) as server:
+            consumer = Consumer(q, API_KEY, SERVER_TOKEN, host=server.url, flush_at=8, max_split_depth=1,
+                                on_error=lambda e, batch: failed.append(batch))
+            for n in range(8):
+                q.put({"n": n})
+            consumer.upload()
+
+        self.assertEqual(consumer.split_count, 1)
+        self.assertEqual(failed, [[{"n": n} for n in range(4)]])
+        self.assertEqual(server.event_count, 4)
+
+    def test_no_split_on_other_errors(self):
+        q = Queue()
+        with FakeIngestionServer() as server:
+            server.inject(401)
+            consumer = Consumer(q, API_KEY, SERVER_TOKEN, host=server.url, flush_at=10)
+            for n in range(10):
+                q.put({"n": n})
+            consumer.upload()
+
+        self.assertEqual(server.request_count, 1)
+        self.assertEqual(consumer.split_count, 0)
+        self.assertEqual(consumer.dropped_count, 10)
+
     def test_pause(self):
         consumer = Consumer(None, TEST_API_KEY, TEST_SERVER_TOKEN)
         consumer.pause()
         self.assertFalse(consumer.running)
 
+    def test_idle_consumer_sleeps(self):
+        q = Queue()
+        wakeups = []
+
+        class CountingCondition(threading.Condition):
+            def wait(self, timeout=None):
+                result = threading.Condition.wait(self, timeout)
+                wakeups.append(timeout)
+                return result
+
+        q.not_empty = CountingCondition(q.mutex)
+        consumer = Consumer(q, TEST_API_KEY, TEST_SERVER_TOKEN, flush_at=10, flush_interval=0.01)
+        with mock.patch("usermaven.consumer.batch_post") as mock_post:
+            consumer.start()
+            time.sleep(0.3)
+            # polling every flush_interval would have woken it up about 30 times
+            self.assertEqual(wakeups, [])
+
+            # the flush_interval starts with the first item
+            q.put({"event_type": "python event track"})
+            q.join()
+            self.assertEqual(mock_post.call_count, 1)
+
+            consumer.pause()
+            consumer.join(1)
+        self.assertFalse(consumer.is_alive())
+
     def test_max_batch_size(self):
         q = Queue()
         consumer = Consumer(q, TEST_API_KEY, TEST_SERVER_TOKEN, flush_at=100000, flush_interval=3)
@@ -160,7 +308,9 @@ class TestConsumer(unittest.TestCase):
                             len(json_str.encode()))
             return res
 
-        with mock.patch("usermaven.request._session.post", side_effect=mock_post_fn) as mock_post:
+        with mock.patch("usermaven.request._get_session") as mock_session:
+            mock_post = mock_session.return_value.post
+            mock_post.side_effect = mock_post_fn
             consumer.start()
             for _ in range(0, n_msgs + 2):
                 q.put(track)
@@ -0,0 +1,77 @@
+import threading
+import time
+import unittest
+
+from usermaven.hedging import Hedge
+
+
+class TestHedge(unittest.TestCase):
+    def setUp(self):
+        self.hedge = Hedge(percentile=0.9, min_samples=5)
+
+    def warm_up(self, latency=0.01):
+        for _ in range(10):
+            self.hedge.record(latency)
+
+    def test_threshold(self):
+        self.assertIsNone(self.hedge.threshold())
+        for latency in range(1, 11):
+            self.hedge.record(latency / 100.0)
+        self.assertEqual(self.hedge.threshold(), 0.1)
+
+    def test_not_hedged_until_warm(self):
+        calls = []
+        self.assertEqual(self.hedge.call(lambda: calls.append(1) or "ok"), "ok")
+        self.assertEqual(calls, [1])
+        self.assertEqual(len(self.hedge.latencies), 1)
+
+    def test_fast_call_is_not_hedged(self):
+        self.warm_up(0.5)
+        calls = []
+        self.assertEqual(self.hedge.call(lambda: calls.append(1) or "ok"), "ok")
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.hedge.hedged_count, 0)
+
+    def test_slow_call_is_hedged(self):
+        self.warm_up()
+        calls = []
+        lock = threading.Lock()
+
+        def request():
+            with lock:
+                calls.append(1)
+                first = len(calls) == 1
+            # the first copy is stuck, the duplicate answers quickly
+            time.sleep(1 if first else 0)
+            return "first" if first else "hedged"
+
+        start = time.monotonic()
+        self.assertEqual(self.hedge.call(request), "hedged")
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.hedge.hedged_count, 1)
+
+    def test_failed_copy_waits_for_the_other(self):
+        self.warm_up()
+        calls = []
+        lock = threading.Lock()
+
+        def request():
+            with lock:
+                calls.append(1)
+                first = len(calls) == 1
+            if first:
+                time.sleep(0.1)
+                return "first"
+            raise IOError("connection reset")
+
+        self.assertEqual(self.hedge.call(request), "first")
+
+    def test_both_fail(self):
+        self.warm_up()
+
+        def request():
+            time.sleep(0.05)
+            raise IOError("connection reset")
+
+        self.assertRaises(IOError, self.hedge.call, request)
@@ -0,0 +1,50 @@
+import subprocess
+import sys
+import unittest
+
+# Modules that must only be imported once something is uploaded.
+DEFERRED_MODULES = ("requests", "urllib3", "backoff", "six", "monotonic", "dateutil")
+# Generous bound on the cumulative cost of `import usermaven`, in microseconds.
+MAX_IMPORT_TIME_US = 150000
+
+
+def import_times(module):
+    """Return `{module: cumulative_us}` as reported by `python -X importtime`."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires Python 3.7")
+class TestImport(unittest.TestCase):
+    def test_http_stack_is_not_imported(self):
+        times = import_times("usermaven")
+        self.assertIn("usermaven", times)
+        for name in times:
+            self.assertNotIn(name.split(".")[0], DEFERRED_MODULES, "%s imported by `import usermaven`" % name)
+
+    def test_import_time(self):
+        # take the best of a few runs to keep a noisy machine from failing the test
+        best = min(import_times("usermaven")["usermaven"] for _ in range(3))
+        self.assertLess(best, MAX_IMPORT_TIME_US)
+
+    def test_client_starts_no_threads(self):
+        code = (
+            "import threading, usermaven;"
+            "c = usermaven.Client('key', 'token');"
+            "assert threading.active_count() == 1, threading.enumerate();"
+            "import sys; assert 'requests' not in sys.modules"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True)
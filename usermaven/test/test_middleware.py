@@ -0,0 +1,136 @@
+import asyncio
+import subprocess
+import sys
+import textwrap
+import unittest
+
+import mock
+
+import usermaven
+from usermaven.client import Client
+from usermaven.middleware import ASGIMiddleware, DjangoMiddleware, WSGIMiddleware
+from usermaven.test.test_utils import FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN
+
+
+class TestMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.client = Client(FAKE_TEST_API_KEY, FAKE_TEST_SERVER_TOKEN, serverless=True)
+
+    def track_twice(self):
+        self.client.track("user_id", "goal_created")
+        self.client.track("user_id", "goal_completed")
+        # nothing is enqueued while the request is handled
+        self.assertEqual(self.client.buffer, [])
+
+    def test_wsgi(self):
+        def app(environ, start_response):
+            self.track_twice()
+            start_response("200 OK", [])
+            yield b"body"
+            self.client.track("user_id", "response_sent")
+
+        middleware = WSGIMiddleware(app, self.client)
+        response = middleware({}, lambda status, headers: None)
+        self.assertEqual(self.client.buffer, [])
+        self.assertEqual(list(response), [b"body"])
+        response.close()
+
+        self.assertEqual([msg["event_type"] for msg in self.client.buffer],
+                         ["goal_created", "goal_completed", "response_sent"])
+
+    def test_wsgi_closed_early(self):
+        def app(environ, start_response):
+            self.track_twice()
+            start_response("200 OK", [])
+            return [b"head", b"body"]
+
+        response = WSGIMiddleware(app, self.client)({}, lambda status, headers: None)
+        chunks = iter(response)
+        self.assertEqual(next(chunks), b"head")
+        self.assertEqual(self.client.buffer, [])
+        response.close()
+        self.assertEqual(len(self.client.buffer), 2)
+
+    def test_wsgi_unclosed_response(self):
+        def app(environ, start_response):
+            self.client.track("user_id", "goal_created")
+            start_response("200 OK", [])
+            return [b"body"]
+
+        middleware = WSGIMiddleware(app, self.client)
+        # a server that never closes the response
+        self.assertEqual(list(middleware({}, lambda status, headers: None)), [b"body"])
+        self.assertEqual(len(self.client.buffer), 1)
+        unclosed = middleware({}, lambda status, headers: None)
+
+        # the next request, and events outside a request, are not held by it
+        self.client.track("user_id", "goal_completed")
+        self.assertEqual(len(self.client.buffer), 2)
+        self.assertEqual(list(middleware({}, lambda status, headers: None)), [b"body"])
+        self.assertEqual(len(self.client.buffer), 3)
+        unclosed.close()
+        self.assertEqual(len(self.client.buffer), 4)
+
+    def test_unclosed_response_at_exit(self):
+        script = textwrap.dedent("""
+            from usermaven.client import Client
+            from usermaven.middleware import WSGIMiddleware
+
+            client = Client("api_key", "server_token", host="http://127.0.0.1:9")
+
+            def app(environ, start_response):
+                client.track("user_id", "goal_created")
+                start_response("200 OK", [])
+                yield b"head"
+                yield b"body"
+
+            unclosed = WSGIMiddleware(app, client)({}, lambda status, headers: None)
+            started = iter(unclosed)
+            next(started)
+        """)
+        # ending the buffer while the interpreter exits must not start the consumer
+        subprocess.run([sys.executable, "-c", script], timeout=30, check=True)
+
+    def test_wsgi_error(self):
+        def app(environ, start_response):
+            self.track_twice()
+            raise KeyError("request failed")
+
+        self.assertRaises(KeyError, WSGIMiddleware(app, self.client), {}, None)
+        self.assertEqual(len(self.client.buffer), 2)
+
+    def test_asgi(self):
+        async def app(scope, receive, send):
+            self.track_twice()
+            await send({"type": "http.response.start", "status": 200})
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        middleware = ASGIMiddleware(app, client=self.client)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(middleware({"type": "http"}, None, send))
+        finally:
+            loop.close()
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(self.client.buffer), 2)
+
+    def test_django(self):
+        def get_response(request):
+            self.track_twice()
+            return "response"
+
+        self.assertEqual(DjangoMiddleware(get_response, self.client)("request"), "response")
+        self.assertEqual(len(self.client.buffer), 2)
+
+    def test_default_client(self):
+        with mock.patch.object(usermaven, "default_client", self.client):
+            DjangoMiddleware(lambda request: self.track_twice())("request")
+        self.assertEqual(len(self.client.buffer), 2)
+
+        with mock.patch.object(usermaven, "disabled", True):
+            self.assertEqual(DjangoMiddleware(lambda request: "response")("request"), "response")
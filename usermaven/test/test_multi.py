@@ -0,0 +1,136 @@
+import threading
+import time
+import unittest
+from collections import Counter
+
+from usermaven.multi import FairQueue, MultiClient
+from usermaven.testing import FakeIngestionServer
+
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
+
+WORKSPACES = {
+    "acme": ("acme_api_key", "acme_server_token"),
+    "globex": ("globex_api_key", "globex_server_token"),
+    "initech": ("initech_api_key", "initech_server_token"),
+}
+
+
+class TestFairQueue(unittest.TestCase):
+    def test_round_robin(self):
+        q = FairQueue()
+        for i in range(6):
+            q.put("busy", i)
+        q.put("quiet", "a")
+        q.put("other", "b")
+
+        served = [q.get_batch(2, 0, timeout=0) for _ in range(5)]
+        self.assertEqual(
+            served,
+            [("busy", [0, 1]), ("quiet", ["a"]), ("other", ["b"]), ("busy", [2, 3]), ("busy", [4, 5])],
+        )
+        self.assertEqual(q.get_batch(2, 0, timeout=0), (None, []))
+        self.assertEqual(q.qsize(), 0)
+
+    def test_waits_for_a_full_batch_or_interval(self):
+        q = FairQueue()
+        q.put("acme", 1)
+        # not ready: fewer than max_items and younger than the interval
+        self.assertEqual(q.get_batch(10, 60, timeout=0.01), (None, []))
+        q.put("globex", 1)
+        q.put("globex", 2)
+        self.assertEqual(q.get_batch(2, 60, timeout=0.01), ("globex", [1, 2]))
+        self.assertEqual(q.get_batch(10, 0.01, timeout=1), ("acme", [1]))
+
+    def test_waits_until_stopped(self):
+        q = FairQueue()
+        stopped = []
+        served = []
+        thread = threading.Thread(target=lambda: served.append(q.get_batch(10, 0, stop=lambda: bool(stopped))))
+        thread.start()
+        time.sleep(0.05)
+        self.assertTrue(thread.is_alive())
+        stopped.append(True)
+        with q.not_empty:
+            q.not_empty.notify_all()
+        thread.join(1)
+        self.assertEqual(served, [(None, [])])
+
+    def test_bounded(self):
+        q = FairQueue(maxsize=3, workspace_maxsize=2)
+        q.put("acme", 1)
+        q.put("acme", 2)
+        self.assertRaises(Full, q.put, "acme", 3)
+        q.put("globex", 1)
+        self.assertRaises(Full, q.put, "initech", 1)
+
+    def test_task_done(self):
+        q = FairQueue()
+        q.put("acme", 1)
+        q.get_batch(1, 0, timeout=0)
+        q.task_done()
+        q.join()
+        self.assertRaises(ValueError, q.task_done)
+
+
+class TestMultiClient(unittest.TestCase):
+    def setUp(self):
+        # accept any token, each event carries the api_key of the workspace it was sent for
+        self.server = FakeIngestionServer(api_key=None).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, **kwargs):
+        return MultiClient(WORKSPACES, host=self.server.url, flush_interval=0.01, **kwargs)
+
+    def test_batches_per_workspace(self):
+        client = self.client(thread=2, flush_at=10)
+        for i in range(90):
+            workspace = sorted(WORKSPACES)[i % 3]
+            success, msg = client.track(workspace, "user_%d" % i, "goal_created")
+            self.assertTrue(success)
+            self.assertEqual(msg["api_key"], WORKSPACES[workspace][0])
+        client.identify("acme", {"id": "user_1", "email": "user_1@example.com", "created_at": "2022-01-20T09:55:35"})
+        client.shutdown()
+
+        self.assertEqual(self.server.event_count, 91)
+        for batch in self.server.batches:
+            self.assertEqual(len(set(event["api_key"] for event in batch)), 1)
+        counts = Counter(event["api_key"] for event in self.server.events)
+        self.assertEqual(counts, {"acme_api_key": 31, "globex_api_key": 30, "initech_api_key": 30})
+
+    def test_credentials(self):
+        server = FakeIngestionServer(api_key="globex_api_key", server_token="globex_server_token").start()
+        errors = []
+        try:
+            client = MultiClient(WORKSPACES, host=server.url, flush_interval=0.01, thread=1,
+                                 on_error=lambda e, batch: errors.append(e.status))
+            client.track("globex", "user_id", "goal_created")
+            client.track("acme", "user_id", "goal_created")
+            client.shutdown()
+        finally:
+            server.stop()
+        self.assertEqual([e["api_key"] for e in server.events], ["globex_api_key"])
+        self.assertEqual(errors, [401])
+
+    def test_unknown_workspace(self):
+        client = self.client()
+        self.assertRaises(ValueError, client.track, "unknown", "user_id", "goal_created")
+
+    def test_validation(self):
+        client = self.client()
+        self.assertRaises(AssertionError, client.track, "acme", None, "goal_created")
+        client.add_workspace("hooli", "hooli_api_key", "hooli_server_token")
+        client.track("hooli", "user_id", "goal_created")
+        client.shutdown()
+        self.assertEqual([e["api_key"] for e in self.server.events], ["hooli_api_key"])
+
+    def test_workspace_queue_size(self):
+        client = self.client(workspace_queue_size=1)
+        client.join()
+        self.assertTrue(client.track("acme", "user_id", "goal_created")[0])
+        self.assertFalse(client.track("acme", "user_id", "goal_created")[0])
+        self.assertTrue(client.track("globex", "user_id", "goal_created")[0])
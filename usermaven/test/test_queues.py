@@ -0,0 +1,180 @@
+import threading
+import time
+import unittest
+import zlib
+
+from usermaven.queues import ByteQueue, ShardedQueue, drain_queue, join_queue, put_many
+
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+
+
+class TestByteQueue(unittest.TestCase):
+    def test_bounded_by_bytes(self):
+        q = ByteQueue(10)
+        q.put(b"12345", block=False)
+        q.put(b"1234", block=False)
+        self.assertEqual(q.bytes, 9)
+        self.assertRaises(Full, q.put, b"12", block=False)
+        q.put(b"1", block=False)
+        self.assertTrue(q.full())
+
+        self.assertEqual(q.get_nowait(), b"12345")
+        self.assertEqual(q.bytes, 5)
+        q.put(b"12", block=False)
+
+    def test_bounded_by_count(self):
+        q = ByteQueue(100, maxsize=2)
+        q.put(b"1", block=False)
+        q.put(b"2", block=False)
+        self.assertRaises(Full, q.put, b"3", block=False)
+
+    def test_large_item(self):
+        q = ByteQueue(10)
+        # too large for the budget, but accepted into an empty queue
+        q.put(b"x" * 20, block=False)
+        self.assertRaises(Full, q.put, b"1", block=False)
+
+    def test_other_items(self):
+        q = ByteQueue(10)
+        q.put({"event_type": "goal_created"}, block=False)
+        self.assertEqual(q.bytes, 0)
+        q.put(b"1234567890", block=False)
+        self.assertEqual(q.qsize(), 2)
+
+    def test_put_timeout(self):
+        q = ByteQueue(5)
+        q.put(b"12345")
+        self.assertRaises(Full, q.put, b"1", timeout=0.01)
+
+    def test_blocking_put(self):
+        q = ByteQueue(5)
+        q.put(b"12345")
+        putter = threading.Thread(target=q.put, args=(b"123",))
+        putter.start()
+        putter.join(0.05)
+        self.assertTrue(putter.is_alive())
+        q.get()
+        putter.join(1)
+        self.assertFalse(putter.is_alive())
+        self.assertEqual(q.bytes, 3)
+
+
+class TestPutMany(unittest.TestCase):
+    def test_put_many(self):
+        q = Queue(3)
+        q.put("first")
+        self.assertEqual(put_many(q, ["second", "third", "fourth"]), 2)
+        self.assertEqual(q.unfinished_tasks, 3)
+        self.assertEqual(drain_queue(q), ["first", "second", "third"])
+        self.assertTrue(join_queue(q, 0.01))
+
+    def test_put_many_wakes_consumers(self):
+        q = Queue()
+        got = []
+        threads = [threading.Thread(target=lambda: got.append(q.get(timeout=1))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        put_many(q, [1, 2, 3])
+        for thread in threads:
+            thread.join(1)
+        self.assertEqual(sorted(got), [1, 2, 3])
+
+    def test_put_many_bytes(self):
+        q = ByteQueue(10)
+        self.assertEqual(put_many(q, [b"12345", b"1234", b"12", b"1"]), 2)
+        self.assertEqual(q.bytes, 9)
+
+
+class TestShardedQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = ShardedQueue(Queue() for _ in range(4))
+
+    def test_routes_by_key(self):
+        for n in range(100):
+            user = "user_%d" % (n % 10)
+            self.queue.put((user, n), key=user)
+        self.assertEqual(self.queue.qsize(), 100)
+        for shard in self.queue.shards:
+            for user, n in drain_queue(shard):
+                self.assertIs(self.queue.shard_for(user), shard)
+        self.assertTrue(self.queue.empty())
+        # keys are spread over the shards
+        self.assertGreater(len(set(id(self.queue.shard_for("user_%d" % n)) for n in range(10))), 1)
+
+    def test_full(self):
+        q = ShardedQueue([Queue(1)])
+        q.put(1, key="a")
+        self.assertRaises(Full, q.put, 2, key="a")
+
+    def test_put_many(self):
+        users = ["user_%d" % (n % 10) for n in range(100)]
+        self.assertEqual(self.queue.put_many([(user, n) for n, user in enumerate(users)], users), 100)
+        for shard in self.queue.shards:
+            items = drain_queue(shard)
+            self.assertEqual(items, sorted(items, key=lambda item: item[1]))
+            for user, n in items:
+                self.assertIs(self.queue.shard_for(user), shard)
+
+        q = ShardedQueue([Queue(1)])
+        self.assertEqual(q.put_many([1, 2], ["a", "a"]), 1)
+
+    def test_add_shard_holds_items_until_drained(self):
+        self.queue.put("first", key="user")
+        added = []
+        thread = threading.Thread(target=lambda: added.append(self.queue.add_shard(Queue())))
+        thread.start()
+        time.sleep(0.05)
+        # while the shards drain, new items are held back
+        self.queue.put("second", key="user")
+        self.assertEqual(self.queue.qsize(), 2)
+        self.assertEqual(drain_queue(self.queue.shard_for("user")), ["first"])
+        thread.join(1)
+
+        self.assertEqual(added, [True])
+        self.assertEqual(len(self.queue.shards), 5)
+        self.assertEqual(self.queue.shard_for("user").get_nowait(), "second")
+
+    def test_add_shard_does_not_block(self):
+        q = ShardedQueue([Queue(2), Queue(2)])
+        q.put("first", key="user")
+        added = []
+        thread = threading.Thread(target=lambda: added.append(q.add_shard(Queue(2), timeout=5)))
+        thread.start()
+        time.sleep(0.05)
+        # once added, the new shard has no consumer yet
+        users = [user for user in ("user_%d" % n for n in range(100)) if zlib.crc32(user.encode()) % 3 == 2][:4]
+        for user in users:
+            q.put(user, key=user)
+        with self.assertLogs("usermaven", "WARNING"):
+            drain_queue(q.shard_for("user"))
+            thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(added, [True])
+        self.assertEqual(drain_queue(q.shards[2]), users[:2])
+        q.put("next", key=users[0])
+
+    def test_drain_held_items(self):
+        self.queue.put("first", key="user")
+        thread = threading.Thread(target=self.queue.add_shard, args=(Queue(), 0.2))
+        thread.start()
+        time.sleep(0.05)
+        self.queue.put("second", key="user")
+        self.assertEqual(drain_queue(self.queue), ["first", "second"])
+        thread.join(1)
+        self.assertTrue(self.queue.empty())
+
+    def test_add_shard_timeout(self):
+        self.queue.put("first", key="user")
+        self.assertFalse(self.queue.add_shard(Queue(), timeout=0.01))
+        self.assertEqual(len(self.queue.shards), 4)
+        self.queue.put("second", key="user")
+        self.assertEqual(drain_queue(self.queue), ["first", "second"])
+
+    def test_join_queue(self):
+        self.queue.put("first", key="user")
+        self.assertFalse(join_queue(self.queue, 0.01))
+        drain_queue(self.queue)
+        self.assertTrue(join_queue(self.queue, 0.01))
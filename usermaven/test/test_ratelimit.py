@@ -0,0 +1,122 @@
+import time
+import unittest
+
+from usermaven.client import Client
+from usermaven.ratelimit import RateLimited, RateLimiter
+from usermaven.request import APIError, encode_event
+from usermaven.test.test_circuit import FakeClock
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+
+def throttle(retry_after=None, batch=None):
+    raise APIError(429, "too many requests", retry_after)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.clock.advance(seconds)
+
+    def limiter(self, **kwargs):
+        return RateLimiter(clock=self.clock, sleep=self.sleep, **kwargs)
+
+    def test_needs_a_rate(self):
+        self.assertRaises(ValueError, RateLimiter)
+
+    def test_events_per_second(self):
+        limiter = self.limiter(events_per_second=100)
+        # a second worth of events goes out at once, then they are paced
+        for _ in range(15):
+            limiter.acquire(10)
+        self.assertEqual(len(self.sleeps), 5)
+        self.assertAlmostEqual(self.clock.now, 0.5)
+
+    def test_bytes_per_second(self):
+        limiter = self.limiter(bytes_per_second=1000)
+        limiter.acquire(1, 1000)
+        limiter.acquire(1, 500)
+        self.assertAlmostEqual(self.clock.now, 0.5)
+        # a request larger than the bucket waits for a full bucket
+        limiter.acquire(1, 5000)
+        self.assertAlmostEqual(self.clock.now, 1.5)
+        limiter.acquire(1, 1000)
+        self.assertAlmostEqual(self.clock.now, 6.5)
+
+    def test_call_counts_batch_bytes(self):
+        limiter = self.limiter(bytes_per_second=100)
+        batch = [encode_event({"event_type": "x" * 40}), {"event_type": "y" * 40}]
+        self.assertEqual(limiter.call(lambda batch: len(batch), batch=batch), 2)
+        self.assertEqual(limiter.bytes.tokens, 100 - len(batch[0]) - len(encode_event(batch[1])))
+
+    def test_deadline(self):
+        limiter = self.limiter(events_per_second=10)
+        self.assertTrue(limiter.acquire(10, deadline=0.5))
+        self.assertFalse(limiter.acquire(10, deadline=0.5))
+        self.assertEqual(self.sleeps, [])
+        self.assertRaises(RateLimited, limiter.call, lambda batch: None, batch=[1] * 10, deadline=0.5)
+
+    def test_decreases_on_429(self):
+        limiter = self.limiter(events_per_second=100, decrease=0.5)
+        self.assertRaises(APIError, limiter.call, throttle, batch=[1])
+        self.assertEqual(limiter.factor, 0.5)
+        # a request sent before the decrease does not decrease the rate again
+        limiter.throttled(started=-1)
+        self.assertEqual(limiter.factor, 0.5)
+        self.assertRaises(APIError, limiter.call, throttle, batch=[1])
+        # grown a little while waiting for the emptied bucket
+        self.assertAlmostEqual(limiter.factor, 0.25, places=2)
+        self.assertEqual(limiter.throttled_count, 3)
+
+        limiter.acquire(25)
+        self.assertAlmostEqual(self.clock.now, 1.0, places=1)
+
+    def test_increases_again(self):
+        limiter = self.limiter(events_per_second=100, decrease=0.5, increase=0.1)
+        limiter.throttled(started=0)
+        self.clock.advance(2)
+        limiter.acquire(0)
+        self.assertAlmostEqual(limiter.factor, 0.7)
+        self.clock.advance(10)
+        limiter.acquire(0)
+        self.assertEqual(limiter.factor, 1.0)
+
+    def test_retry_after_pauses(self):
+        limiter = self.limiter(events_per_second=1000)
+        self.assertRaises(APIError, limiter.call, throttle, 2, batch=[1])
+        self.assertFalse(limiter.acquire(1, deadline=1))
+        limiter.acquire(1)
+        self.assertEqual(self.sleeps, [2])
+
+
+class TestRateLimitedClient(unittest.TestCase):
+    def test_retry_after(self):
+        with FakeIngestionServer(retry_after=1) as server:
+            server.inject(429)
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, flush_interval=0.01)
+            started = time.monotonic()
+            client.track("user_id", "goal_created")
+            client.flush()
+
+        self.assertGreaterEqual(time.monotonic() - started, 1)
+        self.assertEqual(server.event_count, 1)
+
+    def test_stays_under_quota(self):
+        with FakeIngestionServer(quota=2000, record=False) as server:
+            limiter = RateLimiter(events_per_second=4000)
+            client = Client(API_KEY, SERVER_TOKEN, host=server.url, max_queue_size=0, thread=4, flush_at=50,
+                            rate_limiter=limiter)
+            started = time.monotonic()
+            for i in range(6000):
+                client.track("user_%d" % (i % 10), "goal_created")
+            client.flush()
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(server.event_count, 6000)
+        # the server lets a second worth of events through at once
+        self.assertLess(server.event_count, (elapsed + 1.5) * 2000)
+        self.assertLess(server.statuses[429], 20)
+        self.assertEqual(limiter.throttled_count, server.statuses[429])
@@ -1,11 +1,23 @@
 import json
+import time
 import unittest
 from datetime import date, datetime
+from email.utils import formatdate
 
 import requests
 
-from usermaven.request import DatetimeSerializer, batch_post
+from usermaven.request import (
+    APIError,
+    DatetimeSerializer,
+    batch_post,
+    cap_timeout,
+    decode_batch,
+    encode_batch,
+    encode_event,
+    parse_retry_after,
+)
 from usermaven.test.test_utils import TEST_SERVER_TOKEN, TEST_API_KEY
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
 
 
 class TestRequests(unittest.TestCase):
@@ -40,3 +52,32 @@ class TestRequests(unittest.TestCase):
         with self.assertRaises(requests.ReadTimeout):
             batch_post(
                 "key", "token", batch=[{"user_id": "user_id", "event_type": "track"}], timeout=0.0001)
+
+    def test_encode_batch(self):
+        events = [{"event_type": "a", "created": datetime(2012, 3, 4)}, {"event_type": "b"}]
+        body = encode_batch([encode_event(events[0]), events[1]])
+        self.assertEqual(json.loads(body.decode()), [{"event_type": "a", "created": "2012-03-04T00:00:00"},
+                                                     {"event_type": "b"}])
+        self.assertEqual(decode_batch([encode_event(events[1]), events[1]]), [events[1], events[1]])
+
+    def test_cap_timeout(self):
+        self.assertEqual(cap_timeout(15, None), 15)
+        self.assertEqual(cap_timeout(15, 2), 2)
+        self.assertEqual(cap_timeout((3, 15), 5), (3, 5))
+        self.assertEqual(cap_timeout((3, 15), -1), (0.001, 0.001))
+
+    def test_parse_retry_after(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertEqual(parse_retry_after("30"), 30)
+        self.assertEqual(parse_retry_after("-1"), 0)
+        self.assertAlmostEqual(parse_retry_after(formatdate(time.time() + 60, usegmt=True)), 60, delta=2)
+        self.assertEqual(parse_retry_after(formatdate(time.time() - 60, usegmt=True)), 0)
+
+    def test_retry_after(self):
+        with FakeIngestionServer(retry_after=7) as server:
+            server.inject(429)
+            with self.assertRaises(APIError) as cm:
+                batch_post(API_KEY, SERVER_TOKEN, server.url, batch=[{"event_type": "track"}])
+        self.assertEqual(cm.exception.status, 429)
+        self.assertEqual(cm.exception.retry_after, 7)
@@ -0,0 +1,82 @@
+import unittest
+
+import mock
+
+from usermaven.rollup import Rollup
+
+
+class TestRollup(unittest.TestCase):
+    def setUp(self):
+        self.emit = mock.Mock()
+        self.rollup = Rollup(self.emit, interval=3600, max_keys=2)
+
+    def tearDown(self):
+        self.rollup.stop()
+
+    def test_aggregates_per_key(self):
+        self.rollup.add("user_id", "api_call")
+        self.rollup.add("user_id", "api_call", by=4)
+        self.assertEqual(self.rollup.flush(), 1)
+
+        self.assertEqual(self.emit.call_count, 1)
+        user_id, event_type, company, event_attributes = self.emit.call_args[0]
+        self.assertEqual(user_id, "user_id")
+        self.assertEqual(event_type, "api_call")
+        self.assertEqual(company, {})
+        self.assertEqual(event_attributes["count"], 5)
+        self.assertIn("window_start", event_attributes)
+        self.assertIn("window_end", event_attributes)
+
+    def test_dims_are_part_of_the_key(self):
+        self.rollup.add("user_id", "api_call", dims={"endpoint": "/a"})
+        self.rollup.add("user_id", "api_call", dims={"endpoint": "/b"})
+        self.rollup.add("user_id", "api_call", dims={"endpoint": "/a"})
+        self.rollup.flush()
+
+        counts = {c[0][3]["endpoint"]: c[0][3]["count"] for c in self.emit.call_args_list}
+        self.assertEqual(counts, {"/a": 2, "/b": 1})
+
+    def test_company_is_part_of_the_key(self):
+        company = {"id": "5", "name": "Usermaven", "created_at": "2022-12-12T19:11:49"}
+        self.rollup.add("user_id", "api_call", company=company)
+        self.rollup.add("user_id", "api_call")
+        self.rollup.flush()
+
+        companies = sorted(c[0][2].get("id", "") for c in self.emit.call_args_list)
+        self.assertEqual(companies, ["", "5"])
+
+    def test_flush_starts_a_new_window(self):
+        self.rollup.add("user_id", "api_call")
+        self.rollup.flush()
+        self.assertEqual(self.rollup.flush(), 0)
+        self.assertEqual(self.emit.call_count, 1)
+
+    def test_evicts_oldest_key_on_overflow(self):
+        self.rollup.add("user_1", "api_call")
+        self.rollup.add("user_2", "api_call")
+        self.rollup.add("user_1", "api_call")
+        self.assertFalse(self.emit.called)
+
+        self.rollup.add("user_3", "api_call")
+        self.assertEqual(self.emit.call_count, 1)
+        self.assertEqual(self.emit.call_args[0][0], "user_1")
+        self.assertEqual(self.emit.call_args[0][3]["count"], 2)
+        self.assertEqual(self.rollup.evicted, 1)
+        self.assertEqual(len(self.rollup.counters), 2)
+
+    def test_unhashable_dims(self):
+        with self.assertRaises(ValueError):
+            self.rollup.add("user_id", "api_call", dims={"tags": ["a", "b"]})
+
+    def test_window_timer(self):
+        rollup = Rollup(self.emit, interval=0.05)
+        rollup.add("user_id", "api_call")
+        rollup._stopped.wait(0.3)
+        rollup.stop()
+        self.assertEqual(self.emit.call_count, 1)
+
+    def test_emit_errors_are_logged(self):
+        self.emit.side_effect = Exception("boom")
+        self.rollup.add("user_id", "api_call")
+        self.rollup.flush()
+        self.assertEqual(self.emit.call_count, 1)
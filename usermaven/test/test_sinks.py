@@ -0,0 +1,90 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from usermaven.request import APIError
+from usermaven.sinks import DeadLetterSink, FileSink, hand_to_sink, make_sink, read_undelivered
+
+
+class TestSinks(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "undelivered.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_file_sink(self):
+        sink = FileSink(self.path)
+        sink([{"n": 1}, {"n": 2}], APIError(503, "Service Unavailable"))
+        sink([{"n": 3}])
+
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]["batch"], [{"n": 1}, {"n": 2}])
+        self.assertEqual(records[0]["status"], 503)
+        self.assertIn("Service Unavailable", records[0]["error"])
+        self.assertEqual(records[1], {"batch": [{"n": 3}], "error": None, "status": None})
+
+    def test_dead_letter_sink(self):
+        directory = os.path.join(self.dir, "dead")
+        sink = DeadLetterSink(directory)
+        error = APIError(503, "Service Unavailable")
+        error.attempts = 4
+        sink([{"n": 1}], error)
+        sink([{"n": 2}])
+
+        (name,) = os.listdir(directory)
+        self.assertTrue(name.startswith("undelivered-") and name.endswith(".jsonl.gz"))
+        with gzip.open(os.path.join(directory, name), "rt") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r["batch"] for r in records], [[{"n": 1}], [{"n": 2}]])
+        self.assertEqual((records[0]["status"], records[0]["attempts"]), (503, 4))
+        self.assertEqual((records[1]["status"], records[1]["attempts"]), (None, None))
+        self.assertIn("failed_at", records[0])
+
+    def test_dead_letter_sink_rotates(self):
+        sink = DeadLetterSink(self.dir, max_bytes=1)
+        for n in range(3):
+            sink([{"n": n}])
+        names = sorted(os.listdir(self.dir))
+        self.assertEqual(len(names), 3)
+        batches = [record["batch"] for name in names for _, record in read_undelivered(os.path.join(self.dir, name))]
+        self.assertEqual(batches, [[{"n": 0}], [{"n": 1}], [{"n": 2}]])
+
+    def test_read_undelivered(self):
+        FileSink(self.path)([{"n": 1}])
+        self.assertEqual(list(read_undelivered(self.path)), [(1, {"batch": [{"n": 1}], "error": None, "status": None})])
+
+    def test_read_torn_record(self):
+        sink = DeadLetterSink(self.dir)
+        sink([{"n": 1}])
+        first = os.path.getsize(sink.path)
+        sink([{"n": 2}])
+        with open(sink.path, "rb") as f:
+            data = f.read()
+        # in the compressed data, and in the gzip header
+        for cut in (12, len(data) - first - 3):
+            # the process died while writing the second record
+            with open(sink.path, "wb") as f:
+                f.write(data[:len(data) - cut])
+            with self.assertLogs("usermaven", "WARNING"):
+                records = list(read_undelivered(sink.path))
+            self.assertEqual([record["batch"] for _, record in records], [[{"n": 1}]])
+
+    def test_make_sink(self):
+        self.assertIsNone(make_sink(None))
+        fn = mock.Mock()
+        self.assertIs(make_sink(fn), fn)
+        self.assertIsInstance(make_sink(self.path), FileSink)
+
+    def test_hand_to_sink_swallows_errors(self):
+        sink = mock.Mock(side_effect=IOError("disk full"))
+        hand_to_sink(sink, [{"n": 1}], None)
+        sink.assert_called_once_with([{"n": 1}], None)
+        hand_to_sink(None, [{"n": 1}], None)
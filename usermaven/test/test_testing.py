@@ -0,0 +1,95 @@
+import gzip
+import json
+import unittest
+
+import requests
+
+from usermaven.client import Client
+from usermaven.request import APIError, batch_post
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+
+
+class TestFakeIngestionServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIngestionServer().start()
+        self.track = {"user_id": "user_id", "event_type": "python event track"}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_records_batches(self):
+        batch_post(API_KEY, SERVER_TOKEN, self.server.url, batch=[self.track, self.track])
+        batch_post(API_KEY, SERVER_TOKEN, self.server.url, batch=[self.track])
+        self.assertEqual(len(self.server.batches), 2)
+        self.assertEqual(self.server.events, [self.track] * 3)
+        self.assertEqual(self.server.event_count, 3)
+        self.assertEqual(self.server.statuses[200], 2)
+
+    def test_rejects_invalid_token(self):
+        with self.assertRaises(APIError) as cm:
+            batch_post(API_KEY, "wrong_token", self.server.url, batch=[self.track])
+        self.assertEqual(cm.exception.status, 401)
+        self.assertEqual(self.server.events, [])
+
+    def test_rejects_large_bodies(self):
+        server = FakeIngestionServer(max_body_size=100).start()
+        try:
+            with self.assertRaises(APIError) as cm:
+                batch_post(API_KEY, SERVER_TOKEN, server.url, batch=[self.track] * 10)
+            self.assertEqual(cm.exception.status, 413)
+        finally:
+            server.stop()
+
+    def test_inject(self):
+        self.server.inject(429)
+        self.server.inject(503, count=2)
+        statuses = []
+        for _ in range(4):
+            try:
+                batch_post(API_KEY, SERVER_TOKEN, self.server.url, batch=[self.track])
+                statuses.append(200)
+            except APIError as e:
+                statuses.append(e.status)
+        self.assertEqual(statuses, [429, 503, 503, 200])
+        self.assertEqual(self.server.event_count, 1)
+
+    def test_reject(self):
+        self.server.reject = lambda event: event["event_type"] == "poison"
+        with self.assertRaises(APIError) as cm:
+            batch_post(API_KEY, SERVER_TOKEN, self.server.url, batch=[self.track, {"event_type": "poison"}])
+        self.assertEqual(cm.exception.status, 400)
+        batch_post(API_KEY, SERVER_TOKEN, self.server.url, batch=[self.track])
+        self.assertEqual(self.server.events, [self.track])
+
+    def test_quota(self):
+        server = FakeIngestionServer(quota=10).start()
+        try:
+            batch_post(API_KEY, SERVER_TOKEN, server.url, batch=[self.track] * 8)
+            with self.assertRaises(APIError) as cm:
+                batch_post(API_KEY, SERVER_TOKEN, server.url, batch=[self.track] * 8)
+            self.assertEqual(cm.exception.status, 429)
+            self.assertEqual(server.event_count, 8)
+        finally:
+            server.stop()
+
+    def test_gzip(self):
+        body = gzip.compress(json.dumps([self.track]).encode())
+        res = requests.post(
+            self.server.url + "/api/v1/s2s/event/",
+            params={"token": API_KEY + "." + SERVER_TOKEN},
+            data=body,
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.server.events, [self.track])
+
+    def test_client(self):
+        client = Client(API_KEY, SERVER_TOKEN, host=self.server.url, flush_interval=0.05)
+        for i in range(150):
+            client.track("user_%d" % i, "goal_created")
+        client.shutdown()
+        self.assertTrue(self.server.wait_for_events(150, timeout=1))
+        self.assertEqual([e["user"]["id"] for e in self.server.events], ["user_%d" % i for i in range(150)])
+
+    def test_wait_for_events_timeout(self):
+        self.assertFalse(self.server.wait_for_events(1, timeout=0.05))
@@ -0,0 +1,134 @@
+import io
+import unittest
+
+import mock
+
+from usermaven.client import Client
+from usermaven.testing import API_KEY, SERVER_TOKEN, FakeIngestionServer
+from usermaven.tracing import NOOP_TRACER, OpenTelemetryTracer, Profiler, Tracer
+
+
+class TestTracer(unittest.TestCase):
+    def test_span(self):
+        spans = []
+        tracer = Tracer(lambda stage, duration, attributes: spans.append((stage, duration, attributes)))
+        with tracer.span("request", size=3):
+            pass
+        self.assertEqual(len(spans), 1)
+        stage, duration, attributes = spans[0]
+        self.assertEqual(stage, "request")
+        self.assertGreaterEqual(duration, 0)
+        self.assertEqual(attributes, {"size": 3})
+
+    def test_span_error(self):
+        spans = []
+        tracer = Tracer(lambda stage, duration, attributes: spans.append(attributes))
+        with self.assertRaises(ValueError):
+            with tracer.span("clean"):
+                raise ValueError("invalid")
+        self.assertEqual(spans, [{"error": "ValueError('invalid')"}])
+
+    def test_sample_rate(self):
+        spans = []
+        tracer = Tracer(lambda *args: spans.append(args), sample_rate=0)
+        for _ in range(100):
+            with tracer.span("enqueue"):
+                pass
+        self.assertEqual(spans, [])
+
+        tracer.sample_rate = 0.5
+        with mock.patch("usermaven.tracing.random.random", side_effect=[0.2, 0.7]):
+            for _ in range(2):
+                with tracer.span("enqueue"):
+                    pass
+        self.assertEqual(len(spans), 1)
+
+    def test_noop(self):
+        self.assertFalse(NOOP_TRACER.enabled)
+        with NOOP_TRACER.span("request"):
+            pass
+        NOOP_TRACER.record("request", 1.0)
+
+    def test_profiler_report(self):
+        profiler = Profiler()
+        profiler.record("request", 0.5)
+        profiler.record("request", 1.5)
+        profiler.record("clean", 0.001)
+        self.assertEqual(profiler.stats["request"], [2, 2.0, 1.5])
+
+        out = io.StringIO()
+        profiler.report(out)
+        lines = out.getvalue().splitlines()
+        # stages are listed in pipeline order
+        self.assertTrue(lines[2].startswith("clean"))
+        self.assertTrue(lines[3].startswith("request"))
+        self.assertIn("2000.0", lines[3])
+
+    def test_opentelemetry(self):
+        otel = mock.Mock()
+        tracer = OpenTelemetryTracer(otel)
+        tracer.record("request", 0.25, size=10)
+        name = otel.start_span.call_args[0][0]
+        kwargs = otel.start_span.call_args[1]
+        self.assertEqual(name, "usermaven.request")
+        self.assertEqual(kwargs["attributes"], {"size": 10})
+        end_time = otel.start_span.return_value.end.call_args[1]["end_time"]
+        self.assertEqual(end_time - kwargs["start_time"], 250000000)
+
+
+class TestClientTracing(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIngestionServer().start()
+        self.spans = []
+        self.tracer = Tracer(lambda stage, duration, attributes: self.spans.append((stage, attributes)))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, **kwargs):
+        return Client(API_KEY, SERVER_TOKEN, host=self.server.url, flush_interval=0.05, tracer=self.tracer, **kwargs)
+
+    def stages(self):
+        return set(stage for stage, _ in self.spans)
+
+    def test_stages(self):
+        client = self.client()
+        for i in range(10):
+            client.track("user_%d" % i, "goal_created")
+        client.shutdown()
+        self.assertEqual(self.server.event_count, 10)
+        self.assertEqual(self.stages(), {"clean", "enqueue", "queue_wait", "serialize", "batch", "request"})
+        self.assertEqual(sum(a["size"] for stage, a in self.spans if stage == "batch"), 10)
+
+    def test_deferred_clean(self):
+        client = self.client(defer_processing=True)
+        client.track("user_id", "goal_created")
+        client.shutdown()
+        self.assertIn("clean", self.stages())
+
+    def test_retry(self):
+        self.server.inject(503)
+        client = self.client(max_retries=2)
+        client.track("user_id", "goal_created")
+        client.shutdown()
+        self.assertEqual(self.server.event_count, 1)
+        requests = [a for stage, a in self.spans if stage == "request"]
+        self.assertEqual(len(requests), 2)
+        self.assertIn("error", requests[0])
+        self.assertEqual([a["tries"] for stage, a in self.spans if stage == "retry"], [1])
+
+    def test_serverless(self):
+        client = self.client(serverless=True)
+        client.track("user_id", "goal_created")
+        client.flush()
+        self.assertEqual(self.stages(), {"clean", "enqueue", "request"})
+
+    def test_profile(self):
+        client = Client(API_KEY, SERVER_TOKEN, host=self.server.url, flush_interval=0.05, profile=True)
+        client.track("user_id", "goal_created")
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            client.shutdown()
+            client.join()
+        report = stderr.getvalue()
+        self.assertEqual(report.count("usermaven pipeline profile"), 1)
+        self.assertIn("request", report)
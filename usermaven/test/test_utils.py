@@ -1,10 +1,9 @@
+import threading
 import unittest
 from datetime import date, datetime, timedelta
 from decimal import Decimal
 from uuid import UUID
 
-import six
-
 from usermaven import utils
 
 TEST_SERVER_TOKEN = "5ce1039f-e554-41f2-bcb6-55958cfcce0c"
@@ -17,7 +16,7 @@ class TestUtils(unittest.TestCase):
     def test_clean(self):
         simple = {
             "decimal": Decimal("0.142857"),
-            "unicode": six.u("woo"),
+            "unicode": u"woo",
             "date": datetime.now(),
             "long": 200000000,
             "integer": 1,
@@ -52,10 +51,7 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(dict_with_dates, utils.clean(dict_with_dates))
 
     def test_bytes(self):
-        if six.PY3:
-            item = bytes(10)
-        else:
-            item = bytearray(10)
+        item = bytes(10)
 
         utils.clean(item)
 
@@ -69,3 +65,17 @@ class TestUtils(unittest.TestCase):
     def test_remove_slash(self):
         self.assertEqual("http://usermaven.io", utils.remove_trailing_slash("http://usermaven.io/"))
         self.assertEqual("http://usermaven.io", utils.remove_trailing_slash("http://usermaven.io"))
+
+    def test_thread_var(self):
+        var = utils.ThreadVar("var")
+        self.assertIsNone(var.get())
+        token = var.set([])
+        var.get().append(1)
+        values = []
+        thread = threading.Thread(target=lambda: values.append(var.get()))
+        thread.start()
+        thread.join()
+        self.assertEqual(values, [None])
+        self.assertEqual(var.get(), [1])
+        var.reset(token)
+        self.assertIsNone(var.get())
@@ -0,0 +1,84 @@
+import unittest
+from uuid import UUID
+
+from usermaven.validation import COMPANY, USER, CompanyCache
+
+
+class TestShape(unittest.TestCase):
+    def setUp(self):
+        self.company = {"id": "5", "name": "Usermaven", "created_at": "2022-12-12T19:11:49"}
+
+    def test_returns_known_fields(self):
+        company = dict(self.company, custom={"plan": "enterprise"}, unknown="dropped")
+        self.assertEqual(COMPANY(company), dict(self.company, custom={"plan": "enterprise"}))
+
+    def test_missing_field(self):
+        with self.assertRaises(ValueError):
+            COMPANY({"id": "5", "name": "Usermaven"})
+
+    def test_missing_field_before_wrong_type(self):
+        # as the require() chain did, a missing field wins over an earlier one of the wrong type
+        with self.assertRaises(ValueError):
+            USER({"id": [1], "email": "a"})
+        with self.assertRaises(ValueError):
+            COMPANY({"id": None, "name": "n"})
+
+    def test_wrong_type(self):
+        with self.assertRaises(AssertionError) as cm:
+            COMPANY(dict(self.company, name=5))
+        self.assertIn("company_name", str(cm.exception))
+        with self.assertRaises(AssertionError):
+            COMPANY(dict(self.company, custom="enterprise"))
+        with self.assertRaises(AssertionError):
+            COMPANY("5")
+
+    def test_user(self):
+        user = {"id": 1, "email": "user@example.com", "created_at": "2022-12-12T19:11:49"}
+        self.assertEqual(USER(user), user)
+        with self.assertRaises(ValueError):
+            USER({"id": 1})
+
+
+class TestCompanyCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = CompanyCache(maxsize=2)
+        self.company = {"id": "5", "name": "Usermaven", "created_at": "2022-12-12T19:11:49",
+                        "custom": {"plan": "enterprise", "seats": 20, "uuid": UUID(int=1)}}
+
+    def test_caches_cleaned_block(self):
+        block = self.cache.get(self.company)
+        self.assertEqual(block["custom"]["uuid"], str(UUID(int=1)))
+        self.assertIs(self.cache.get(dict(self.company)), block)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_changed_company_is_a_miss(self):
+        block = self.cache.get(self.company)
+        self.company["custom"]["seats"] = 21
+        changed = self.cache.get(self.company)
+        self.assertIsNot(changed, block)
+        self.assertEqual(changed["custom"]["seats"], 21)
+        self.assertEqual(block["custom"]["seats"], 20)
+
+    def test_keeps_value_types_apart(self):
+        self.assertIs(self.cache.get(dict(self.company, custom={"flag": 1}))["custom"]["flag"], 1)
+        self.assertIs(self.cache.get(dict(self.company, custom={"flag": True}))["custom"]["flag"], True)
+
+    def test_bounded(self):
+        for i in range(5):
+            self.cache.get(dict(self.company, id=str(i)))
+        self.assertEqual(len(self.cache.blocks), 2)
+
+    def test_unhashable_values_are_not_cached(self):
+        company = dict(self.company, custom={"data": bytearray(b"abc")})
+        self.assertEqual(self.cache.get(company)["custom"]["data"], "abc")
+        self.assertEqual(len(self.cache.blocks), 0)
+
+    def test_validates(self):
+        with self.assertRaises(ValueError):
+            self.cache.get({"id": "5"})
+        self.assertEqual(len(self.cache.blocks), 0)
+
+    def test_disabled(self):
+        cache = CompanyCache(maxsize=0)
+        self.assertEqual(cache.get(self.company)["id"], "5")
+        self.assertEqual(len(cache.blocks), 0)
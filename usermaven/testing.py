@@ -0,0 +1,253 @@
+"""An in-process fake of the Usermaven ingestion API for tests and load tests.
+
+`FakeIngestionServer` implements the s2s event endpoint on a local port and
+records every batch it accepts, so a `Client` can be pointed at it with
+`host=server.url`. Faults can be injected with `inject()` or with the
+`error_rate`, `rate_limit_rate`, `latency` and `slow_rate`/`slow_latency`
+(a fraction of requests answered after a longer delay) attributes. With a
+`quota`, in events per second, batches beyond it are answered with a 429
+like the ingestion API does once a workspace exceeds its quota. Bodies in the
+`usermaven.compact` encoding are expanded and recorded as plain events.
+
+The pytest fixtures `usermaven_server` and `usermaven_client` are available by
+adding `pytest_plugins = ["usermaven.testing"]` to a `conftest.py`.
+"""
+import gzip
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+try:
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from urlparse import parse_qs, urlparse
+
+from usermaven.client import Client
+from usermaven.compact import expand_batch
+
+EVENT_PATH = "/api/v1/s2s/event/"
+# Mirrors the limit enforced by the real ingestion servers.
+MAX_BODY_SIZE = 500 << 10
+
+API_KEY = "testing_api_key"
+SERVER_TOKEN = "testing_server_token"
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeIngestionServer(object):
+    """A threaded HTTP server implementing the s2s event endpoint.
+
+    Requests must carry `token=<api_key>.<server_token>` (pass `api_key=None`
+    to accept any token) and bodies over `max_body_size` bytes are rejected
+    with a 413. Batches holding an event for which `reject(event)` is true are
+    rejected with a 400, like a malformed event would be. Accepted batches are appended to `batches` unless `record` is
+    False, in which case only the counters are kept.
+    """
+
+    def __init__(
+        self,
+        api_key=API_KEY,
+        server_token=SERVER_TOKEN,
+        max_body_size=MAX_BODY_SIZE,
+        latency=0,
+        slow_rate=0,
+        slow_latency=0,
+        error_rate=0,
+        rate_limit_rate=0,
+        retry_after=0,
+        quota=None,
+        reject=None,
+        record=True,
+        seed=None,
+    ):
+        self.api_key = api_key
+        self.server_token = server_token
+        self.max_body_size = max_body_size
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        # events per second, refilled continuously, with a burst of one second worth
+        self.quota = quota
+        self._quota_tokens = quota or 0
+        self._quota_updated = time.monotonic()
+        self.reject = reject
+        self.record = record
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.received = threading.Condition(self.lock)
+        self._injected = deque()
+        self.reset()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    @property
+    def events(self):
+        """All accepted events, in the order their batches arrived."""
+        with self.lock:
+            return [event for batch in self.batches for event in batch]
+
+    def reset(self):
+        """Forget everything received so far, including pending injected faults."""
+        with self.lock:
+            self.batches = []
+            self.statuses = Counter()
+            self.request_count = 0
+            self.event_count = 0
+            self.byte_count = 0
+            self._injected.clear()
+
+    def inject(self, status, count=1):
+        """Answer the next `count` requests with `status` instead of accepting them."""
+        with self.lock:
+            self._injected.extend([status] * count)
+
+    def wait_for_events(self, count, timeout=5):
+        """Block until at least `count` events have been accepted, return whether they were."""
+        deadline = time.time() + timeout
+        with self.received:
+            while self.event_count < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.received.wait(remaining)
+            return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="usermaven-fake-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, path, token, body):
+        """Return `(status, detail)` for a request, recording the batch if it is accepted."""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.slow_rate and self.random.random() < self.slow_rate:
+            time.sleep(self.slow_latency)
+        with self.lock:
+            status, detail, batch = self._check(path, token, body)
+            self.request_count += 1
+            self.statuses[status] += 1
+            if status != 200:
+                return status, detail
+            self.event_count += len(batch)
+            self.byte_count += len(body)
+            if self.record:
+                self.batches.append(batch)
+            self.received.notify_all()
+        return 200, None
+
+    def _check(self, path, token, body):
+        """Return `(status, detail, batch)` for a request."""
+        if not path.startswith(EVENT_PATH):
+            return 404, "not found", None
+        if self.api_key is not None and token != self.api_key + "." + self.server_token:
+            return 401, "invalid token", None
+        if len(body) > self.max_body_size:
+            return 413, "payload too large", None
+        if self._injected:
+            return self._injected.popleft(), "injected fault", None
+        roll = self.random.random()
+        if roll < self.error_rate:
+            return 500, "internal server error", None
+        if roll < self.error_rate + self.rate_limit_rate:
+            return 429, "too many requests", None
+        try:
+            # compact bodies are expanded like an endpoint accepting them would
+            batch = expand_batch(json.loads(body.decode("utf-8")))
+        except ValueError:
+            return 400, "body is not a valid batch", None
+        if self.reject is not None and any(self.reject(event) for event in batch):
+            return 400, "batch contains a rejected event", None
+        if self.quota and not self._take_quota(len(batch)):
+            return 429, "quota exceeded", None
+        return 200, None, batch
+
+    def _take_quota(self, events):
+        now = time.monotonic()
+        self._quota_tokens = min(self._quota_tokens + (now - self._quota_updated) * self.quota, self.quota)
+        self._quota_updated = now
+        if self._quota_tokens < min(events, self.quota):
+            return False
+        self._quota_tokens -= events
+        return True
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, don't let Nagle's algorithm hold the body back
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                token = parse_qs(url.query).get("token", [None])[0]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+
+                status, detail = fake.handle(url.path, token, body)
+                payload = json.dumps({"status": "ok"} if status == 200 else {"detail": detail}).encode()
+                try:
+                    self.send_response(status)
+                    if status == 429:
+                        self.send_header("Retry-After", str(fake.retry_after))
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client timed out and went away, like a real client would
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+if pytest is not None:
+
+    @pytest.fixture
+    def usermaven_server():
+        """A running `FakeIngestionServer`, stopped after the test."""
+        with FakeIngestionServer() as server:
+            yield server
+
+    @pytest.fixture
+    def usermaven_client(usermaven_server):
+        """A `Client` that sends to `usermaven_server`, shut down after the test."""
+        client = Client(API_KEY, SERVER_TOKEN, host=usermaven_server.url, flush_interval=0.05)
+        yield client
+        client.shutdown()
@@ -0,0 +1,147 @@
+"""Optional hooks that time each stage of the send pipeline.
+
+Stages are `clean` and `enqueue` on the calling thread, then `queue_wait`,
+`serialize` and `batch` while a consumer assembles a batch, `request` for
+every HTTP attempt and `retry` for every backoff sleep between attempts.
+
+Pass `tracer=Tracer(callback)` to a `Client` to receive
+`callback(stage, duration, attributes)` for each of them,
+`tracer=OpenTelemetryTracer(trace.get_tracer(__name__))` to emit
+OpenTelemetry spans, or `profile=True` to print a per-stage breakdown on
+shutdown. Without a tracer the hooks cost a no-op method call.
+"""
+import random
+import sys
+import time
+from threading import Lock
+
+STAGES = ("clean", "enqueue", "queue_wait", "serialize", "batch", "request", "retry")
+
+
+class _NoopSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span(object):
+    __slots__ = ("tracer", "stage", "attributes", "start")
+
+    def __init__(self, tracer, stage, attributes):
+        self.tracer = tracer
+        self.stage = stage
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        self.tracer.record(self.stage, time.perf_counter() - self.start, **self.attributes)
+        return False
+
+
+class NoopTracer(object):
+    """The tracer used when tracing is off."""
+
+    enabled = False
+
+    def span(self, stage, **attributes):
+        return _NOOP_SPAN
+
+    def sampled(self):
+        return False
+
+    def record(self, stage, duration, **attributes):
+        pass
+
+    def report(self, file=None):
+        pass
+
+
+NOOP_TRACER = NoopTracer()
+
+
+class Tracer(NoopTracer):
+    """Calls `callback(stage, duration, attributes)` for a `sample_rate` fraction of the spans.
+
+    Subclasses can override `record` instead of passing a callback.
+    """
+
+    enabled = True
+
+    def __init__(self, callback=None, sample_rate=1.0):
+        self.callback = callback
+        self.sample_rate = sample_rate
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def span(self, stage, **attributes):
+        """Return a context manager that records the time spent in its block as `stage`."""
+        if not self.sampled():
+            return _NOOP_SPAN
+        return _Span(self, stage, attributes)
+
+    def record(self, stage, duration, **attributes):
+        """Record `duration` seconds spent in `stage`."""
+        if self.callback is not None:
+            self.callback(stage, duration, attributes)
+
+
+class OpenTelemetryTracer(Tracer):
+    """Emits a `usermaven.<stage>` span on an OpenTelemetry `tracer` for every recorded stage."""
+
+    def __init__(self, tracer, sample_rate=1.0):
+        Tracer.__init__(self, sample_rate=sample_rate)
+        self.tracer = tracer
+
+    def record(self, stage, duration, **attributes):
+        end = time.time_ns() if hasattr(time, "time_ns") else int(time.time() * 1e9)
+        span = self.tracer.start_span(
+            "usermaven." + stage, start_time=end - int(duration * 1e9), attributes=attributes
+        )
+        span.end(end_time=end)
+
+
+class Profiler(Tracer):
+    """Aggregates the time spent per stage and prints a breakdown with `report()`."""
+
+    def __init__(self, sample_rate=1.0):
+        Tracer.__init__(self, sample_rate=sample_rate)
+        self.lock = Lock()
+        self.stats = {}
+
+    def record(self, stage, duration, **attributes):
+        with self.lock:
+            stats = self.stats.get(stage)
+            if stats is None:
+                stats = self.stats[stage] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+    def report(self, file=None):
+        """Print the count, total, mean and max time of every stage, and its share of the total."""
+        file = file or sys.stderr
+        with self.lock:
+            stats = dict((stage, list(values)) for stage, values in self.stats.items())
+        total = sum(values[1] for values in stats.values()) or 1.0
+        order = [stage for stage in STAGES if stage in stats] + sorted(set(stats) - set(STAGES))
+
+        file.write("usermaven pipeline profile\n")
+        file.write("{0:<12}{1:>10}{2:>12}{3:>12}{4:>12}{5:>8}\n".format(
+            "stage", "count", "total ms", "mean us", "max ms", "share"))
+        for stage in order:
+            count, seconds, longest = stats[stage]
+            file.write("{0:<12}{1:>10}{2:>12.1f}{3:>12.1f}{4:>12.2f}{5:>7.1f}%\n".format(
+                stage, count, seconds * 1e3, seconds / count * 1e6, longest * 1e3, seconds / total * 100))
@@ -2,9 +2,13 @@ import logging
 import numbers
 from datetime import date, datetime
 from decimal import Decimal
+from threading import local
 from uuid import UUID
 
-import six
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
 
 log = logging.getLogger("usermaven")
 
@@ -15,12 +19,39 @@ def remove_trailing_slash(host):
     return host
 
 
+class ThreadVar(object):
+    """A thread-local stand-in for `contextvars.ContextVar` (Python 3.7+), with the same get/set/reset."""
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self.local = local()
+
+    def get(self):
+        return getattr(self.local, "value", self.default)
+
+    def set(self, value):
+        token = self.get()
+        self.local.value = value
+        return token
+
+    def reset(self, token):
+        self.local.value = token
+
+
+def context_var(name, default=None):
+    """Return a variable local to the current context: the asyncio task, or the thread without contextvars."""
+    if ContextVar is None:
+        return ThreadVar(name, default)
+    return ContextVar(name, default=default)
+
+
 def clean(item):
     if isinstance(item, Decimal):
         return float(item)
     if isinstance(item, UUID):
         return str(item)
-    elif isinstance(item, (six.string_types, bool, numbers.Number, datetime, date, type(None))):
+    elif isinstance(item, (str, bool, numbers.Number, datetime, date, type(None))):
         return item
     elif isinstance(item, (set, list, tuple)):
         return _clean_list(item)
@@ -36,7 +67,7 @@ def _clean_list(list_):
 
 def _clean_dict(dict_):
     data = {}
-    for k, v in six.iteritems(dict_):
+    for k, v in dict_.items():
         try:
             data[k] = clean(v)
         except TypeError:
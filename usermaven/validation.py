@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from threading import Lock
+
+from usermaven.settings import ID_TYPES
+from usermaven.utils import clean
+
+
+class Shape(object):
+    """A validator compiled once for one payload shape, e.g. the `company` dict.
+
+    `required` and `optional` are `(field, types)` pairs. Calling the shape
+    with a value checks it like a chain of `require(...)` calls would and
+    returns a new dict holding only the known fields.
+    """
+
+    __slots__ = ("name", "required", "optional", "_missing")
+
+    def __init__(self, name, required, optional=()):
+        self.name = name
+        # precompute the names used in error messages, e.g. "company_id"
+        self.required = tuple((field, types, name + "_" + field) for field, types in required)
+        self.optional = tuple((field, types, name + "_" + field) for field, types in optional)
+        self._missing = "{0} object is missing one or more of the required attributes".format(name)
+
+    def __call__(self, value):
+        if not isinstance(value, dict):
+            raise AssertionError("{0} must have {1}, got: {2}".format(self.name, dict, value))
+        # a missing field is reported before a field of the wrong type, as the chain did
+        for field, _, _ in self.required:
+            if field not in value:
+                raise ValueError(self._missing)
+        block = {}
+        for field, types, label in self.required:
+            field_value = value[field]
+            if not isinstance(field_value, types):
+                raise AssertionError("{0} must have {1}, got: {2}".format(label, types, field_value))
+            block[field] = field_value
+        for field, types, label in self.optional:
+            if field in value:
+                field_value = value[field]
+                if not isinstance(field_value, types):
+                    raise AssertionError("{0} must have {1}, got: {2}".format(label, types, field_value))
+                block[field] = field_value
+        return block
+
+
+USER = Shape(
+    "user", required=(("id", ID_TYPES), ("email", str), ("created_at", str)), optional=(("custom", dict),)
+)
+COMPANY = Shape(
+    "company", required=(("id", ID_TYPES), ("name", str), ("created_at", str)), optional=(("custom", dict),)
+)
+
+
+def _freeze(value):
+    """Return a hashable equivalent of `value`, raising `TypeError` if there is none."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return ("[",) + tuple(_freeze(v) for v in value)
+    # keep 1, 1.0 and True apart, they would otherwise share a key
+    return type(value), value
+
+
+class CompanyCache(object):
+    """A bounded LRU cache of validated and cleaned company blocks.
+
+    Blocks are keyed by the content of the company dict (which includes its
+    id), so a company that changes gets a new entry. The returned blocks are
+    shared between events and must not be mutated.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.blocks = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, company):
+        """Return the validated, cleaned block to send for `company`."""
+        if not self.maxsize:
+            return clean(COMPANY(company))
+        try:
+            key = _freeze(company)
+            hash(key)
+        except TypeError:
+            # unhashable contents (or not a dict), validate and clean without caching
+            return clean(COMPANY(company))
+
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+
+        block = clean(COMPANY(company))
+        with self.lock:
+            self.misses += 1
+            self.blocks[key] = block
+            if len(self.blocks) > self.maxsize:
+                self.blocks.popitem(last=False)
+        return block